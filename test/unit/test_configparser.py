@@ -0,0 +1,331 @@
+import os
+import shutil
+import tarfile
+import time
+import unittest
+from StringIO import StringIO
+from tempfile import mkdtemp
+
+from zerocloud.common import ACCESS_READABLE, ACCESS_WRITABLE, ACCESS_CDR, \
+    ACCESS_RANDOM
+from zerocloud.configparser import ClusterConfigParser
+from zerocloud.tarstream import TarIndex
+
+PARSER_CONFIG = {
+    'limits': {'reads': 1024, 'writes': 1024, 'rbytes': 1048576, 'wbytes': 1048576},
+    'manifest': {'Version': '20130611', 'Timeout': 5, 'Memory': 4294967296}
+}
+
+
+def make_config(node_id):
+    return {
+        'name': 'node%d' % node_id,
+        'id': node_id,
+        'args': 'script.lua %d' % node_id,
+        'env': {'NODE': str(node_id)},
+        'connect': ['tcp:%d:,/dev/out/reduce,0,0,0,0,0,0' % node_id],
+        'bind': [],
+        'name_service': 'udp:127.0.0.1:%d' % (54321 + node_id),
+        'channels': [
+            {'device': 'stdin', 'access': ACCESS_READABLE, 'removable': 'no',
+             'path': 'swift://a/c/input%d' % node_id, 'lpath': '/tmp/in%d' % node_id},
+            {'device': 'stdout', 'access': ACCESS_WRITABLE, 'removable': 'no',
+             'path': None, 'lpath': '/tmp/out%d' % node_id, 'mode': 'char'},
+            {'device': 'image', 'access': ACCESS_CDR, 'removable': 'yes',
+             'path': 'swift://a/c/lua.img', 'lpath': '/tmp/image%d' % node_id},
+            {'device': 'sysimage1', 'access': ACCESS_RANDOM | ACCESS_READABLE,
+             'removable': 'no', 'path': None, 'lpath': '/sysimage1'},
+        ]
+    }
+
+
+
+# manifests and nvram files built by prepare_zerovm_files before it used templates
+REFERENCE_FILES = {
+    'node1': (
+        'Version=20130611\n'
+        'Program=/tmp/nexe\n'
+        'Timeout=5\n'
+        'Memory=4294967296,0\n'
+        'Channel=/tmp/in1,/dev/stdin,0,0,1024,1048576,0,0\n'
+        'Channel=/tmp/out1,/dev/stdout,0,1,0,0,1024,1048576\n'
+        'Channel=/tmp/image1,/dev/image,1,0,1024,1048576,1024,1048576\n'
+        'Channel=/sysimage1,/dev/sysimage1,3,0,1024,1048576,0,0\n'
+        'Channel=tcp:1:,/dev/out/reduce,0,0,0,0,0,0\n'
+        'Channel=/dev/null,/dev/stderr,0,0,0,0,1024,1048576\n'
+        'Channel=/tmp/nexe,/dev/self,3,0,1024,1048576,0,0\n'
+        'Channel=nvram,/dev/nvram,3,0,1024,1048576,0,0\n'
+        'Node=1\n'
+        'NameServer=udp:127.0.0.1:54322\n',
+        '[fstab]\n'
+        'channel=/dev/image, mountpoint=/, access=ro, removable=yes\n'
+        'channel=/dev/sysimage1, mountpoint=/, access=ro, removable=no\n'
+        '[args]\n'
+        'args = node1 script.lua 1\n'
+        '[env]\n'
+        'name=NODE, value=1\n'
+        '[mapping]\n'
+        'channel=/dev/stdout, mode=char\n'),
+    'node2': (
+        'Version=20130611\n'
+        'Program=/tmp/nexe\n'
+        'Timeout=5\n'
+        'Memory=4294967296,0\n'
+        'Channel=/tmp/in2,/dev/stdin,0,0,1024,1048576,0,0\n'
+        'Channel=/tmp/out2,/dev/stdout,0,1,0,0,1024,1048576\n'
+        'Channel=/tmp/image2,/dev/image,1,0,1024,1048576,1024,1048576\n'
+        'Channel=/sysimage1,/dev/sysimage1,3,0,1024,1048576,0,0\n'
+        'Channel=tcp:2:,/dev/out/reduce,0,0,0,0,0,0\n'
+        'Channel=/dev/null,/dev/stderr,0,0,0,0,1024,1048576\n'
+        'Channel=/tmp/nexe,/dev/self,3,0,1024,1048576,0,0\n'
+        'Channel=nvram,/dev/nvram,3,0,1024,1048576,0,0\n'
+        'Node=2\n'
+        'NameServer=udp:127.0.0.1:54323\n',
+        '[fstab]\n'
+        'channel=/dev/image, mountpoint=/, access=ro, removable=yes\n'
+        'channel=/dev/sysimage1, mountpoint=/, access=ro, removable=no\n'
+        '[args]\n'
+        'args = node2 script.lua 2\n'
+        '[env]\n'
+        'name=NODE, value=2\n'
+        '[mapping]\n'
+        'channel=/dev/stdout, mode=char\n'),
+    'local_read': (
+        'Version=20130611\n'
+        'Program=/tmp/nexe\n'
+        'Timeout=5\n'
+        'Memory=4294967296,0\n'
+        'Channel=/tmp/in1,/dev/stdin,0,0,1024,1048576,0,0\n'
+        'Channel=/tmp/out1,/dev/stdout,0,1,0,0,1024,1048576\n'
+        'Channel=/tmp/image1,/dev/image,1,0,1024,1048576,1024,1048576\n'
+        'Channel=/sysimage1,/dev/sysimage1,3,0,1024,1048576,0,0\n'
+        'Channel=tcp:1:,/dev/out/reduce,0,0,0,0,0,0\n'
+        'Channel=/dev/null,/dev/stderr,0,0,0,0,1024,1048576\n'
+        'Channel=/tmp/nexe,/dev/self,3,0,1024,1048576,0,0\n'
+        'Channel=nvram,/dev/nvram,3,0,1024,1048576,0,0\n'
+        'Node=1\n'
+        'NameServer=udp:127.0.0.1:54322\n',
+        '[fstab]\n'
+        'channel=/dev/image, mountpoint=/, access=ro, removable=yes\n'
+        'channel=/dev/sysimage1, mountpoint=/, access=ro, removable=no\n'
+        '[args]\n'
+        'args = node1 script.lua 1\n'
+        '[env]\n'
+        'name=CONTENT_LENGTH, value=10\n'
+        'name=CONTENT_TYPE, value=text/plain\n'
+        'name=HTTP_X_OBJECT_META_KEY, value=value\n'
+        'name=HTTP_ETAG, value=abc\n'
+        'name=DOCUMENT_ROOT, value=/dev/stdin\n'
+        'name=NODE, value=1\n'
+        'name=REQUEST_METHOD, value=POST\n'
+        'name=PATH_INFO, value=/a/c/input1\n'
+        '[mapping]\n'
+        'channel=/dev/stdout, mode=char\n'),
+    'local_write': (
+        'Version=20130611\n'
+        'Program=/tmp/nexe\n'
+        'Timeout=5\n'
+        'Memory=4294967296,0\n'
+        'Channel=/tmp/in1,/dev/stdin,0,0,1024,1048576,0,0\n'
+        'Channel=/tmp/out1,/dev/stdout,0,1,0,0,1024,1048576\n'
+        'Channel=/tmp/image1,/dev/image,1,0,1024,1048576,1024,1048576\n'
+        'Channel=/sysimage1,/dev/sysimage1,3,0,1024,1048576,0,0\n'
+        'Channel=tcp:1:,/dev/out/reduce,0,0,0,0,0,0\n'
+        'Channel=/dev/null,/dev/stderr,0,0,0,0,1024,1048576\n'
+        'Channel=/tmp/nexe,/dev/self,3,0,1024,1048576,0,0\n'
+        'Channel=nvram,/dev/nvram,3,0,1024,1048576,0,0\n'
+        'Node=1\n'
+        'NameServer=udp:127.0.0.1:54322\n',
+        '[fstab]\n'
+        'channel=/dev/image, mountpoint=/, access=ro, removable=yes\n'
+        'channel=/dev/sysimage1, mountpoint=/, access=ro, removable=no\n'
+        '[args]\n'
+        'args = node1 script.lua 1\n'
+        '[env]\n'
+        'name=CONTENT_TYPE, value=text/html\n'
+        'name=HTTP_X_OBJECT_META_KEY, value=value\n'
+        'name=DOCUMENT_ROOT, value=/dev/stdout\n'
+        'name=NODE, value=1\n'
+        'name=REQUEST_METHOD, value=POST\n'
+        'name=PATH_INFO, value=/a/c/out1\n'
+        '[mapping]\n'
+        'channel=/dev/stdout, mode=char\n'),
+    'no_env': (
+        'Version=20130611\n'
+        'Program=/tmp/nexe\n'
+        'Timeout=5\n'
+        'Memory=4294967296,0\n'
+        'Channel=/tmp/in1,/dev/stdin,0,0,1024,1048576,0,0\n'
+        'Channel=/tmp/out1,/dev/stdout,0,1,0,0,1024,1048576\n'
+        'Channel=/tmp/image1,/dev/image,1,0,1024,1048576,1024,1048576\n'
+        'Channel=/sysimage1,/dev/sysimage1,3,0,1024,1048576,0,0\n'
+        'Channel=tcp:1:,/dev/out/reduce,0,0,0,0,0,0\n'
+        'Channel=/dev/null,/dev/stderr,0,0,0,0,1024,1048576\n'
+        'Channel=/tmp/nexe,/dev/self,3,0,1024,1048576,0,0\n'
+        'Channel=nvram,/dev/nvram,3,0,1024,1048576,0,0\n'
+        'Node=1\n'
+        'NameServer=udp:127.0.0.1:54322\n',
+        '[fstab]\n'
+        'channel=/dev/image, mountpoint=/, access=ro, removable=yes\n'
+        'channel=/dev/sysimage1, mountpoint=/, access=ro, removable=no\n'
+        '[args]\n'
+        'args = node1 script.lua 1\n'
+        '[mapping]\n'
+        'channel=/dev/stdout, mode=char\n'),
+}
+
+def make_reference_config(name):
+    """Returns config and local object of a REFERENCE_FILES case"""
+    config = make_config(2 if name == 'node2' else 1)
+    local_object = None
+    if name == 'local_read':
+        local_object = config['channels'][0]
+        local_object.update({'path_info': '/a/c/input1', 'size': 10,
+                             'meta': {'Content-Type': 'text/plain', 'X-Object-Meta-Key': 'value',
+                                      'ETag': 'abc'}})
+    elif name == 'local_write':
+        local_object = config['channels'][1]
+        local_object.update({'path': 'swift://a/c/out1', 'path_info': '/a/c/out1',
+                             'content_type': 'text/html', 'meta': {'key': 'value'}})
+    elif name == 'no_env':
+        config['env'] = {}
+    return config, local_object
+
+
+class TestManifestTemplates(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+        self.parser = ClusterConfigParser({'sysimage1': '/sysimage1'}, None,
+                                          PARSER_CONFIG, None, None)
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def prepare(self, parser, config, nvram_name, local_object=None):
+        nvram_file = os.path.join(self.testdir, nvram_name)
+        manifest = parser.prepare_zerovm_files(config, nvram_file, local_object,
+                                               '/tmp/nexe', True)
+        return manifest.replace(nvram_file, 'nvram'), open(nvram_file).read()
+
+    def test_reference(self):
+        uncached = ClusterConfigParser({'sysimage1': '/sysimage1'}, None,
+                                       PARSER_CONFIG, None, None)
+        uncached.manifest_template_cache_size = 0
+        # second round is built from cached templates
+        for _junk in range(2):
+            for name, expected in sorted(REFERENCE_FILES.items()):
+                config, local_object = make_reference_config(name)
+                self.assertEqual(self.prepare(uncached, config, 'nvram1', local_object), expected)
+                config, local_object = make_reference_config(name)
+                self.assertEqual(self.prepare(self.parser, config, 'nvram2', local_object), expected)
+        self.assertEqual(len(self.parser.manifest_templates), 3)
+        self.assertEqual(len(uncached.manifest_templates), 0)
+
+    def test_shape_change(self):
+        config = make_config(1)
+        self.prepare(self.parser, config, 'nvram')
+        config = make_config(1)
+        config['channels'][1]['mode'] = 'pipe'
+        manifest, nvram = self.prepare(self.parser, config, 'nvram')
+        self.assertTrue('channel=/dev/stdout, mode=pipe' in nvram)
+        config = make_config(1)
+        local_object = config['channels'][0]
+        local_object.update({'path_info': '/a/c/input1', 'content_type': 'text/plain', 'size': 10,
+                             'meta': {'X-Object-Meta-Key': 'value'}})
+        manifest, nvram = self.prepare(self.parser, config, 'nvram', local_object)
+        self.assertTrue('name=PATH_INFO, value=/a/c/input1' in nvram)
+        self.assertEqual(len(self.parser.manifest_templates), 3)
+
+    def test_cache_size(self):
+        parser = ClusterConfigParser({'sysimage1': '/sysimage1'}, None,
+                                     PARSER_CONFIG, None, None, manifest_template_cache_size=2)
+        shapes = []
+        for mode in ('char', 'pipe', 'file'):
+            config = make_config(1)
+            config['channels'][1]['mode'] = mode
+            self.prepare(parser, config, 'nvram')
+            shapes.append(parser._get_config_shape(config, None, True))
+            if mode == 'pipe':
+                # first shape is used again, second one becomes the least recently used
+                config = make_config(1)
+                self.prepare(parser, config, 'nvram')
+        self.assertEqual(parser.manifest_templates.keys(), [shapes[0], shapes[2]])
+
+    def test_memory(self):
+        config = make_config(1)
+        manifest, nvram = self.prepare(self.parser, config, 'nvram')
+        self.assertTrue('Memory=4294967296,0\n' in manifest)
+        config['memory'] = 268435456
+        manifest, nvram = self.prepare(self.parser, config, 'nvram')
+        self.assertTrue('Memory=268435456,0\n' in manifest)
+        self.assertEqual(len(self.parser.manifest_templates), 1)
+        config['memory'] = 8589934592
+        manifest, nvram = self.prepare(self.parser, config, 'nvram')
+        self.assertTrue('Memory=4294967296,0\n' in manifest)
+
+    @unittest.skipUnless(os.environ.get('ZEROCLOUD_BENCH'), 'set ZEROCLOUD_BENCH=1 to run benchmarks')
+    def test_benchmark(self):
+        sessions = int(os.environ.get('ZEROCLOUD_BENCH_SESSIONS', 10000))
+        configs = [make_config(i % 100) for i in range(sessions)]
+        nvram_file = os.path.join(self.testdir, 'nvram')
+        for cache_size in (0, 1024):
+            self.parser.manifest_template_cache_size = cache_size
+            self.parser.manifest_templates.clear()
+            start = time.time()
+            for config in configs:
+                self.parser.prepare_zerovm_files(config, nvram_file, None, '/tmp/nexe', True)
+            elapsed = time.time() - start
+            print '\nmanifest build, cache_size=%d: %.1f us/session' \
+                  % (cache_size, elapsed / sessions * 1000000)
+
+
+class TestSysimageIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+        self.image = os.path.join(self.testdir, 'image.tar')
+        self.index_dir = os.path.join(self.testdir, 'index')
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def make_parser(self):
+        return ClusterConfigParser({'image': self.image}, None, PARSER_CONFIG, None, None,
+                                   sysimage_index_dir=self.index_dir)
+
+    def create_image(self, names):
+        tar = tarfile.open(self.image, 'w')
+        for name in names:
+            info = tarfile.TarInfo(name)
+            info.size = len(name)
+            tar.addfile(info, StringIO(name))
+        tar.close()
+
+    def test_utf8_names(self):
+        self.create_image(['bin/python', 'bin/caf\xc3\xa9'])
+        index = self.make_parser().get_sysimage_index('image')
+        self.assertTrue(index.lookup('bin/caf\xc3\xa9'))
+        self.assertEqual(os.listdir(self.index_dir), ['image.json'])
+        # persisted index is loaded by the next worker
+        index = self.make_parser().get_sysimage_index('image')
+        self.assertEqual(sorted(index.members.keys()), ['bin/caf\xc3\xa9', 'bin/python'])
+
+    def test_not_utf8_names(self):
+        self.create_image(['bin/python', 'bin/caf\xe9'])
+        index = self.make_parser().get_sysimage_index('image')
+        # index cannot be saved but is used
+        self.assertTrue(index.lookup('bin/caf\xe9'))
+        self.assertFalse(os.path.exists(os.path.join(self.index_dir, 'image.json')))
+
+    def test_foreign_index(self):
+        self.create_image(['bin/python'])
+        self.make_parser().get_sysimage_index('image')
+        index_file = os.path.join(self.index_dir, 'image.json')
+        os.chmod(index_file, 0666)
+        index = TarIndex(self.image)
+        self.assertFalse(index.load(index_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import logging
+import unittest
+
+from zerocloud import metrics
+from zerocloud.metrics import SessionMetrics, PhaseTimer, BUCKETS
+
+
+class FakeStatsdLogger(object):
+
+    def __init__(self):
+        self.timings = []
+
+    def timing(self, name, value):
+        self.timings.append((name, value))
+
+
+class TestSessionMetrics(unittest.TestCase):
+
+    def test_observe(self):
+        logger = FakeStatsdLogger()
+        session_metrics = SessionMetrics(logger=logger)
+        session_metrics.observe('run', 'default', 'AUTH_a.b', 0.003)
+        session_metrics.observe('run', 'default', 'AUTH_a.b', 100)
+        histogram = session_metrics.histograms[('run', 'default', 'AUTH_a.b')]
+        self.assertEqual(histogram.count, 2)
+        self.assertEqual(histogram.total, 100.003)
+        self.assertEqual(histogram.counts[list(BUCKETS).index(0.005)], 1)
+        self.assertEqual(histogram.counts[-1], 1)
+        self.assertEqual(logger.timings[:2], [('zap_phase_time.run.default', 3.0),
+                                              ('zap_phase_time.run.default.AUTH_a_b', 3.0)])
+
+    def test_max_accounts(self):
+        session_metrics = SessionMetrics(max_accounts=2)
+        for account in ('a', 'b', 'c', 'd', 'a'):
+            session_metrics.observe('upload', 'default', account, 1)
+        self.assertEqual(sorted(session_metrics.histograms.keys()),
+                         [('upload', 'default', '_other'),
+                          ('upload', 'default', 'a'),
+                          ('upload', 'default', 'b')])
+        self.assertEqual(session_metrics.histograms[('upload', 'default', '_other')].count, 2)
+
+    def test_render(self):
+        session_metrics = SessionMetrics()
+        session_metrics.observe('run', 'default', 'a"b', 0.2)
+        session_metrics.observe('run', 'default', 'a"b', 2)
+        lines = session_metrics.render().splitlines()
+        labels = 'phase="run",pool="default",account="a\\"b"'
+        self.assertIn('# TYPE zerovm_phase_seconds histogram', lines)
+        self.assertIn('zerovm_phase_seconds_bucket{%s,le="0.1"} 0' % labels, lines)
+        self.assertIn('zerovm_phase_seconds_bucket{%s,le="0.25"} 1' % labels, lines)
+        self.assertIn('zerovm_phase_seconds_bucket{%s,le="2.5"} 2' % labels, lines)
+        self.assertIn('zerovm_phase_seconds_bucket{%s,le="+Inf"} 2' % labels, lines)
+        self.assertIn('zerovm_phase_seconds_sum{%s} 2.200000' % labels, lines)
+        self.assertIn('zerovm_phase_seconds_count{%s} 2' % labels, lines)
+
+
+class TestPhaseTimer(unittest.TestCase):
+
+    def setUp(self):
+        self.orig_time = metrics.time.time
+        self.now = 1000.0
+        metrics.time.time = lambda: self.now
+
+    def tearDown(self):
+        metrics.time.time = self.orig_time
+
+    def test_mark(self):
+        session_metrics = SessionMetrics()
+        timer = PhaseTimer(session_metrics, 'default', 'a')
+        self.now += 2
+        timer.mark('upload')
+        self.now += 0.5
+        timer.mark('run')
+        self.assertEqual(session_metrics.histograms[('upload', 'default', 'a')].total, 2)
+        self.assertEqual(session_metrics.histograms[('run', 'default', 'a')].total, 0.5)
+
+    def test_disabled(self):
+        timer = PhaseTimer(None, 'default', 'a')
+        self.now += 1
+        timer.mark('upload')
+        self.assertEqual(timer.last, self.now)
+
+
+class TestSendGauge(unittest.TestCase):
+
+    def test_statsd_client(self):
+        sent = []
+
+        class FakeStatsdClient(object):
+
+            def _send(self, *args):
+                sent.append(args)
+
+        class FakeAdapter(object):
+
+            def __init__(self, logger):
+                self.logger = logger
+
+        logger = logging.getLogger('test_send_gauge')
+        logger.statsd_client = FakeStatsdClient()
+        metrics.send_gauge(FakeAdapter(logger), 'zap_pool_limit.default', 3)
+        self.assertEqual(sent, [('zap_pool_limit.default', 3, 'g', None)])
+        # logger without statsd
+        metrics.send_gauge(FakeAdapter(logging.getLogger('test_send_gauge_none')), 'x', 1)
+        metrics.send_gauge(None, 'x', 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
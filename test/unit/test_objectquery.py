@@ -1,18 +1,26 @@
+from collections import OrderedDict
 from contextlib import contextmanager
 from StringIO import StringIO
 from dircache import opendir
 import traceback
 import logging
 from posix import rmdir, listdir
+import fcntl
+import signal
+import stat
 import struct
+import subprocess
+import sys
 import unittest
 import os
 import random
 import cPickle as pickle
 from time import time, sleep
-from eventlet import GreenPool
+from eventlet import GreenPool, spawn
+from eventlet.event import Event
+from eventlet.green import socket
 from unittest.case import SkipTest
-from hashlib import md5
+from hashlib import md5, sha256
 from tempfile import mkstemp, mkdtemp
 from shutil import rmtree
 from copy import copy
@@ -21,15 +29,17 @@ import tarfile
 from eventlet.wsgi import Input
 
 from swift.common import utils
-from swift.common.swob import Request
+from swift.common.swob import Request, Response
 from swift.common.utils import mkdirs, normalize_timestamp, get_logger
 from swift.obj.server import ObjectController
 from test.unit import FakeLogger
 
 from test_proxyquery import ZEROVM_DEFAULT_MOCK
 from zerocloud.common import ZvmNode, ACCESS_READABLE, ACCESS_WRITABLE, NodeEncoder, ACCESS_CDR, \
-    parse_location, ACCESS_RANDOM, TAR_MIMES
+    parse_location, ACCESS_RANDOM, TAR_MIMES, REPORT_LENGTH, REPORT_DAEMON
 from zerocloud import objectquery
+from zerocloud.scheduler import FairPool
+from zerocloud.metrics import SessionMetrics, PHASES
 
 try:
     import simplejson as json
@@ -103,6 +113,8 @@ class TestObjectQuery(unittest.TestCase):
         self.conf = {'devices': self.testdir,
                      'mount_check': 'false',
                      'disable_fallocate': 'true',
+                     'zerovm_validation_dir': os.path.join(self.testdir, 'validated'),
+                     'zerovm_sockets_dir': os.path.join(self.testdir, 'zvm-daemons'),
                      'zerovm_sysimage_devices': 'sysimage1 /opt/zerovm/sysimage1 sysimage2 /opt/zerovm/sysimage2'
         }
         self.obj_controller = FakeApp(self.conf)
@@ -219,6 +231,215 @@ class TestObjectQuery(unittest.TestCase):
         with objectquery.TmpDir(tmpdir, 'sda1').mkstemp():
             self.assert_(os.path.exists(tmpdir))
 
+    def test_session_dir_pool(self):
+        parent = os.path.join(self.testdir, 'sda1', 'tmp', 'zvm-sessions')
+        # leftovers of a dead worker and of a previous process with our pid
+        dead_pid = 1 << 22
+        while True:
+            try:
+                os.kill(dead_pid, 0)
+                dead_pid += 1
+            except OSError:
+                break
+        mkdirs(os.path.join(parent, str(dead_pid), 'tmpabc'))
+        leftover = os.path.join(parent, str(os.getpid()), 'tmpdef')
+        mkdirs(os.path.join(leftover, 'dir'))
+        open(os.path.join(leftover, 'file'), 'w').close()
+        pool = objectquery.SessionDirPool(parent, 2)
+        pool.wait()
+        self.assertEqual(os.listdir(parent), [str(os.getpid())])
+        self.assertEqual(pool.free, [leftover])
+        self.assertEqual(os.listdir(leftover), [])
+        dirs = [pool.get() for _junk in range(3)]
+        self.assertEqual(dirs[0], leftover)
+        for path in dirs:
+            open(os.path.join(path, 'file'), 'w').close()
+            pool.put(path)
+        pool.wait()
+        # only max_size directories are kept
+        self.assertEqual(len(pool.free), 2)
+        self.assertEqual(sorted(os.listdir(os.path.join(parent, str(os.getpid())))),
+                         sorted(os.path.basename(path) for path in pool.free))
+        for path in pool.free:
+            self.assertEqual(os.listdir(path), [])
+
+    def test_QUERY_session_dir_pool(self):
+        self.setup_zerovm_query()
+        conf = ZvmNode(1, 'sort', parse_location('swift://a/c/exe'))
+        conf.add_new_channel('stdin', ACCESS_READABLE, parse_location('swift://a/c/o'))
+        conf.add_new_channel('stdout', ACCESS_WRITABLE)
+        conf = json.dumps(conf, cls=NodeEncoder)
+        for _junk in range(3):
+            with self.create_tar({'boot': StringIO(self._nexescript), 'sysmap': StringIO(conf)}) as tar:
+                length = os.path.getsize(tar)
+                req = self.zerovm_object_request()
+                req.body_file = Input(open(tar, 'rb'), length)
+                req.content_length = length
+                resp = self.app.zerovm_query(req)
+                self.assertEqual(resp.status_int, 200)
+                self.assertEqual(resp.headers['x-nexe-retcode'], '0')
+            pool = self.app.session_dir_pools[os.path.join(self.testdir, 'sda1', 'tmp')]
+            pool.wait()
+            # the same directory is reused by every session
+            self.assertEqual(len(pool.free), 1)
+            self.assertEqual(os.listdir(pool.free[0]), [])
+
+    def test_strip_file_head(self):
+        random.seed(0)
+        data = ''.join(chr(random.randrange(256)) for _junk in range(100000))
+        for offset in (0, 10, 4096, 65536, len(data)):
+            fd, path = mkstemp(dir=self.testdir)
+            os.write(fd, data)
+            os.close(fd)
+            try:
+                etag = objectquery._strip_file_head(path, offset, chunk_size=1000)
+                self.assertEqual(open(path, 'rb').read(), data[offset:])
+                self.assertEqual(etag, md5(data[offset:]).hexdigest())
+                self.assertEqual(objectquery._md5_file(path, chunk_size=1000), etag)
+            finally:
+                os.unlink(path)
+
+    def test_daemon_registry(self):
+        sockets_dir = mkdtemp()
+        daemon_sock = os.path.join(sockets_dir, 'daemon-uuid')
+        proc = subprocess.Popen([sys.executable, '-c',
+                                 'import socket, sys, time\n'
+                                 's = socket.socket(socket.AF_UNIX)\n'
+                                 's.bind(sys.argv[1])\n'
+                                 's.listen(1)\n'
+                                 'sys.stdout.write("ok")\n'
+                                 'sys.stdout.flush()\n'
+                                 'time.sleep(30)\n',
+                                 daemon_sock],
+                                stdout=subprocess.PIPE)
+        try:
+            self.assertEqual(proc.stdout.read(2), 'ok')
+            registry = objectquery.DaemonRegistry(sockets_dir)
+            self.assertFalse(registry.is_alive(daemon_sock))
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(daemon_sock)
+            record = registry.register(daemon_sock, sock)
+            sock.close()
+            self.assertEqual(record['pid'], proc.pid)
+            self.assertTrue(os.path.exists(daemon_sock + '.pid'))
+            # record is shared with other workers
+            other = objectquery.DaemonRegistry(sockets_dir)
+            self.assertTrue(other.is_alive(daemon_sock))
+            other.cleanup(daemon_sock)
+            self.assertEqual(proc.wait(), -signal.SIGKILL)
+            self.assertFalse(os.path.exists(daemon_sock))
+            self.assertFalse(os.path.exists(daemon_sock + '.pid'))
+            self.assertFalse(registry.is_alive(daemon_sock))
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                proc.wait()
+            rmtree(sockets_dir)
+
+    def test_daemon_registry_untrusted(self):
+        sockets_dir = mkdtemp()
+        daemon_sock = os.path.join(sockets_dir, 'daemon-uuid')
+        victim = subprocess.Popen(['sleep', '30'])
+        try:
+            record = {'pid': victim.pid,
+                      'start_time': objectquery._get_process_start_time(victim.pid),
+                      'registered': time()}
+            with open(daemon_sock + '.pid', 'wb') as fp:
+                fp.write(json.dumps(record))
+            # record writable by others is ignored
+            os.chmod(daemon_sock + '.pid', 0666)
+            registry = objectquery.DaemonRegistry(sockets_dir)
+            self.assertEqual(registry.get(daemon_sock), None)
+            self.assertFalse(registry.is_alive(daemon_sock))
+            # pid that is not confirmed by the socket is not killed
+            os.chmod(daemon_sock + '.pid', 0600)
+            registry = objectquery.DaemonRegistry(sockets_dir)
+            self.assertTrue(registry.is_alive(daemon_sock))
+            registry.cleanup(daemon_sock)
+            sleep(0.1)
+            self.assertEqual(victim.poll(), None)
+            self.assertFalse(os.path.exists(daemon_sock + '.pid'))
+            # sockets directory writable by others is refused
+            os.chmod(sockets_dir, 0777)
+            self.assertRaises(ValueError, objectquery.DaemonRegistry, sockets_dir)
+        finally:
+            victim.kill()
+            victim.wait()
+            rmtree(sockets_dir)
+
+    def test_daemon_instances(self):
+        fd, conf_file = mkstemp()
+        os.write(fd, json.dumps([{'name': 'daemon',
+                                  'exec': {'path': 'file://sysimage1:daemon'},
+                                  'file_list': [{'device': 'stdin'},
+                                                {'device': 'stdout'}]}]))
+        os.close(fd)
+        sockets_dir = mkdtemp()
+        try:
+            conf = copy(self.conf)
+            conf['zerovm_daemons'] = 'uuid1 %s uuid2 /nonexistent' % conf_file
+            conf['zerovm_daemon_instances'] = '3'
+            app = objectquery.ObjectQueryMiddleware(self.obj_controller, conf, logger=FakeLogger())
+            self.assertEqual(app.zerovm_daemons.keys(), ['uuid1'])
+            app.zerovm_sockets_dir = sockets_dir
+            sockets = app.get_daemon_sockets('uuid1')
+            self.assertEqual(sockets, [os.path.join(sockets_dir, 'uuid1'),
+                                       os.path.join(sockets_dir, 'uuid1.1'),
+                                       os.path.join(sockets_dir, 'uuid1.2')])
+            # daemons that are not configured on this node have one instance
+            self.assertEqual(app.get_daemon_sockets('other'), [os.path.join(sockets_dir, 'other')])
+            alive = set()
+            app.daemons.is_alive = lambda sock: sock in alive
+            # nothing is running, first instance is started on connect
+            self.assertEqual(app.select_daemon_socket('uuid1'), sockets[0])
+            alive.update(sockets[1:])
+            app.daemon_load[sockets[1]] = 2
+            self.assertEqual(app.select_daemon_socket('uuid1'), sockets[2])
+            app.daemon_load[sockets[2]] = 3
+            self.assertEqual(app.select_daemon_socket('uuid1'), sockets[1])
+
+            manifests = []
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+            def execute_zerovm(zerovm_inputmnfst_fn, zerovm_args=None, timer=None):
+                manifests.append(open(zerovm_inputmnfst_fn).read())
+                # zerovm exits when the forked daemon listens on the job socket
+                listener.bind(sockets[0])
+                listener.listen(1)
+                report = ['0'] * REPORT_LENGTH
+                report[REPORT_DAEMON] = '1'
+                return 0, '\n'.join(report), ''
+
+            def no_job(*args):
+                self.fail('Job sent when the daemon is started')
+
+            # daemon is started without a session and without a pool slot
+            app.execute_zerovm = execute_zerovm
+            app.zerovm_query = no_job
+            app.send_to_socket = no_job
+            for pool, queue in app.zerovm_threadpools.values():
+                pool.spawn = no_job
+            with self.create_tar({'daemon': StringIO(self._nexescript)}) as image_tar:
+                app.parser.sysimage_devices = {'sysimage1': image_tar}
+                self.assertTrue(app.start_daemon('uuid1', sockets[0]))
+            listener.close()
+            self.assertEqual(len(manifests), 1)
+            self.assertIn('Job = %s\n' % sockets[0], manifests[0])
+            # daemon pid is recorded from its socket
+            self.assertEqual(app.daemons.get(sockets[0])['pid'], os.getpid())
+            # instance is being started by another worker
+            lock_fd = os.open(sockets[1] + '.lock', os.O_CREAT | os.O_RDWR)
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+                alive.discard(sockets[1])
+                self.assertFalse(app.start_daemon('uuid1', sockets[1]))
+                self.assertEqual(len(manifests), 1)
+            finally:
+                os.close(lock_fd)
+        finally:
+            os.unlink(conf_file)
+            rmtree(sockets_dir)
+
     def test_QUERY_realzvm(self):
         raise SkipTest
         orig_exe = self.app.zerovm_exename
@@ -298,6 +519,46 @@ class TestObjectQuery(unittest.TestCase):
             #self.assertEqual(self.app.logger.log_dict['info'][0][0][0],
             #    'Zerovm CDR: 0 0 0 0 1 46 2 56 0 0 0 0')
 
+    def test_QUERY_sendfile(self):
+        if not objectquery.has_sendfile():
+            raise SkipTest
+        self.setup_zerovm_query()
+        req = self.zerovm_object_request()
+        nexefile = StringIO(self._nexescript)
+        conf = ZvmNode(1, 'sort', parse_location('swift://a/c/exe'))
+        conf.add_new_channel('stdin', ACCESS_READABLE, parse_location('swift://a/c/o'))
+        conf.add_new_channel('stdout', ACCESS_WRITABLE)
+        conf = json.dumps(conf, cls=NodeEncoder)
+        sysmap = StringIO(conf)
+        server_sock, client_sock = socket.socketpair()
+        orig_get_client_socket = self.app._get_client_socket
+        try:
+            self.app.zerovm_sendfile = True
+            self.app._get_client_socket = lambda req: server_sock
+            with self.create_tar({'boot': nexefile, 'sysmap': sysmap}) as tar:
+                length = os.path.getsize(tar)
+                req.body_file = Input(open(tar, 'rb'), length)
+                req.content_length = length
+                resp = self.app.zerovm_query(req)
+                self.assertEqual(req.environ['eventlet.minimum_write_chunk_size'], 0)
+                # act as WSGI server: chunks are written to the same socket
+                for chunk in resp.app_iter:
+                    server_sock.sendall(chunk)
+                server_sock.close()
+                fd, name = mkstemp()
+                for chunk in iter(lambda: client_sock.recv(65536), ''):
+                    os.write(fd, chunk)
+                os.close(fd)
+                self.assertEqual(os.path.getsize(name), resp.content_length)
+                tar = tarfile.open(name)
+                members = tar.getmembers()
+                self.assertEqual(tar.getnames()[-1], 'stdout')
+                self.assertEqual(tar.extractfile(members[-1]).read(), self._sortednumbers)
+        finally:
+            self.app.zerovm_sendfile = False
+            self.app._get_client_socket = orig_get_client_socket
+            client_sock.close()
+
     def test_QUERY_sort_textout(self):
         self.setup_zerovm_query()
         req = self.zerovm_object_request()
@@ -572,6 +833,243 @@ return resp + out
             #self.assertEqual(self.app.logger.log_dict['info'][0][0][0],
             #    'Zerovm CDR: 0 0 0 0 1 0 2 13 0 0 0 0')
 
+    def test_QUERY_pipeline(self):
+        self.app.zerovm_pipeline = True
+        self.setup_zerovm_query()
+        fifos = []
+        orig_prepare = self.app.parser.prepare_zerovm_files
+
+        def prepare_zerovm_files(config, *args):
+            for ch in config['channels']:
+                if ch.get('lpath') and stat.S_ISFIFO(os.stat(ch['lpath']).st_mode):
+                    fifos.append(ch['device'])
+            return orig_prepare(config, *args)
+        self.app.parser.prepare_zerovm_files = prepare_zerovm_files
+        conf = ZvmNode(1, 'sort', parse_location('swift://a/c/exe'))
+        conf.add_new_channel('stdin', ACCESS_READABLE, parse_location('swift://a/c/input'))
+        conf.add_new_channel('stdout', ACCESS_WRITABLE)
+        conf = json.dumps(conf, cls=NodeEncoder)
+        # stdin is the last member, after sysmap, so it is fed to zerovm through a FIFO
+        members = OrderedDict([('sysmap', StringIO(conf)),
+                               ('boot', StringIO(self._nexescript)),
+                               ('stdin', StringIO(self.create_random_numbers(10)))])
+        with self.create_tar(members) as tar:
+            length = os.path.getsize(tar)
+            req = self.zerovm_free_request()
+            req.body_file = Input(open(tar, 'rb'), length)
+            req.content_length = length
+            resp = self.app.zerovm_query(req)
+            self.assertEqual(resp.status_int, 200)
+            self.assertEqual(resp.headers['x-nexe-retcode'], '0')
+            self.assertEqual(req.body_file.position, length)
+            fd, name = mkstemp()
+            for chunk in resp.app_iter:
+                os.write(fd, chunk)
+            os.close(fd)
+            tar = tarfile.open(name)
+            self.assertEqual(tar.extractfile('stdout').read(), self._sortednumbers)
+            os.unlink(name)
+        self.assertEqual(fifos, ['stdin'])
+        self.assertIn('zap_pipelined', self.app.logger.get_increments())
+        # executable arrives after stdin, session is not pipelined
+        members = OrderedDict([('sysmap', StringIO(conf)),
+                               ('stdin', StringIO(self.create_random_numbers(10))),
+                               ('boot', StringIO(self._nexescript))])
+        with self.create_tar(members) as tar:
+            length = os.path.getsize(tar)
+            req = self.zerovm_free_request()
+            req.body_file = Input(open(tar, 'rb'), length)
+            req.content_length = length
+            resp = self.app.zerovm_query(req)
+            self.assertEqual(resp.status_int, 200)
+            self.assertEqual(resp.headers['x-nexe-retcode'], '0')
+        self.assertEqual(fifos, ['stdin'])
+
+    def test_QUERY_early_prepare(self):
+        self.setup_zerovm_query()
+        self.app.zerovm_early_prepare = True
+        prepared = []
+        orig_prepare_early = self.app._prepare_early
+
+        def prepare_early(early, *args):
+            orig_prepare_early(early, *args)
+            prepared.append((early.disk_files.keys(), early.outputs.keys(), early.reserved_size))
+            disk_files.extend(disk_file for disk_file, _junk in early.disk_files.values())
+        self.app._prepare_early = prepare_early
+        disk_files = []
+        conf = ZvmNode(1, 'sort', parse_location('swift://a/c/exe'))
+        conf.add_new_channel('stdin', ACCESS_READABLE, parse_location('swift://a/c/o'))
+        conf.add_new_channel('stdout', ACCESS_WRITABLE)
+        conf.channels[-1].size_hint = 4096
+        conf = json.dumps(conf, cls=NodeEncoder)
+        members = OrderedDict([('sysmap', StringIO(conf)),
+                               ('boot', StringIO(self._nexescript))])
+        pool = self.app.zerovm_threadpools['default'][0]
+        device_tmp = os.path.join(self.testdir, 'sda1', 'tmp')
+        with self.create_tar(members) as tar:
+            length = os.path.getsize(tar)
+            req = self.zerovm_object_request()
+            req.body_file = Input(open(tar, 'rb'), length)
+            req.content_length = length
+            resp = self.app.zerovm_query(req)
+            self.assertEqual(resp.status_int, 200)
+            self.assertEqual(resp.headers['x-nexe-retcode'], '0')
+            fd, name = mkstemp()
+            for chunk in resp.app_iter:
+                os.write(fd, chunk)
+            os.close(fd)
+            tar_file = tarfile.open(name)
+            self.assertEqual(tar_file.extractfile('stdout').read(), self._sortednumbers)
+            os.unlink(name)
+            self.assertEqual(prepared, [(['stdin'], ['stdout'], 4096)])
+            self.assertEqual(pool.running, 0)
+            # upload is cut, prepared output and reserved slot are given back
+            req = self.zerovm_object_request()
+            req.body_file = Input(open(tar, 'rb'), length)
+            req.content_length = length
+            req.headers['content-length'] = str(length + 512)
+            resp = self.app.zerovm_query(req)
+            self.assertEqual(resp.status_int, 499)
+            self.assertEqual(len(prepared), 2)
+            self.assertEqual(pool.running, 0)
+            self.assertEqual(pool.queued, 0)
+            # local object opened for the session is closed
+            self.assertEqual(len(disk_files), 2)
+            self.assertTrue(disk_files[-1]._fp is None)
+            self.assertEqual([f for f in os.listdir(device_tmp)
+                              if os.path.isfile(os.path.join(device_tmp, f))], [])
+            # account cannot be admitted yet, session is prepared after the upload
+            orig_reserve = objectquery.AccountPool.reserve
+            objectquery.AccountPool.reserve = lambda pool, queue: False
+            try:
+                req = self.zerovm_object_request()
+                req.body_file = Input(open(tar, 'rb'), length)
+                req.content_length = length
+                resp = self.app.zerovm_query(req)
+                self.assertEqual(resp.status_int, 200)
+                ''.join(resp.app_iter)
+            finally:
+                objectquery.AccountPool.reserve = orig_reserve
+            self.assertEqual(len(prepared), 2)
+            self.assertEqual(pool.running, 0)
+
+    def test_early_preparation_finish(self):
+        copying = Event()
+        copied = []
+        cancelled = []
+
+        def prepare(early, done):
+            copying.send()
+            # copy in a thread cannot be interrupted
+            done.wait()
+            copied.append(early.cancelled)
+
+        class Pool(object):
+
+            def cancel(self):
+                cancelled.append(copied[:])
+
+        done = Event()
+        early = objectquery.EarlyPreparation(Pool(), FakeLogger(), prepare, done)
+        copying.wait()
+        spawn(done.send)
+        early.finish()
+        # session files are removed only after the copy is done
+        self.assertEqual(copied, [True])
+        self.assertEqual(cancelled, [[True]])
+
+    def test_QUERY_threadpool(self):
+        self.setup_zerovm_query()
+        calls = []
+
+        class RecordingPool(object):
+
+            def run_in_thread(self, func, *args, **kwargs):
+                calls.append(func.__name__)
+                return func(*args, **kwargs)
+
+        self.app.zerovm_threads_per_disk = 1
+        self.app.threadpools['sda1'] = RecordingPool()
+        conf = ZvmNode(1, 'sort', parse_location('swift://a/c/exe'))
+        conf.add_new_channel('stdin', ACCESS_READABLE, parse_location('swift://a/c/o'))
+        conf.add_new_channel('stdout', ACCESS_WRITABLE)
+        conf.channels[-1].size_hint = 4096
+        conf = json.dumps(conf, cls=NodeEncoder)
+        members = OrderedDict([('sysmap', StringIO(conf)),
+                               ('boot', StringIO(self._nexescript))])
+        with self.create_tar(members) as tar:
+            length = os.path.getsize(tar)
+            req = self.zerovm_object_request()
+            req.body_file = Input(open(tar, 'rb'), length)
+            req.content_length = length
+            resp = self.app.zerovm_query(req)
+            self.assertEqual(resp.status_int, 200)
+            self.assertEqual(resp.headers['x-nexe-retcode'], '0')
+            body = ''.join(resp.app_iter)
+            self.assertTrue(body)
+        # upload is written, output allocated and response read in the device threadpool
+        self.assertIn('_write_chunk', calls)
+        self.assertIn('fallocate', calls)
+        self.assertIn('read', calls)
+
+    def test_QUERY_stream_output(self):
+        self.setup_zerovm_query()
+        self.app.zerovm_stream_output = True
+        conf = ZvmNode(1, 'sort', parse_location('swift://a/c/exe'))
+        conf.add_new_channel('stdin', ACCESS_READABLE, parse_location('swift://a/c/o'))
+        conf.add_new_channel('stdout', ACCESS_WRITABLE)
+        conf = json.dumps(conf, cls=NodeEncoder)
+        members = OrderedDict([('sysmap', StringIO(conf)),
+                               ('boot', StringIO(self._nexescript))])
+        device_tmp = os.path.join(self.testdir, 'sda1', 'tmp')
+        with self.create_tar(members) as tar:
+            length = os.path.getsize(tar)
+            req = self.zerovm_object_request()
+            req.headers['x-zerovm-stream'] = 'true'
+            req.body_file = Input(open(tar, 'rb'), length)
+            req.content_length = length
+            resp = self.app.zerovm_query(req)
+            self.assertEqual(resp.status_int, 200)
+            self.assertEqual(resp.headers['x-zerovm-stream'], 'true')
+            self.assertEqual(resp.content_length, None)
+            fd, name = mkstemp()
+            for chunk in resp.app_iter:
+                os.write(fd, chunk)
+            os.close(fd)
+            tar_file = tarfile.open(name)
+            members = tar_file.getmembers()
+            # output is sent in one or more members, the report is the last one
+            self.assertEqual(members[-1].name, 'report')
+            self.assertEqual(set(m.name for m in members[:-1]), set(['stdout']))
+            self.assertEqual(''.join(tar_file.extractfile(m).read() for m in members[:-1]),
+                             self._sortednumbers)
+            report = json.loads(tar_file.extractfile(members[-1]).read())
+            self.assertEqual(report['status'], '200 OK')
+            self.assertEqual(report['headers']['x-nexe-retcode'], '0')
+            self.assertEqual(report['headers']['x-nexe-status'], 'ok.')
+            os.unlink(name)
+            self.assertIn('zap_streamed', self.app.logger.get_increments())
+            self.assertEqual([f for f in os.listdir(device_tmp)
+                              if os.path.isfile(os.path.join(device_tmp, f))], [])
+        # only a single immediate response channel is streamed
+        conf = ZvmNode(1, 'sort', parse_location('swift://a/c/exe'))
+        conf.add_new_channel('stdin', ACCESS_READABLE, parse_location('swift://a/c/o'))
+        conf.add_new_channel('stdout', ACCESS_WRITABLE)
+        conf.add_new_channel('stderr', ACCESS_WRITABLE)
+        conf = json.dumps(conf, cls=NodeEncoder)
+        members = OrderedDict([('sysmap', StringIO(conf)),
+                               ('boot', StringIO(self._nexescript))])
+        with self.create_tar(members) as tar:
+            length = os.path.getsize(tar)
+            req = self.zerovm_object_request()
+            req.headers['x-zerovm-stream'] = 'true'
+            req.body_file = Input(open(tar, 'rb'), length)
+            req.content_length = length
+            resp = self.app.zerovm_query(req)
+            self.assertEqual(resp.status_int, 200)
+            self.assertNotIn('x-zerovm-stream', resp.headers)
+            self.assertEqual(resp.headers['x-nexe-retcode'], '0')
+
     def test_QUERY_write_only(self):
         # running the executable creates a new object in-place
         self.setup_zerovm_query()
@@ -1143,7 +1641,7 @@ time.sleep(10)
                         req[i].content_length = length
                     size = int(maxreq_factor * pool_factor * 5)
                     queue = int(maxreq_factor * queue_factor * 5)
-                    self.app.zerovm_threadpools['default'] = (GreenPool(size), queue)
+                    self.app.zerovm_threadpools['default'] = (FairPool(size), queue)
                     spil_over = size + queue
                     for i in r:
                         t[i] = pool.spawn(self.app.zerovm_query, req[i])
@@ -1168,6 +1666,33 @@ time.sleep(10)
                 self.app.parser_config['manifest']['Timeout'] = orig_timeout
                 self.app.zerovm_threadpools = orig_zerovm_threadpools
 
+    def test_QUERY_fair_share_pool(self):
+        self.setup_zerovm_query()
+        nexefile = StringIO('return sleep(.2)')
+        conf = ZvmNode(1, 'sleep', parse_location('swift://a/c/exe'))
+        conf = json.dumps(conf, cls=NodeEncoder)
+        sysmap = StringIO(conf)
+        with self.create_tar({'boot': nexefile, 'sysmap': sysmap}) as tar:
+            length = os.path.getsize(tar)
+            orig_zerovm_threadpools = self.app.zerovm_threadpools
+            try:
+                self.app.zerovm_threadpools = {'default': (FairPool(1), 2)}
+                pool = GreenPool()
+                threads = []
+                for account in ['heavy'] * 6 + ['light']:
+                    req = self.zerovm_free_request()
+                    req.headers['x-account-name'] = account
+                    req.body_file = Input(open(tar, 'rb'), length)
+                    req.content_length = length
+                    threads.append(pool.spawn(self.app.zerovm_query, req))
+                pool.waitall()
+                statuses = [t.wait().status_int for t in threads]
+                # one running and two queued requests of busy account,
+                # light account still gets its share of the queue
+                self.assertEqual(statuses, [200] * 3 + [503] * 3 + [200])
+            finally:
+                self.app.zerovm_threadpools = orig_zerovm_threadpools
+
     def test_QUERY_max_input_size(self):
         self.setup_zerovm_query()
         orig_maxinput = self.app.parser_config['limits']['rbytes']
@@ -1286,6 +1811,87 @@ time.sleep(10)
                 self.assertEqual(resp.headers['x-nexe-validation'], '0')
                 self.assertEqual(resp.headers['x-nexe-system'], 'sysimage-test')
 
+    def test_QUERY_sysimage_boot_cache(self):
+        self.setup_zerovm_query()
+        conf = ZvmNode(1, 'sort', parse_location('file://sysimage1:usr/bin/sort'))
+        conf.add_new_channel('stdin', ACCESS_READABLE, parse_location('swift://a/c/o'))
+        conf.add_new_channel('stdout', ACCESS_WRITABLE)
+        conf = json.dumps(conf, cls=NodeEncoder)
+        orig_sysimages = self.app.parser.sysimage_devices
+        with self.create_tar({'usr/bin/sort': StringIO(self._nexescript)}) as image_tar:
+            try:
+                self.app.parser.sysimage_devices = {'sysimage1': image_tar}
+                for hits in (0, 1):
+                    req = self.zerovm_object_request()
+                    with self.create_tar({'sysmap': StringIO(conf)}) as tar:
+                        length = os.path.getsize(tar)
+                        req.body_file = Input(open(tar, 'rb'), length)
+                        req.content_length = length
+                        resp = self.app.zerovm_query(req)
+                        self.assertEqual(resp.status_int, 200)
+                        fd, name = mkstemp()
+                        for chunk in resp.app_iter:
+                            os.write(fd, chunk)
+                        os.close(fd)
+                        tar_result = tarfile.open(name)
+                        members = tar_result.getmembers()
+                        self.assertEqual(tar_result.getnames()[-1], 'stdout')
+                        self.assertEqual(tar_result.extractfile(members[-1]).read(),
+                                         self._sortednumbers)
+                        # boot files from sysimage devices are trusted
+                        self.assertEqual(resp.headers['x-nexe-validation'], '2')
+                    cache = self.app.boot_caches['sda1']
+                    self.assertEqual(cache.hits, hits)
+                    self.assertEqual(cache.misses, 1)
+                    self.assertEqual(len(cache.entries), 1)
+            finally:
+                self.app.parser.sysimage_devices = orig_sysimages
+
+    def test_QUERY_sysimage_index(self):
+        self.setup_zerovm_query()
+        conf = ZvmNode(1, 'sort', parse_location('file://sysimage1:usr/bin/sort'))
+        conf.add_new_channel('stdin', ACCESS_READABLE, parse_location('swift://a/c/o'))
+        conf.add_new_channel('stdout', ACCESS_WRITABLE)
+        conf = json.dumps(conf, cls=NodeEncoder)
+        orig_sysimages = self.app.parser.sysimage_devices
+        orig_index_dir = self.app.parser.sysimage_index_dir
+        index_dir = mkdtemp()
+        with self.create_tar({'usr/bin/sort': StringIO(self._nexescript)}) as image_tar:
+            try:
+                self.app.zerovm_bootcache_size = 0
+                self.app.parser.sysimage_devices = {'sysimage1': image_tar}
+                self.app.parser.sysimage_index_dir = index_dir
+                index = self.app.parser.get_sysimage_index('sysimage1')
+                self.assertTrue(index.lookup('usr/bin/sort'))
+                self.assertTrue(os.path.exists(os.path.join(index_dir, 'sysimage1.json')))
+                # persisted index is picked up without a tar scan
+                self.app.parser.sysimage_indexes = {}
+                index = self.app.parser.get_sysimage_index('sysimage1')
+                self.assertEqual(index.lookup('usr/bin/sort')[1], len(self._nexescript))
+                self.assertEqual(self.app.parser.get_sysimage_index('sysimage2'), None)
+                req = self.zerovm_object_request()
+                with self.create_tar({'sysmap': StringIO(conf)}) as tar:
+                    length = os.path.getsize(tar)
+                    req.body_file = Input(open(tar, 'rb'), length)
+                    req.content_length = length
+                    resp = self.app.zerovm_query(req)
+                    self.assertEqual(resp.status_int, 200)
+                    fd, name = mkstemp()
+                    for chunk in resp.app_iter:
+                        os.write(fd, chunk)
+                    os.close(fd)
+                    tar_result = tarfile.open(name)
+                    members = tar_result.getmembers()
+                    self.assertEqual(tar_result.getnames()[-1], 'stdout')
+                    self.assertEqual(tar_result.extractfile(members[-1]).read(),
+                                     self._sortednumbers)
+                    self.assertEqual(resp.headers['x-nexe-validation'], '2')
+            finally:
+                self.app.parser.sysimage_devices = orig_sysimages
+                self.app.parser.sysimage_index_dir = orig_index_dir
+                self.app.parser.sysimage_indexes = {}
+                rmtree(index_dir)
+
     def test_QUERY_use_image_file(self):
         self.setup_zerovm_query()
         req = self.zerovm_object_request()
@@ -1394,7 +2000,7 @@ time.sleep(10)
         req = Request.blank('/sda1/p/a/c/exe',
                             environ={'REQUEST_METHOD': 'PUT'},
                             headers={'X-Timestamp': normalize_timestamp(time()),
-                                     'x-zerovm-validate': 'true',
+                                     'x-zerovm-validate': 'sync',
                                      'Content-Type': 'application/octet-stream'})
         req.body = self._nexescript
         resp = req.get_response(self.app)
@@ -1417,16 +2023,18 @@ time.sleep(10)
         self.assertEquals(resp.status_int, 201)
         self.assertNotIn('x-zerovm-valid', resp.headers)
 
+        # overwrite with the same content is found in validation store
         req = Request.blank('/sda1/p/a/c/exe',
                             headers={'x-zerovm-valid': 'true'})
         req.body = self._nexescript
         resp = req.get_response(self.app)
         self.assertEquals(resp.status_int, 200)
-        self.assertNotIn('x-zerovm-valid', resp.headers)
+        self.assertEquals(resp.headers['x-zerovm-valid'], 'true')
 
         req = Request.blank('/sda1/p/a/c/exe',
                             environ={'REQUEST_METHOD': 'PUT'},
                             headers={'X-Timestamp': normalize_timestamp(time()),
+                                     'x-zerovm-validate': 'sync',
                                      'Content-Type': 'application/x-nexe'})
         req.body = self._nexescript
         resp = req.get_response(self.app)
@@ -1445,13 +2053,237 @@ time.sleep(10)
         req = Request.blank('/sda1/p/a/c/exe',
                             environ={'REQUEST_METHOD': 'PUT'},
                             headers={'X-Timestamp': normalize_timestamp(time()),
-                                     'x-zerovm-validate': 'true',
+                                     'x-zerovm-validate': 'sync',
                                      'Content-Type': 'application/octet-stream'})
         req.body = 'INVALID'
         resp = req.get_response(self.app)
         self.assertEquals(resp.status_int, 201)
         self.assertNotIn('x-zerovm-valid', resp.headers)
 
+    def test_QUERY_phase_metrics(self):
+        self.setup_zerovm_query()
+        self.app.session_metrics = SessionMetrics()
+        req = self.zerovm_object_request()
+        conf = ZvmNode(1, 'sort', parse_location('swift://a/c/exe'))
+        conf.add_new_channel('stdin', ACCESS_READABLE, parse_location('swift://a/c/o'))
+        conf.add_new_channel('stdout', ACCESS_WRITABLE)
+        conf = json.dumps(conf, cls=NodeEncoder)
+        with self.create_tar({'boot': StringIO(self._nexescript), 'sysmap': StringIO(conf)}) as tar:
+            length = os.path.getsize(tar)
+            req.body_file = Input(open(tar, 'rb'), length)
+            req.content_length = length
+            resp = self.app.zerovm_query(req)
+            self.assertEqual(resp.status_int, 200)
+            ''.join(resp.app_iter)
+        phases = sorted(phase for phase, pool, account in self.app.session_metrics.histograms)
+        self.assertEqual(phases, sorted(PHASES))
+        req = Request.blank('/zerovm/metrics')
+        resp = req.get_response(self.app)
+        self.assertEqual(resp.status_int, 200)
+        self.assertIn('zerovm_phase_seconds_count{phase="run",pool="default",account="a"} 1', resp.body)
+
+    def test_QUERY_output_space(self):
+        self.setup_zerovm_query()
+        conf = ZvmNode(1, 'sort', parse_location('swift://a/c/exe'))
+        conf.add_new_channel('stdin', ACCESS_READABLE, parse_location('swift://a/c/o'))
+        conf.add_new_channel('stdout', ACCESS_WRITABLE)
+        conf.channels[-1].size_hint = 4096
+        conf = json.dumps(conf, cls=NodeEncoder)
+        with self.create_tar({'boot': StringIO(self._nexescript), 'sysmap': StringIO(conf)}) as tar:
+            length = os.path.getsize(tar)
+            req = self.zerovm_object_request()
+            req.body_file = Input(open(tar, 'rb'), length)
+            req.content_length = length
+            resp = self.app.zerovm_query(req)
+            self.assertEqual(resp.status_int, 200)
+            self.assertEqual(resp.headers['x-nexe-retcode'], '0')
+            # device cannot keep the reserve after output space is reserved
+            self.app.zerovm_tmp_reserve = 1 << 62
+            req = self.zerovm_object_request()
+            req.body_file = Input(open(tar, 'rb'), length)
+            req.content_length = length
+            resp = self.app.zerovm_query(req)
+            self.assertEqual(resp.status_int, 503)
+            self.assertEqual(resp.body, 'Not enough space for session output')
+
+    def test_QUERY_deadline(self):
+        self.setup_zerovm_query()
+        conf = ZvmNode(1, 'sort', parse_location('swift://a/c/exe'))
+        conf.add_new_channel('stdin', ACCESS_READABLE, parse_location('swift://a/c/o'))
+        conf.add_new_channel('stdout', ACCESS_WRITABLE)
+        conf = json.dumps(conf, cls=NodeEncoder)
+        pool = self.app.zerovm_threadpools['default'][0]
+        with self.create_tar({'boot': StringIO(self._nexescript), 'sysmap': StringIO(conf)}) as tar:
+            length = os.path.getsize(tar)
+            req = self.zerovm_object_request()
+            req.body_file = Input(open(tar, 'rb'), length)
+            req.content_length = length
+            req.headers['x-zerovm-deadline'] = str(time() + 60)
+            resp = self.app.zerovm_query(req)
+            self.assertEqual(resp.status_int, 200)
+            self.assertEqual(resp.headers['x-nexe-retcode'], '0')
+            self.assertTrue(pool.run_time > 0)
+            # session is not expected to finish by the deadline
+            pool.run_time = 10.0
+            req = self.zerovm_object_request()
+            req.body_file = Input(open(tar, 'rb'), length)
+            req.content_length = length
+            req.headers['x-zerovm-deadline'] = str(time() + 5)
+            resp = self.app.zerovm_query(req)
+            self.assertEqual(resp.status_int, 503)
+            self.assertEqual(resp.body, 'Deadline cannot be met')
+            self.assertEqual(resp.headers['retry-after'], '1')
+            self.assertEqual(resp.headers['x-zerovm-deadline-rejected'], 'true')
+            self.assertEqual(pool.running, 0)
+            # deadline has passed, retrying will not help
+            req = self.zerovm_object_request()
+            req.body_file = Input(open(tar, 'rb'), length)
+            req.content_length = length
+            req.headers['x-zerovm-deadline'] = str(time() - 1)
+            resp = self.app.zerovm_query(req)
+            self.assertEqual(resp.status_int, 408)
+            self.assertNotIn('retry-after', resp.headers)
+            self.assertEqual(pool.running, 0)
+            req = self.zerovm_object_request()
+            req.body_file = Input(open(tar, 'rb'), length)
+            req.content_length = length
+            req.headers['x-zerovm-deadline'] = 'soon'
+            resp = self.app.zerovm_query(req)
+            self.assertEqual(resp.status_int, 400)
+
+    def test_QUERY_scratch_dir(self):
+        scratch_dir = os.path.join(self.testdir, 'scratch')
+        self.app.zerovm_scratch_dir = scratch_dir
+        self.app.zerovm_scratch_max_size = 100
+        self.setup_zerovm_query()
+        prepared = []
+        orig_prepare = self.app.parser.prepare_zerovm_files
+
+        def prepare_zerovm_files(config, nvram_file, local_object, zerovm_nexe, *args):
+            lpaths = dict((ch['device'], ch['lpath']) for ch in config['channels'])
+            lpaths['boot'] = zerovm_nexe
+            prepared.append((nvram_file, lpaths))
+            return orig_prepare(config, nvram_file, local_object, zerovm_nexe, *args)
+        self.app.parser.prepare_zerovm_files = prepare_zerovm_files
+        conf = ZvmNode(1, 'sort', parse_location('swift://a/c/exe'))
+        conf.add_new_channel('stdin', ACCESS_READABLE)
+        conf.add_new_channel('image', ACCESS_CDR)
+        conf.add_new_channel('input', ACCESS_CDR)
+        conf.add_new_channel('stdout', ACCESS_WRITABLE)
+        conf = json.dumps(conf, cls=NodeEncoder)
+        members = OrderedDict([('sysmap', StringIO(conf)),
+                               ('boot', StringIO(self._nexescript)),
+                               ('stdin', StringIO(self.create_random_numbers(10))),
+                               ('input', StringIO('y' * 10)),
+                               ('image', StringIO('x' * 200))])
+        with self.create_tar(members) as tar:
+            length = os.path.getsize(tar)
+            req = self.zerovm_free_request()
+            req.body_file = Input(open(tar, 'rb'), length)
+            req.content_length = length
+            resp = self.app.zerovm_query(req)
+            self.assertEqual(resp.status_int, 200)
+            self.assertEqual(resp.headers['x-nexe-retcode'], '0')
+        nvram_file, lpaths = prepared[0]
+        scratch_dir = os.path.join(scratch_dir, 'sda1')
+        device_tmp = os.path.join(self.testdir, 'sda1', 'tmp')
+        self.assertEqual(os.path.dirname(nvram_file), scratch_dir)
+        self.assertTrue(lpaths['stdin'].startswith(scratch_dir + '/'))
+        # too big for the scratch dir
+        self.assertTrue(lpaths['image'].startswith(device_tmp + '/'))
+        # executable and writable channel stay on the device whatever their size
+        self.assertTrue(lpaths['boot'].startswith(device_tmp + '/'))
+        self.assertTrue(lpaths['input'].startswith(device_tmp + '/'))
+        # output grows on demand, it is never placed in the scratch dir
+        self.assertEqual(os.path.dirname(lpaths['stdout']), device_tmp)
+        self.assertFalse(os.path.exists(nvram_file))
+        self.assertEqual(os.listdir(scratch_dir), ['zvm-sessions'])
+
+    def test_QUERY_validate_in_background(self):
+        self.setup_zerovm_query()
+        req = Request.blank('/sda1/p/a/c/exe',
+                            environ={'REQUEST_METHOD': 'PUT'},
+                            headers={'X-Timestamp': normalize_timestamp(time()),
+                                     'Content-Type': 'application/x-nexe'})
+        req.body = self._nexescript
+        resp = req.get_response(self.app)
+        self.assertEquals(resp.status_int, 201)
+        self.assertNotIn('x-zerovm-valid', resp.headers)
+        self.assertEquals(len(self.app.validation_jobs), 1)
+        for thrd in list(self.app.validation_jobs):
+            self.assertTrue(thrd.wait())
+        self.assertEquals(len(self.app.validation_jobs), 0)
+        req = Request.blank('/sda1/p/a/c/exe',
+                            headers={'x-zerovm-valid': 'true'})
+        resp = req.get_response(self.app)
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(resp.headers['x-zerovm-valid'], 'true')
+        # queue is full, upload is not validated
+        self.app.zerovm_validation_queue = 0
+        self.app.validation_pool.size = 0
+        req = Request.blank('/sda1/p/a/c/exe2',
+                            environ={'REQUEST_METHOD': 'PUT'},
+                            headers={'X-Timestamp': normalize_timestamp(time()),
+                                     'Content-Type': 'application/x-nexe'})
+        req.body = 'INVALID'
+        resp = req.get_response(self.app)
+        self.assertEquals(resp.status_int, 201)
+        self.assertEquals(len(self.app.validation_jobs), 0)
+
+    def test_QUERY_validation_store(self):
+        self.setup_zerovm_query()
+        req = Request.blank('/sda1/p/a/c/exe',
+                            environ={'REQUEST_METHOD': 'PUT'},
+                            headers={'X-Timestamp': normalize_timestamp(time()),
+                                     'x-zerovm-validate': 'sync',
+                                     'Content-Type': 'application/x-nexe'})
+        req.body = self._nexescript
+        resp = req.get_response(self.app)
+        self.assertEquals(resp.status_int, 201)
+        self.assertEquals(resp.headers['x-zerovm-valid'], 'true')
+        orig_execute = self.app.execute_zerovm
+
+        def execute_zerovm(*args, **kwargs):
+            raise AssertionError('zerovm should not run for validated executable')
+        try:
+            self.app.execute_zerovm = execute_zerovm
+            # the same executable in other container is not validated again
+            req = Request.blank('/sda1/p/a/c2/exe',
+                                environ={'REQUEST_METHOD': 'PUT'},
+                                headers={'X-Timestamp': normalize_timestamp(time()),
+                                         'x-zerovm-validate': 'sync',
+                                         'Content-Type': 'application/x-nexe'})
+            req.body = self._nexescript
+            resp = req.get_response(self.app)
+            self.assertEquals(resp.status_int, 201)
+            self.assertEquals(resp.headers['x-zerovm-valid'], 'true')
+        finally:
+            self.app.execute_zerovm = orig_execute
+        # uploaded executable is looked up in the store and not validated on execution
+        req = self.zerovm_object_request()
+        conf = ZvmNode(1, 'sort', parse_location('swift://a/c/exe'))
+        conf.add_new_channel('stdin', ACCESS_READABLE, parse_location('swift://a/c/o'))
+        conf.add_new_channel('stdout', ACCESS_WRITABLE)
+        conf = json.dumps(conf, cls=NodeEncoder)
+        with self.create_tar({'boot': StringIO(self._nexescript), 'sysmap': StringIO(conf)}) as tar:
+            length = os.path.getsize(tar)
+            req.body_file = Input(open(tar, 'rb'), length)
+            req.content_length = length
+            resp = self.app.zerovm_query(req)
+            self.assertEqual(resp.status_int, 200)
+            self.assertEqual(resp.headers['x-nexe-validation'], '2')
+        # unknown executable is validated in session and added to the store
+        script = 'return pickle.dumps(sorted(id, reverse=True))'
+        req = self.zerovm_object_request()
+        with self.create_tar({'boot': StringIO(script), 'sysmap': StringIO(conf)}) as tar:
+            length = os.path.getsize(tar)
+            req.body_file = Input(open(tar, 'rb'), length)
+            req.content_length = length
+            resp = self.app.zerovm_query(req)
+            self.assertEqual(resp.status_int, 200)
+            self.assertEqual(resp.headers['x-nexe-validation'], '0')
+        self.assertTrue(self.app.validation_store.is_valid(sha256(script).hexdigest()))
+
     def test_QUERY_execute_prevalidated(self):
         self.setup_zerovm_query()
         req = self.zerovm_object_request()
@@ -1551,5 +2383,88 @@ exit(255)
                 self.assertIn('ERROR OBJ.QUERY retcode=Error,  zerovm_stdout=', resp.body)
             os.unlink(zerovm)
 
+
+class FakeMemcache(object):
+
+    def __init__(self):
+        self.store = {}
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def set(self, key, value):
+        self.store[key] = value
+
+
+class TestValidationStore(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+        self.store_dir = os.path.join(self.testdir, 'validated')
+
+    def tearDown(self):
+        rmtree(self.testdir)
+
+    def test_store_dir(self):
+        objectquery.ValidationStore(self.store_dir)
+        self.assertEqual(os.stat(self.store_dir).st_mode & 0777, 0700)
+        os.chmod(self.store_dir, 0777)
+        self.assertRaises(ValueError, objectquery.ValidationStore, self.store_dir)
+
+    def test_memcache(self):
+        key = sha256('nexe').hexdigest()
+        memcache = FakeMemcache()
+        # entries in memcache are not trusted without the secret
+        store = objectquery.ValidationStore(self.store_dir)
+        memcache.set('zvmvalid/%s' % key, 'true')
+        self.assertFalse(store.is_valid(key, memcache))
+        store = objectquery.ValidationStore(self.store_dir, secret='secret')
+        self.assertFalse(store.is_valid(key, memcache))
+        other = objectquery.ValidationStore(os.path.join(self.testdir, 'other'), secret='other')
+        other.set_valid(key, memcache)
+        self.assertFalse(store.is_valid(key, memcache))
+        # entry signed by another server with the same secret
+        other = objectquery.ValidationStore(os.path.join(self.testdir, 'other2'), secret='secret')
+        other.set_valid(key, memcache)
+        self.assertTrue(store.is_valid(key, memcache))
+        self.assertTrue(store.is_valid(key))
+
+
+class TestBootFileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+        self.cache_dir = os.path.join(self.testdir, 'zvm-bootcache')
+
+    def tearDown(self):
+        rmtree(self.testdir)
+
+    def extract(self, name, size):
+        path = os.path.join(self.testdir, name)
+        with open(path, 'wb') as fp:
+            fp.write(name[0] * size)
+        return path
+
+    def test_shared_budget(self):
+        # caches of two workers of the host
+        worker1 = objectquery.BootFileCache(self.cache_dir, 250)
+        worker2 = objectquery.BootFileCache(self.cache_dir, 250)
+        worker1.put(md5('a').hexdigest(), self.extract('a', 100))
+        # file cached by the other worker is a hit
+        dest = os.path.join(self.testdir, 'boot')
+        self.assertTrue(worker2.get(md5('a').hexdigest(), dest))
+        self.assertEqual(open(dest).read(), 'a' * 100)
+        os.unlink(dest)
+        old = time() - 100
+        os.utime(os.path.join(self.cache_dir, md5('a').hexdigest()), (old, old))
+        worker2.put(md5('b').hexdigest(), self.extract('b', 100))
+        worker1.put(md5('c').hexdigest(), self.extract('c', 100))
+        # least recently used file of the host is evicted to keep its budget
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         sorted([md5('b').hexdigest(), md5('c').hexdigest()]))
+        self.assertEqual(worker1.size, 200)
+        self.assertFalse(worker2.get(md5('a').hexdigest(), dest))
+        self.assertEqual(worker2.misses, 1)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -13,7 +13,7 @@ import unittest
 import os
 import cPickle as pickle
 from time import time, sleep
-from swift.common.swob import Request, HTTPNotFound, HTTPUnauthorized
+from swift.common.swob import Request, HTTPNotFound, HTTPUnauthorized, HTTPServiceUnavailable
 from hashlib import md5
 from tempfile import mkstemp, mkdtemp
 from shutil import rmtree
@@ -152,7 +152,8 @@ def setup():
         'content-encoding, x-object-manifest, content-disposition, foo',
             'disable_fallocate': 'true',
             'zerovm_proxy': 'http://127.0.0.1:%d/v1/' % prolis.getsockname()[1],
-            'zerovm_maxoutput': 1024 * 1024 * 10 }
+            'zerovm_maxoutput': 1024 * 1024 * 10,
+            'zerovm_sockets_dir': os.path.join(_testdir, 'zvm-daemons')}
     _test_sockets = \
         (prolis, acc1lis, acc2lis, con1lis, con2lis, obj1lis, obj2lis)
     pickle.dump(ring.RingData([[0, 1, 0, 1], [1, 0, 1, 0]],
@@ -557,6 +558,65 @@ class TestProxyQuery(unittest.TestCase):
                                                'o2': self.get_sorted_numbers()
                                            })
 
+    def test_QUERY_deadline(self):
+        self.setup_QUERY()
+        conf = [
+            {
+                'name': 'sort',
+                'exec': {'path': 'swift://a/c/exe'},
+                'file_list': [
+                    {'device': 'stdin', 'path': 'swift://a/c/o'},
+                    {'device': 'stdout'}
+                ]
+            }
+        ]
+        conf = json.dumps(conf)
+        prosrv = _test_servers[0]
+        pools = [srv.zerovm_threadpools['default'][0] for srv in _test_servers[5:]]
+        run_times = [pool.run_time for pool in pools]
+        try:
+            # rejected by the object server, not retried on other nodes
+            for pool in pools:
+                pool.run_time = 10.0
+            req = self.zerovm_request()
+            req.body = conf
+            req.headers['x-zerovm-deadline'] = str(time() + 5)
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 503)
+            self.assertEqual(res.body, 'Deadline cannot be met')
+            self.assertEqual(res.headers['retry-after'], '1')
+            req = self.zerovm_request()
+            req.body = conf
+            req.headers['x-zerovm-deadline'] = str(time() - 1)
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 408)
+            self.assertNotIn('retry-after', res.headers)
+        finally:
+            for pool, run_time in zip(pools, run_times):
+                pool.run_time = run_time
+        # node that is just busy is skipped, the session runs on the next one
+        busy = []
+        orig_queries = [srv.zerovm_query for srv in _test_servers[5:]]
+
+        def zerovm_query(orig_query):
+            def query(req):
+                if not busy:
+                    busy.append(req.path_info)
+                    return HTTPServiceUnavailable(request=req, headers={'Retry-After': '10'})
+                return orig_query(req)
+            return query
+        try:
+            for srv, orig_query in zip(_test_servers[5:], orig_queries):
+                srv.zerovm_query = zerovm_query(orig_query)
+            req = self.zerovm_request()
+            req.body = conf
+            res = req.get_response(prosrv)
+            self.executed_successfully(res)
+            self.assertEqual(len(busy), 1)
+        finally:
+            for srv, orig_query in zip(_test_servers[5:], orig_queries):
+                srv.zerovm_query = orig_query
+
     def test_QUERY_sort_store_stdout_stderr(self):
         self.setup_QUERY()
         conf = [
@@ -625,6 +685,45 @@ class TestProxyQuery(unittest.TestCase):
         self.assertEqual(res.body, self.get_sorted_numbers())
         self.check_container_integrity(prosrv, '/v1/a/c', {})
 
+    def test_QUERY_stream_stdout(self):
+        self.setup_QUERY()
+        conf = [
+            {
+                'name': 'sort',
+                'exec': {'path': 'swift://a/c/exe'},
+                'file_list': [
+                    {'device': 'stdin', 'path': 'swift://a/c/o'},
+                    {'device': 'stdout'}
+                ]
+            }
+        ]
+        conf = json.dumps(conf)
+        prosrv = _test_servers[0]
+        for objsrv in _test_servers[5:]:
+            objsrv.zerovm_stream_output = True
+        try:
+            req = self.zerovm_request()
+            req.headers['x-zerovm-stream'] = 'true'
+            req.body = conf
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 200)
+            self.assertEqual(res.headers['x-zerovm-stream'], 'true')
+            self.assertEqual(res.content_type, 'application/x-tar')
+            tar = tarfile.open(fileobj=StringIO(res.body))
+            members = tar.getmembers()
+            self.assertEqual(members[-1].name, 'sort/report')
+            self.assertEqual(''.join(tar.extractfile(member).read() for member in members[:-1]),
+                             self.get_sorted_numbers())
+            self.assertEqual(set(member.name for member in members[:-1]), set(['sort/stdout']))
+            report = json.loads(tar.extractfile(members[-1]).read())
+            self.assertEqual(report['status'], '200 OK')
+            self.assertEqual(report['headers']['x-nexe-retcode'], '0')
+            self.assertEqual(report['headers']['x-nexe-status'], 'ok.')
+        finally:
+            for objsrv in _test_servers[5:]:
+                objsrv.zerovm_stream_output = False
+        self.check_container_integrity(prosrv, '/v1/a/c', {})
+
     def test_QUERY_store_meta(self):
         self.setup_QUERY()
         prolis = _test_sockets[0]
@@ -1948,3 +2047,61 @@ return open(mnfst.nvram['path']).read()
         #     self.assertEqual(node.replicate, 1)
         #     self.assertEqual(node.replicas, [])
         #print json.dumps(controller.nodes, sort_keys=True, indent=2, cls=proxyquery.NodeEncoder)
+
+
+class FakeServerResponse(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.reads = []
+
+    def read(self, amt):
+        self.reads.append(amt)
+        data, self.data = self.data[:amt], self.data[amt:]
+        return data
+
+
+class TestStreamedBody(unittest.TestCase):
+
+    def object_stream(self, members):
+        return ''.join(proxyquery._tar_member(name, data) for name, data in members)
+
+    def test_member_iter(self):
+        data = self.object_stream([('stdout', 'a' * 700), ('report', '{}')])
+        server_response = FakeServerResponse(data)
+        self.assertEqual(''.join(proxyquery._member_iter(server_response, 65536)), data)
+        # members are read with their exact size, never waiting for more data
+        self.assertEqual(server_response.reads, [512, 1024, 512, 512, 512])
+
+    def test_report(self):
+        report = json.dumps({'status': '200 OK', 'headers': {'x-nexe-retcode': '1'}})
+        data = self.object_stream([('stdout', 'abc'), ('stdout', 'def'), ('report', report)])
+        untar_stream = proxyquery.UntarStream(iter([data]))
+        reports = []
+        body = proxyquery.StreamedBody(untar_stream, proxyquery._next_tarinfo(untar_stream),
+                                       'node/', reports.append)
+        tar = tarfile.open(fileobj=StringIO(''.join(body)))
+        self.assertEqual([member.name for member in tar.getmembers()],
+                         ['node/stdout', 'node/stdout', 'node/report'])
+        self.assertEqual(json.loads(tar.extractfile('node/report').read())['headers']['x-nexe-retcode'], '1')
+        self.assertEqual(reports, [report])
+        body.close()
+        self.assertEqual(reports, [report])
+
+    def test_client_disconnect(self):
+        data = self.object_stream([('stdout', 'abc'), ('stdout', 'def')])
+        untar_stream = proxyquery.UntarStream(iter([data]))
+        reports = []
+        accounted = []
+        final_body = proxyquery.FinalBody(iter(()))
+        final_body.append(proxyquery.StreamedBody(untar_stream, proxyquery._next_tarinfo(untar_stream),
+                                                  'node/', reports.append))
+        final_body.callbacks.append(lambda: accounted.append(True))
+        body_iter = iter(final_body)
+        next(body_iter)
+        # client is gone before the report arrived, the session is still accounted
+        body_iter.close()
+        self.assertEqual(reports, [None])
+        self.assertEqual(accounted, [True])
+        final_body.close()
+        self.assertEqual(accounted, [True])
@@ -0,0 +1,343 @@
+import os
+import shutil
+import subprocess
+import time
+import unittest
+from tempfile import mkdtemp
+
+from eventlet import sleep, spawn
+
+from zerocloud.scheduler import FairPool, HostSlots, MemoryBudget, AccountPool, AdaptiveLimit
+
+
+class FakeStatsdLogger(object):
+
+    def __init__(self):
+        self.gauges = []
+
+    def gauge(self, name, value):
+        self.gauges.append((name, value))
+
+    def timing(self, name, value):
+        pass
+
+    def timing_since(self, name, start):
+        pass
+
+
+class TestHostSlots(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+        self.path = os.path.join(self.testdir, 'slots', 'default')
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_shared_slots(self):
+        # each instance has its own lock files open, like a separate worker
+        worker1 = HostSlots(self.path, 2)
+        worker2 = HostSlots(self.path, 2)
+        self.assertEqual(worker1.acquire(), 0)
+        self.assertEqual(worker2.acquire(), 1)
+        self.assertEqual(worker1.acquire(), None)
+        self.assertEqual(worker2.acquire(), None)
+        self.assertEqual(worker1.used(), 2)
+        self.assertEqual(worker2.used(), 2)
+        worker1.release(0)
+        self.assertEqual(worker2.used(), 1)
+        self.assertEqual(worker2.acquire(), 0)
+        self.assertEqual(worker1.acquire(), None)
+
+    def test_closed_worker(self):
+        worker1 = HostSlots(self.path, 1)
+        worker2 = HostSlots(self.path, 1)
+        self.assertEqual(worker1.acquire(), 0)
+        self.assertEqual(worker2.acquire(), None)
+        # exit of a worker releases its locks
+        for fd in worker1.fds.values():
+            os.close(fd)
+        self.assertEqual(worker2.acquire(), 0)
+
+    def test_not_inherited(self):
+        worker1 = HostSlots(self.path, 1)
+        worker2 = HostSlots(self.path, 1)
+        self.assertEqual(worker1.acquire(), 0)
+        # child process spawned by the worker outlives it
+        child = subprocess.Popen(['sleep', '10'], close_fds=False)
+        try:
+            for fd in worker1.fds.values():
+                os.close(fd)
+            self.assertEqual(worker2.used(), 0)
+            self.assertEqual(worker2.acquire(), 0)
+        finally:
+            child.kill()
+            child.wait()
+
+
+class TestFairPoolHostSlots(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+        self.path = os.path.join(self.testdir, 'default')
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def make_pool(self, size, queue):
+        return FairPool(size, host_slots=HostSlots(self.path, size),
+                        host_queue=HostSlots(self.path + '.queue', queue),
+                        poll_interval=0.01)
+
+    def test_host_limit(self):
+        pool1 = self.make_pool(1, 1)
+        pool2 = self.make_pool(1, 1)
+        done = []
+
+        def job(name, seconds):
+            sleep(seconds)
+            done.append(name)
+
+        thrd1 = pool1.spawn('a', job, 'first', 0.1)
+        self.assertEqual(pool2.free(), 0)
+        self.assertTrue(pool2.can_admit('a', 1))
+        waiter = spawn(pool2.spawn, 'a', job, 'second', 0)
+        sleep(0.02)
+        # the job waits in the host queue for the slot of the other worker
+        self.assertEqual(pool2.queued, 1)
+        self.assertEqual(pool1.host_waiting(), 1)
+        self.assertFalse(pool1.can_admit('b', 1))
+        thrd1.wait()
+        waiter.wait().wait()
+        self.assertEqual(done, ['first', 'second'])
+        self.assertEqual(pool1.free(), 1)
+        self.assertEqual(pool2.free(), 1)
+        self.assertEqual(pool2.host_waiting(), 0)
+        self.assertEqual(pool2.poller, None)
+
+    def test_cancel(self):
+        pool1 = self.make_pool(1, 1)
+        pool2 = self.make_pool(1, 1)
+        self.assertEqual(pool1.reserve('a'), None)
+        entry = pool2.reserve('a')
+        self.assertNotEqual(entry, None)
+        self.assertEqual(pool1.host_waiting(), 1)
+        pool2.cancel('a', entry)
+        self.assertEqual(pool1.host_waiting(), 0)
+        pool1.cancel('a')
+        self.assertEqual(pool2.free(), 1)
+
+
+class TestFairPoolMemory(unittest.TestCase):
+
+    def test_budget(self):
+        memory = MemoryBudget(4)
+        pool = FairPool(10, memory=memory)
+        cluster = FairPool(10, memory=memory)
+        done = []
+
+        def job(name, seconds):
+            sleep(seconds)
+            done.append(name)
+
+        thrd1 = AccountPool(pool, 'a', 3).spawn(job, 'a', 0.05)
+        self.assertEqual(memory.used, 3)
+        self.assertFalse(pool.can_admit('b', 0, 2))
+        self.assertTrue(pool.can_admit('b', 0, 1))
+        # the large job waits at the head of the queue, the small one behind it
+        large = spawn(AccountPool(cluster, 'b', 2).spawn, job, 'b', 0)
+        sleep(0)
+        small = spawn(AccountPool(cluster, 'c', 1).spawn, job, 'c', 0)
+        sleep(0)
+        self.assertEqual(cluster.queued, 2)
+        thrd1.wait()
+        large.wait().wait()
+        small.wait().wait()
+        self.assertEqual(done[0], 'a')
+        self.assertEqual(sorted(done), ['a', 'b', 'c'])
+        self.assertEqual(memory.used, 0)
+        self.assertEqual(cluster.running, 0)
+
+    def test_larger_than_budget(self):
+        memory = MemoryBudget(4)
+        pool = FairPool(10, memory=memory)
+        self.assertEqual(pool.reserve('a', 8), None)
+        entry = pool.reserve('a', 1)
+        self.assertNotEqual(entry, None)
+        pool.cancel('a', None, 8)
+        self.assertTrue(entry[0].ready())
+        self.assertEqual(memory.used, 1)
+        pool.cancel('a', entry, 1)
+        self.assertEqual(memory.used, 0)
+
+
+class TestHostMemoryBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+        self.path = os.path.join(self.testdir, 'slots', 'memory')
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_shared(self):
+        memory = MemoryBudget(4, path=self.path, unit=1)
+        ready_r, ready_w = os.pipe()
+        done_r, done_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # other worker of the host runs a job of 3 units
+            try:
+                worker = MemoryBudget(4, path=self.path, unit=1)
+                worker.take(3)
+                os.write(ready_w, 'x')
+                os.read(done_r, 1)
+            finally:
+                os._exit(0)
+        try:
+            os.read(ready_r, 1)
+            self.assertFalse(memory.take(2))
+            self.assertTrue(memory.fits(1))
+            self.assertTrue(memory.take(1))
+            self.assertEqual(memory.used, 1)
+            # a job larger than the budget waits for the whole host
+            memory.release(1)
+            self.assertFalse(memory.take(8))
+        finally:
+            os.write(done_w, 'x')
+            os.waitpid(pid, 0)
+        # locks of the exited worker are released
+        self.assertTrue(memory.take(8))
+        self.assertEqual(len(memory.held), 4)
+        memory.release(8)
+        self.assertEqual(memory.held, set())
+
+    def test_pool_polls(self):
+        memory = MemoryBudget(2, path=self.path, unit=1)
+        other = MemoryBudget(2, path=self.path, unit=1)
+        pool = FairPool(10, memory=memory, poll_interval=0.01)
+        done = []
+        # memory taken by another process, simulated with a child
+        ready_r, ready_w = os.pipe()
+        done_r, done_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                other.take(2)
+                os.write(ready_w, 'x')
+                os.read(done_r, 1)
+            finally:
+                os._exit(0)
+        os.read(ready_r, 1)
+        thrd = spawn(AccountPool(pool, 'a', 1).spawn, done.append, 'a')
+        sleep(0.05)
+        self.assertEqual(pool.queued, 1)
+        os.write(done_w, 'x')
+        os.waitpid(pid, 0)
+        thrd.wait().wait()
+        self.assertEqual(done, ['a'])
+        self.assertEqual(memory.used, 0)
+
+
+class TestAdaptiveLimit(unittest.TestCase):
+
+    def make_pool(self, size, load=0.0):
+        limit = AdaptiveLimit(2, 8, interval=0)
+        limit.get_load = lambda: load
+        return FairPool(size, limit=limit)
+
+    def test_clamp(self):
+        self.assertEqual(self.make_pool(20).size, 8)
+        self.assertEqual(self.make_pool(1).size, 2)
+
+    def test_increase(self):
+        pool = self.make_pool(4)
+        pool.running = 4
+        self.assertEqual(pool.limit.update(pool, 1.0), 4)
+        pool.queued = 1
+        self.assertEqual(pool.limit.update(pool, 1.0), 5)
+        pool.size = 8
+        pool.running = 8
+        self.assertEqual(pool.limit.update(pool, 1.0), 8)
+
+    def test_decrease(self):
+        pool = self.make_pool(8)
+        pool.queued = 1
+        pool.running = 8
+        for _ in range(50):
+            pool.limit.update(pool, 1.0)
+        # run time grows while the host gets busier
+        sizes = [pool.limit.update(pool, 3.0) for _ in range(10)]
+        self.assertEqual(sizes[0], 8)
+        self.assertEqual(sizes[-1], 6)
+        pool = self.make_pool(8, load=2.0)
+        self.assertEqual(pool.limit.update(pool, 1.0), 6)
+        pool.size = 2
+        self.assertEqual(pool.limit.update(pool, 1.0), 2)
+
+    def test_mixed_run_times(self):
+        pool = self.make_pool(4)
+        pool.queued = 1
+        pool.running = 4
+        # short and long jobs do not make each other look slow
+        for i in range(200):
+            size = pool.limit.update(pool, 20.0 if i % 10 == 0 else 0.05)
+            self.assertTrue(size >= 4)
+            pool.size = pool.running = size
+        self.assertEqual(pool.size, 8)
+        # all of them slow down
+        for i in range(10):
+            size = pool.limit.update(pool, 60.0 if i % 10 == 0 else 0.15)
+        self.assertEqual(size, 6)
+
+    def test_run(self):
+        pool = self.make_pool(4, load=2.0)
+        pool.logger = FakeStatsdLogger()
+        pool.spawn('a', sleep, 0).wait()
+        self.assertEqual(pool.size, 3)
+        self.assertEqual(pool.free(), 3)
+        self.assertEqual(pool.logger.gauges, [('zap_pool_queue_depth.default', 0),
+                                              ('zap_pool_limit.default', 3)])
+
+
+class TestFairPoolDeadline(unittest.TestCase):
+
+    def test_edf(self):
+        pool = FairPool(1)
+        started = []
+
+        def job(name):
+            started.append(name)
+
+        self.assertEqual(pool.reserve('a'), None)
+        batch = AccountPool(pool, 'a')
+        interactive = AccountPool(pool, 'a', deadline=time.time() + 10)
+        urgent = AccountPool(pool, 'a', deadline=time.time() + 5)
+        waiters = [spawn(batch.spawn, job, 'batch'), spawn(interactive.spawn, job, 'interactive'),
+                   spawn(urgent.spawn, job, 'urgent')]
+        sleep(0)
+        self.assertEqual(pool.queued, 3)
+        pool.cancel('a')
+        for waiter in waiters:
+            waiter.wait().wait()
+        self.assertEqual(started, ['urgent', 'interactive', 'batch'])
+
+    def test_estimate(self):
+        pool = FairPool(2)
+        pool.run_time = 1.0
+        self.assertEqual(pool.estimate(), 0)
+        pool.reserve('a')
+        pool.reserve('b')
+        self.assertEqual(pool.estimate(), 1.0)
+        pool.reserve('a')
+        pool.reserve('b', deadline=time.time() + 100)
+        pool.reserve('c')
+        # jobs without deadline are dispatched after it
+        self.assertEqual(pool.estimate(time.time() + 200), 1.0)
+        self.assertEqual(pool.estimate(), 2.0)
+        account_pool = AccountPool(pool, 'd', deadline=time.time() + 1.5)
+        self.assertEqual(account_pool.estimate(), 2.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
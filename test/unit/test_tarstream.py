@@ -0,0 +1,216 @@
+from StringIO import StringIO
+from hashlib import md5
+import os
+import random
+import tarfile
+import unittest
+
+from zerocloud import tarstream
+from zerocloud.tarstream import TarStream, TarInfo, Path, REGTYPE, DIRTYPE, \
+    BLOCKSIZE, NUL, UntarStream, ExtractedFile
+
+
+class TestTarStream(unittest.TestCase):
+
+    def setUp(self):
+        self.orig_time = tarstream.time.time
+        tarstream.time.time = lambda: 1380000000.5
+        TarStream.header_templates.clear()
+
+    def tearDown(self):
+        tarstream.time.time = self.orig_time
+
+    def _reference_header(self, ftype, name, size):
+        tarinfo = TarInfo()
+        tarinfo.tarfile = None
+        tarinfo.type = ftype
+        tarinfo.name = name
+        tarinfo.size = size
+        tarinfo.mtime = tarstream.time.time()
+        return tarinfo.tobuf(tarstream.DEFAULT_FORMAT, tarstream.ENCODING, None)
+
+    def test_serve_chunk(self):
+        random.seed(0)
+        for chunk_size in (7, 512, 1000, 65536):
+            stream = TarStream(chunk_size=chunk_size)
+            expected = ''
+            result = []
+            for size in (0, 1, 511, 512, 513, chunk_size, chunk_size * 3 + 1, 100000):
+                buf = ''.join(chr(random.randrange(256)) for _ in range(size))
+                expected += buf
+                result.extend(stream.serve_chunk(buf))
+                self.assertEqual(''.join(result) + stream.data, expected)
+            for chunk in result:
+                self.assertTrue(isinstance(chunk, str))
+                self.assertEqual(len(chunk), chunk_size)
+            tail = stream.data
+            self.assertEqual(stream.flush(), tail)
+            self.assertEqual(stream.data, '')
+
+    def test_create_tarinfo(self):
+        for name in ('stdout', 'sysmap', 'x' * 100, 'y' * 150):
+            for size in (0, 1, 511, 12345678, 8 ** 11 + 5):
+                for ftype in (REGTYPE, DIRTYPE):
+                    # second run uses cached template
+                    for _junk in range(2):
+                        self.assertEqual(TarStream().create_tarinfo(ftype=ftype, name=name, size=size),
+                                         self._reference_header(ftype, name, size))
+        # long names (including 'x' * 100 + '/' directory) are not cached
+        self.assertEqual(len(TarStream.header_templates), 5)
+
+    def test_header_templates_lru(self):
+        orig_max = TarStream.max_header_templates
+        TarStream.max_header_templates = 2
+        try:
+            stream = TarStream()
+            for name in ('stdout', 'stderr', 'stdout', 'sysmap'):
+                self.assertEqual(stream.create_tarinfo(ftype=REGTYPE, name=name, size=1),
+                                 self._reference_header(REGTYPE, name, 1))
+            # recently used template is kept, the oldest one is evicted
+            self.assertEqual([key[1] for key in TarStream.header_templates], ['stdout', 'sysmap'])
+        finally:
+            TarStream.max_header_templates = orig_max
+
+    def test_stream(self):
+        files = [('sysmap', '{"name": "sort"}'),
+                 ('stdout', 'a' * 100000),
+                 ('empty', ''),
+                 ('stderr', 'b' * 513)]
+        path_list = [Path(REGTYPE, name, len(data), [data]) for name, data in files]
+        stream = TarStream(path_list=path_list, chunk_size=4096)
+        result = ''.join(stream)
+        self.assertEqual(len(result) % BLOCKSIZE, 0)
+        self.assertEqual(len(result), stream.get_total_stream_length())
+        tar = tarfile.open(fileobj=StringIO(result))
+        for name, data in files:
+            self.assertEqual(tar.extractfile(name).read(), data)
+
+
+class TestUntarStream(unittest.TestCase):
+
+    def _create_tar(self, files):
+        stream = StringIO()
+        tar = tarfile.open(fileobj=stream, mode='w', format=tarfile.GNU_FORMAT)
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, StringIO(data))
+        tar.close()
+        return stream.getvalue()
+
+    def _extract(self, tar_iter, read_size=None):
+        untar_stream = UntarStream(tar_iter)
+        result = []
+        for data in untar_stream.tar_iter:
+            untar_stream.update_buffer(data)
+            info = untar_stream.get_next_tarinfo()
+            while info:
+                untar_stream.to_write = info.size
+                untar_stream.offset_data = info.offset_data
+                if read_size:
+                    extracted = ExtractedFile(untar_stream)
+                    reader = iter(lambda: extracted.read(read_size), '')
+                else:
+                    reader = untar_stream.untar_file_iter()
+                size = 0
+                checksum = md5()
+                for body in reader:
+                    size += len(body)
+                    checksum.update(body)
+                result.append((info.name, size, checksum.hexdigest()))
+                info = untar_stream.get_next_tarinfo()
+        return result
+
+    def test_unaligned_chunks(self):
+        files = [('sysmap', 'a' * 511),
+                 ('stdin', 'b' * 20000),
+                 ('empty', ''),
+                 ('image', 'c' * 20000),
+                 ('stdout', 'd' * 513)]
+        expected = [(name, len(data), md5(data).hexdigest()) for name, data in files]
+        tar = self._create_tar(files)
+        for chunk_size in (1, 511, 700, 4096, 65536):
+            chunks = [tar[i:i + chunk_size] for i in range(0, len(tar), chunk_size)]
+            for read_size in (None, 1, 100, 4096, 100000):
+                self.assertEqual(self._extract(iter(chunks), read_size), expected)
+
+    def test_large_stream(self):
+        # set ZEROCLOUD_TAR_TEST_MB to check multi-GB streams
+        size = int(os.environ.get('ZEROCLOUD_TAR_TEST_MB', 16)) * 1048576
+        chunk = ''.join(chr(i % 251) for i in range(65536))
+        count = size / len(chunk)
+        expected = md5()
+        for _junk in xrange(count):
+            expected.update(chunk)
+        for read_size in (None, 65536):
+            path_list = [Path(REGTYPE, 'stdout', size, (chunk for _junk in xrange(count)))]
+            self.assertEqual(self._extract(TarStream(path_list=path_list), read_size),
+                             [('stdout', size, expected.hexdigest())])
+
+    def test_no_copies(self):
+        data = [chr(i) * 4096 for i in range(8)]
+        header = TarStream().create_tarinfo(ftype=REGTYPE, name='stdout', size=4096 * 8)
+        # member data arrives in its own chunks, reads return them as they are
+        untar_stream = UntarStream(iter([header] + data + [NUL * BLOCKSIZE * 2]))
+        untar_stream.update_buffer(next(untar_stream.tar_iter))
+        info = untar_stream.get_next_tarinfo()
+        untar_stream.to_write = info.size
+        untar_stream.offset_data = info.offset_data
+        extracted = ExtractedFile(untar_stream)
+        for chunk in data:
+            self.assertTrue(extracted.read(4096) is chunk)
+        self.assertEqual(extracted.read(4096), '')
+        # data sharing a chunk with the header is kept as a buffer of it until read
+        stream = header + ''.join(data) + NUL * BLOCKSIZE * 2
+        untar_stream = UntarStream(iter([stream]))
+        untar_stream.update_buffer(next(untar_stream.tar_iter))
+        info = untar_stream.get_next_tarinfo()
+        untar_stream.to_write = info.size
+        untar_stream.offset_data = info.offset_data
+        extracted = ExtractedFile(untar_stream)
+        self.assertEqual(extracted.read(100), data[0][:100])
+        self.assertEqual(len(extracted.chunks), 1)
+        self.assertTrue(isinstance(extracted.chunks[0], memoryview))
+        self.assertEqual(extracted.read(), ''.join(data)[100:])
+
+    def test_untar_file_iter_no_copies(self):
+        copied = []
+
+        class Chunk(str):
+            # counts bytes copied by concatenating or slicing received chunks
+            def __add__(self, other):
+                copied.append(len(self) + len(other))
+                return Chunk(str.__add__(self, other))
+
+            def __getslice__(self, start, stop):
+                result = str.__getslice__(self, start, stop)
+                copied.append(len(result))
+                return result
+
+        data = ''.join(chr(i % 251) for i in range(65536))
+        tar = self._create_tar([('stdin', data * 64), ('stdout', 'a' * 700)])
+        # chunks are not aligned to member boundaries
+        chunks = [Chunk(tar[i:i + 65536 + 100]) for i in range(0, len(tar), 65536 + 100)]
+        untar_stream = UntarStream(iter(chunks))
+        received = []
+        for chunk in untar_stream.tar_iter:
+            untar_stream.update_buffer(chunk)
+            info = untar_stream.get_next_tarinfo()
+            while info:
+                untar_stream.to_write = info.size
+                untar_stream.offset_data = info.offset_data
+                views = list(untar_stream.untar_file_iter())
+                # whole chunks are passed as they are, parts of them as memoryviews
+                for view in views:
+                    self.assertTrue(isinstance(view, memoryview) or any(view is chunk for chunk in chunks))
+                received.append((info.name, ''.join(view.tobytes() if isinstance(view, memoryview) else view
+                                                    for view in views)))
+                info = untar_stream.get_next_tarinfo()
+        self.assertEqual(received, [('stdin', data * 64), ('stdout', 'a' * 700)])
+        # only header blocks are copied out of the received chunks
+        self.assertTrue(copied)
+        self.assertEqual([size for size in copied if size > BLOCKSIZE], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
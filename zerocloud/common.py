@@ -1,4 +1,8 @@
 from copy import deepcopy
+import ctypes
+import ctypes.util
+import errno
+import os
 import re
 from hashlib import md5
 from swift.common.constraints import MAX_META_NAME_LENGTH, MAX_META_VALUE_LENGTH, \
@@ -33,6 +37,8 @@ TAR_MIMES = ['application/x-tar', 'application/x-gtar', 'application/x-ustar']
 CLUSTER_CONFIG_FILENAME = 'boot/cluster.map'
 NODE_CONFIG_FILENAME = 'boot/system.map'
 STREAM_CACHE_SIZE = 128 * 1024
+# last member of a streamed session response, holds status and x-nexe headers
+STREAM_REPORT = 'report'
 
 DEFAULT_EXE_SYSTEM_MAP = r'''
     [{
@@ -280,13 +286,14 @@ def is_cache_path(location):
 
 
 class ZvmNode(object):
-    def __init__(self, id=None, name=None, exe=None, args=None, env=None, replicate=1):
+    def __init__(self, id=None, name=None, exe=None, args=None, env=None, replicate=1, memory=None):
         self.id = id
         self.name = name
         self.exe = exe
         self.args = args
         self.env = env
         self.replicate = replicate
+        self.memory = memory
         self.channels = []
         self.connect = []
         self.bind = []
@@ -374,7 +381,7 @@ class ZvmNode(object):
 class ZvmChannel(object):
     def __init__(self, device, access, path=None,
                  content_type=None, meta_data=None,
-                 mode=None, removable='no', mountpoint='/'):
+                 mode=None, removable='no', mountpoint='/', size_hint=None):
         self.device = device
         self.access = access
         self.path = path
@@ -383,6 +390,8 @@ class ZvmChannel(object):
         self.mode = mode
         self.removable = removable
         self.mountpoint = mountpoint
+        # expected size of data written to the channel, disk space for it is reserved upfront
+        self.size_hint = size_hint
 
 
 class NodeEncoder(json.JSONEncoder):
@@ -395,3 +404,65 @@ class NodeEncoder(json.JSONEncoder):
         if isinstance(o, ObjPath):
             return o.url
         return json.JSONEncoder.default(self, o)
+
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _sendfile = getattr(_libc, 'sendfile64', None) or _libc.sendfile
+    _sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                          ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    _sendfile.restype = ctypes.c_ssize_t
+except (OSError, AttributeError):
+    _sendfile = None
+
+
+try:
+    _fallocate = getattr(_libc, 'fallocate64', None) or _libc.fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    _fallocate.restype = ctypes.c_int
+except (NameError, AttributeError):
+    _fallocate = None
+
+FALLOC_FL_COLLAPSE_RANGE = 0x08
+
+
+def has_sendfile():
+    return _sendfile is not None
+
+
+def sendfile(out_fd, in_fd, offset, count):
+    """
+    Copies data from one file descriptor to another inside the kernel
+
+    :param out_fd: destination descriptor, usually a socket
+    :param in_fd: source file descriptor
+    :param offset: offset in the source file to start from
+    :param count: maximum number of bytes to copy
+    :returns number of bytes actually copied
+    :raises OSError on failure, errno.EAGAIN if non-blocking out_fd is full
+    """
+    off = ctypes.c_int64(offset)
+    sent = _sendfile(out_fd, in_fd, ctypes.byref(off), count)
+    if sent < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return sent
+
+
+def collapse_range(fd, offset, length):
+    """
+    Removes a range of the file, data after it is moved without copying
+
+    Supported only by some filesystems (ext4, xfs), offset and length
+    must be multiples of the filesystem block size.
+
+    :param fd: file descriptor
+    :param offset: start of the range
+    :param length: length of the range
+    :raises OSError on failure, errno.EOPNOTSUPP or errno.EINVAL if range cannot be collapsed
+    """
+    if not _fallocate:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    if _fallocate(fd, FALLOC_FL_COLLAPSE_RANGE, offset, length) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
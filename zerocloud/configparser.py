@@ -1,9 +1,14 @@
+import os
 import re
+import tarfile
 import traceback
+from collections import OrderedDict
 from swift import gettext_ as _
+from swift.common.utils import mkdirs
 from zerocloud.common import SwiftPath, ZvmNode, ZvmChannel, is_zvm_path, \
     ACCESS_READABLE, ACCESS_CDR, ACCESS_WRITABLE, parse_location, ACCESS_RANDOM, \
     has_control_chars, DEVICE_MAP, is_swift_path, ACCESS_NETWORK
+from zerocloud.tarstream import TarIndex
 
 CHANNEL_TYPE_MAP = {
     'stdin': 0,
@@ -36,7 +41,8 @@ class ClusterConfigParsingError(Exception):
 class ClusterConfigParser(object):
     def __init__(self, sysimage_devices, default_content_type,
                  parser_config,
-                 list_account_callback, list_container_callback):
+                 list_account_callback, list_container_callback,
+                 sysimage_index_dir=None, manifest_template_cache_size=1024):
         """
         Create a new parser instance
 
@@ -49,8 +55,14 @@ class ClusterConfigParser(object):
         :param list_container_callback: callback function that can be called with
                 (account_name, container_name, mask) to get a list of object names in container
                 that match the mask regex
+        :param sysimage_index_dir: directory to persist member indexes of system image devices,
+                indexes are kept only in memory if not set
+        :param manifest_template_cache_size: number of compiled manifest templates kept,
+                least recently used ones are evicted, 0 disables the cache
         """
         self.sysimage_devices = sysimage_devices
+        self.sysimage_index_dir = sysimage_index_dir
+        self.sysimage_indexes = {}
         self.list_account = list_account_callback
         self.list_container = list_container_callback
         self.nodes = {}
@@ -59,6 +71,9 @@ class ClusterConfigParser(object):
         self.node_id = 1
         self.total_count = 0
         self.parser_config = parser_config
+        # compiled manifest templates, keyed by shape of the node config
+        self.manifest_templates = OrderedDict()
+        self.manifest_template_cache_size = manifest_template_cache_size
 
     def find_objects(self, path, **kwargs):
         """
@@ -392,10 +407,47 @@ class ClusterConfigParser(object):
         """
         return self.sysimage_devices.get(device_name, None)
 
+    def get_sysimage_index(self, device_name):
+        """
+        Gets member index for particular sysimage device name,
+        index is (re)built if the image file was changed since the last time
+
+        :param device_name: name of the device
+        :returns TarIndex instance, None if device is unknown or image cannot be indexed
+        """
+        path = self.get_sysimage(device_name)
+        if not path:
+            return None
+        index = self.sysimage_indexes.get(device_name)
+        if index and index.path == path and not index.is_stale():
+            return index
+        index = TarIndex(path)
+        index_file = None
+        if self.sysimage_index_dir:
+            index_file = os.path.join(self.sysimage_index_dir, '%s.json' % device_name)
+        try:
+            if not index_file or not index.load(index_file):
+                index.build()
+                if index_file:
+                    try:
+                        mkdirs(self.sysimage_index_dir)
+                        index.save(index_file)
+                    except (OSError, IOError, ValueError):
+                        # index is still used, it is built again by the next process
+                        pass
+        except (OSError, IOError, tarfile.TarError):
+            self.sysimage_indexes.pop(device_name, None)
+            return None
+        self.sysimage_indexes[device_name] = index
+        return index
+
     def prepare_zerovm_files(self, config, nvram_file, local_object, zerovm_nexe, use_dev_self=True):
         """
         Prepares all the files needed for zerovm session run
 
+        Manifest and nvram parts that depend only on the shape of the config
+        are compiled once into a template, only per-session values are filled in.
+
         :param config: single node config in deserialized format
         :param nvram_file: nvram file name to write nvram data to
         :param local_object: specific channel from config that is a local channel, can be None
@@ -404,16 +456,84 @@ class ClusterConfigParser(object):
 
         :returns zerovm manifest data as string
         """
+        shape = self._get_config_shape(config, local_object, use_dev_self)
+        template = self.manifest_templates.pop(shape, None)
+        if template is None:
+            template = self._compile_manifest_template(config, local_object, use_dev_self)
+            if self.manifest_template_cache_size > 0:
+                while len(self.manifest_templates) >= self.manifest_template_cache_size:
+                    self.manifest_templates.popitem(last=False)
+                self.manifest_templates[shape] = template
+        else:
+            self.manifest_templates[shape] = template
+        manifest, channel_indexes, fstab, mapping = template
+        values = [zerovm_nexe or '/dev/null', self.get_memory(config)]
+        for i in channel_indexes:
+            values.append(config['channels'][i]['lpath'])
+        values.extend(config['connect'] + config['bind'])
+        if use_dev_self:
+            values.append(zerovm_nexe)
+        values.append(nvram_file)
+        values.append(config['id'])
+        if 'name_service' in config:
+            values.append(config['name_service'])
+
+        args = '[args]\nargs = %s' % config['name']
+        if config.get('args'):
+            args += ' %s' % config['args']
+        args += '\n'
+        nvram = ''.join([fstab, args, self._build_env(config, local_object), mapping])
+        fd = os.open(nvram_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            while nvram:
+                written = os.write(fd, nvram)
+                nvram = nvram[written:]
+        finally:
+            os.close(fd)
+        return manifest % tuple(values)
+
+    def get_memory(self, config):
+        """
+        Returns memory of the session: memory declared by the node,
+        capped by the configured maximum, or the maximum if not declared
+
+        :param config: single node config in deserialized format
+        """
+        max_memory = int(self.parser_config['manifest']['Memory'])
+        memory = config.get('memory')
+        if memory:
+            return min(int(memory), max_memory)
+        return max_memory
+
+    def _get_config_shape(self, config, local_object, use_dev_self):
+        limits = self.parser_config['limits']
+        manifest = self.parser_config['manifest']
+        channels = tuple((ch['device'], ch['access'], bool(ch.get('path')), ch is local_object,
+                          ch.get('mode', None), ch.get('removable', 'no'),
+                          self.is_sysimage_device(ch['device']))
+                         for ch in config['channels'])
+        conn_devices = tuple(conn.split(',', 2)[1] for conn in config['connect'] + config['bind'])
+        return (channels, conn_devices, use_dev_self, 'name_service' in config,
+                limits['reads'], limits['rbytes'], limits['writes'], limits['wbytes'],
+                manifest['Version'], manifest['Timeout'])
+
+    def _compile_manifest_template(self, config, local_object, use_dev_self):
+        """
+        Compiles manifest template for the shape of the config
+
+        :returns tuple of manifest format string, indexes of config channels
+                 whose paths are filled in, fstab and mapping nvram stanzas
+        """
+        limits = self.parser_config['limits']
+        manifest = self.parser_config['manifest']
         zerovm_inputmnfst = (
             'Version=%s\n'
-            'Program=%s\n'
+            'Program=%%s\n'
             'Timeout=%s\n'
-            'Memory=%s,0\n'
+            'Memory=%%s,0\n'
             % (
-                self.parser_config['manifest']['Version'],
-                zerovm_nexe or '/dev/null',
-                self.parser_config['manifest']['Timeout'],
-                self.parser_config['manifest']['Memory']
+                _escape(manifest['Version']),
+                _escape(manifest['Timeout'])
             ))
         mode_mapping = {}
         fstab = None
@@ -426,7 +546,8 @@ class ClusterConfigParser(object):
             return fstab
 
         channels = []
-        for ch in config['channels']:
+        channel_indexes = []
+        for i, ch in enumerate(config['channels']):
             device = ch['device']
             type = CHANNEL_TYPE_MAP.get(device)
             if type is None:
@@ -437,39 +558,35 @@ class ClusterConfigParser(object):
             access = ch['access']
             if self.is_sysimage_device(device):
                 fstab = add_to_fstab(fstab, device, 'ro')
+            line = None
             if access & ACCESS_READABLE:
-                zerovm_inputmnfst += \
-                    'Channel=%s,/dev/%s,%s,0,%s,%s,0,0\n' % \
-                    (ch['lpath'], device, type,
-                     self.parser_config['limits']['reads'], self.parser_config['limits']['rbytes'])
+                line = 'Channel=%%s,/dev/%s,%s,0,%s,%s,0,0\n' % \
+                       (_escape(device), type, limits['reads'], limits['rbytes'])
             elif access & ACCESS_CDR:
-                zerovm_inputmnfst += \
-                    'Channel=%s,/dev/%s,%s,0,%s,%s,%s,%s\n' % \
-                    (ch['lpath'], device, type,
-                     self.parser_config['limits']['reads'], self.parser_config['limits']['rbytes'],
-                     self.parser_config['limits']['writes'], self.parser_config['limits']['wbytes'])
+                line = 'Channel=%%s,/dev/%s,%s,0,%s,%s,%s,%s\n' % \
+                       (_escape(device), type, limits['reads'], limits['rbytes'],
+                        limits['writes'], limits['wbytes'])
                 if device in 'image':
                     fstab = add_to_fstab(fstab, device, 'ro', removable=ch['removable'])
             elif access & ACCESS_WRITABLE:
                 tag = '0'
                 if not ch['path'] or ch is local_object:
                     tag = '1'
-                zerovm_inputmnfst += \
-                    'Channel=%s,/dev/%s,%s,%s,0,0,%s,%s\n' % \
-                    (ch['lpath'], device, type, tag,
-                     self.parser_config['limits']['writes'], self.parser_config['limits']['wbytes'])
+                line = 'Channel=%%s,/dev/%s,%s,%s,0,0,%s,%s\n' % \
+                       (_escape(device), type, tag, limits['writes'], limits['wbytes'])
             elif access & ACCESS_NETWORK:
-                zerovm_inputmnfst += \
-                    'Channel=%s,/dev/%s,%s,0,0,0,%s,%s\n' % \
-                    (ch['lpath'], device, type,
-                     self.parser_config['limits']['writes'], self.parser_config['limits']['wbytes'])
+                line = 'Channel=%%s,/dev/%s,%s,0,0,0,%s,%s\n' % \
+                       (_escape(device), type, limits['writes'], limits['wbytes'])
+            if line:
+                zerovm_inputmnfst += line
+                channel_indexes.append(i)
             mode = ch.get('mode', None)
             if mode:
                 mode_mapping[device] = mode
             channels.append(device)
         network_devices = []
         for conn in config['connect'] + config['bind']:
-            zerovm_inputmnfst += 'Channel=%s\n' % conn
+            zerovm_inputmnfst += 'Channel=%s\n'
             dev = conn.split(',', 2)[1][5:]  # len('/dev/') = 5
             if dev in STD_DEVICES:
                 network_devices.append(dev)
@@ -478,74 +595,66 @@ class ClusterConfigParser(object):
                 if 'stdin' in dev:
                     zerovm_inputmnfst += \
                         'Channel=/dev/null,/dev/stdin,0,0,%s,%s,0,0\n' % \
-                        (self.parser_config['limits']['reads'], self.parser_config['limits']['rbytes'])
+                        (limits['reads'], limits['rbytes'])
                 else:
                     zerovm_inputmnfst += \
                         'Channel=/dev/null,/dev/%s,0,0,0,0,%s,%s\n' % \
-                        (dev, self.parser_config['limits']['writes'], self.parser_config['limits']['wbytes'])
+                        (_escape(dev), limits['writes'], limits['wbytes'])
         if use_dev_self:
             zerovm_inputmnfst += \
-                'Channel=%s,/dev/self,3,0,%s,%s,0,0\n' % \
-                (zerovm_nexe, self.parser_config['limits']['reads'], self.parser_config['limits']['rbytes'])
-        env = None
-        if config.get('env'):
-            env = '[env]\n'
-            if local_object:
-                if local_object['access'] & (ACCESS_READABLE | ACCESS_CDR):
-                    metadata = local_object['meta']
-                    env += ENV_ITEM % ('CONTENT_LENGTH', local_object['size'])
-                    env += ENV_ITEM % ('CONTENT_TYPE',
-                                       quote_for_env(metadata.get('Content-Type',
-                                                                  'application/octet-stream')))
-                    for k, v in metadata.iteritems():
-                        meta = k.upper()
-                        if meta.startswith('X-OBJECT-META-'):
-                            env += ENV_ITEM % ('HTTP_%s' % meta.replace('-', '_'),
-                                               quote_for_env(v))
-                            continue
-                        for hdr in ['X-TIMESTAMP', 'ETAG', 'CONTENT-ENCODING']:
-                            if hdr in meta:
-                                env += ENV_ITEM % ('HTTP_%s' % meta.replace('-', '_'),
-                                                   quote_for_env(v))
-                                break
-                elif local_object['access'] & ACCESS_WRITABLE:
-                    env += ENV_ITEM % ('CONTENT_TYPE',
-                                       quote_for_env(local_object.get('content_type',
-                                                                      'application/octet-stream')))
-                    meta = local_object.get('meta', None)
-                    if meta:
-                        for k, v in meta.iteritems():
-                            env += ENV_ITEM % ('HTTP_X_OBJECT_META_%s' % k.upper().replace('-', '_'),
-                                               quote_for_env(v))
-                env += ENV_ITEM % ('DOCUMENT_ROOT', '/dev/%s' % local_object['device'])
-                config['env']['REQUEST_METHOD'] = 'POST'
-                config['env']['PATH_INFO'] = local_object['path_info']
-            for k, v in config['env'].iteritems():
-                if v:
-                    env += ENV_ITEM % (k, quote_for_env(v))
-        args = '[args]\nargs = %s' % config['name']
-        if config.get('args'):
-            args += ' %s' % config['args']
-        args += '\n'
+                'Channel=%%s,/dev/self,3,0,%s,%s,0,0\n' % \
+                (limits['reads'], limits['rbytes'])
+        zerovm_inputmnfst += \
+            'Channel=%%s,/dev/nvram,3,0,%s,%s,%s,%s\n' % \
+            (limits['reads'], limits['rbytes'], 0, 0)
+        zerovm_inputmnfst += 'Node=%d\n'
+        if 'name_service' in config:
+            zerovm_inputmnfst += 'NameServer=%s\n'
         mapping = None
         if mode_mapping:
             mapping = '[mapping]\n'
             for ch_device, mode in mode_mapping.iteritems():
                 mapping += 'channel=/dev/%s, mode=%s\n' % (ch_device, mode)
-
-        fd = open(nvram_file, 'wb')
-        for chunk in [fstab, args, env, mapping]:
-            fd.write(chunk or '')
-        fd.close()
-        zerovm_inputmnfst += \
-            'Channel=%s,/dev/nvram,3,0,%s,%s,%s,%s\n' % \
-            (nvram_file, self.parser_config['limits']['reads'], self.parser_config['limits']['rbytes'], 0, 0)
-        zerovm_inputmnfst += 'Node=%d\n' \
-                             % (config['id'])
-        if 'name_service' in config:
-            zerovm_inputmnfst += 'NameServer=%s\n' \
-                                 % config['name_service']
-        return zerovm_inputmnfst
+        return zerovm_inputmnfst, channel_indexes, fstab or '', mapping or ''
+
+    def _build_env(self, config, local_object):
+        if not config.get('env'):
+            return ''
+        env = '[env]\n'
+        if local_object:
+            if local_object['access'] & (ACCESS_READABLE | ACCESS_CDR):
+                metadata = local_object['meta']
+                env += ENV_ITEM % ('CONTENT_LENGTH', local_object['size'])
+                env += ENV_ITEM % ('CONTENT_TYPE',
+                                   quote_for_env(metadata.get('Content-Type',
+                                                              'application/octet-stream')))
+                for k, v in metadata.iteritems():
+                    meta = k.upper()
+                    if meta.startswith('X-OBJECT-META-'):
+                        env += ENV_ITEM % ('HTTP_%s' % meta.replace('-', '_'),
+                                           quote_for_env(v))
+                        continue
+                    for hdr in ['X-TIMESTAMP', 'ETAG', 'CONTENT-ENCODING']:
+                        if hdr in meta:
+                            env += ENV_ITEM % ('HTTP_%s' % meta.replace('-', '_'),
+                                               quote_for_env(v))
+                            break
+            elif local_object['access'] & ACCESS_WRITABLE:
+                env += ENV_ITEM % ('CONTENT_TYPE',
+                                   quote_for_env(local_object.get('content_type',
+                                                                  'application/octet-stream')))
+                meta = local_object.get('meta', None)
+                if meta:
+                    for k, v in meta.iteritems():
+                        env += ENV_ITEM % ('HTTP_X_OBJECT_META_%s' % k.upper().replace('-', '_'),
+                                           quote_for_env(v))
+            env += ENV_ITEM % ('DOCUMENT_ROOT', '/dev/%s' % local_object['device'])
+            config['env']['REQUEST_METHOD'] = 'POST'
+            config['env']['PATH_INFO'] = local_object['path_info']
+        for k, v in config['env'].iteritems():
+            if v:
+                env += ENV_ITEM % (k, quote_for_env(v))
+        return env
 
     def resolve_path_info(self, account_name, replica_count):
         default_path_info = '/%s' % account_name
@@ -562,6 +671,11 @@ class ClusterConfigParser(object):
             if node.replicate == 0:
                 node.replicate = 1
 
+def _escape(value):
+    """Escapes value for use in a manifest template"""
+    return str(value).replace('%', '%%')
+
+
 def _add_connected_device(devices, channel, zvm_node):
     if not devices.get(zvm_node.name, None):
         devices[zvm_node.name] = {}
@@ -612,7 +726,10 @@ def _create_node(node_config):
     if has_control_chars('%s %s %s' % (exe.url, args, env)):
         raise ClusterConfigParsingError(_('Invalid nexe property for %s') % name)
     replicate = node_config.get('replicate', 1)
-    return ZvmNode(0, name, exe, args, env, replicate)
+    memory = node_config.get('memory', None)
+    if memory is not None and (not isinstance(memory, (int, long)) or memory <= 0):
+        raise ClusterConfigParsingError(_('Invalid memory for %s') % name)
+    return ZvmNode(0, name, exe, args, env, replicate, memory)
 
 
 def _create_channel(channel, node, default_content_type=None):
@@ -626,6 +743,9 @@ def _create_channel(channel, node, default_content_type=None):
     mode = channel.get('mode', None)
     meta = channel.get('meta', {})
     content_type = channel.get('content_type', default_content_type if path else 'text/html')
+    size_hint = channel.get('size_hint', None)
+    if size_hint is not None and (not isinstance(size_hint, (int, long)) or size_hint < 0):
+        raise ClusterConfigParsingError(_('Invalid size hint for device %s in %s') % (device, node.name))
     if access & ACCESS_READABLE and path:
         if not is_swift_path(path):
             raise ClusterConfigParsingError(_('Readable device must be a swift object'))
@@ -633,4 +753,5 @@ def _create_channel(channel, node, default_content_type=None):
             raise ClusterConfigParsingError(_('Invalid path %s in %s')
                                             % (path.url, node.name))
     return ZvmChannel(device, access, path=path,
-                      content_type=content_type, meta_data=meta, mode=mode)
\ No newline at end of file
+                      content_type=content_type, meta_data=meta, mode=mode,
+                      size_hint=size_hint)
\ No newline at end of file
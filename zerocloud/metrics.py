@@ -0,0 +1,115 @@
+import time
+
+# upper bounds of histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# session phases in the order they happen
+PHASES = ('queue_wait', 'upload', 'sysmap_parse', 'channel_resolution',
+          'manifest_build', 'spawn', 'run', 'report_parse',
+          'output_finalize', 'response_stream')
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        for bound in BUCKETS:
+            if value <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.total += value
+        self.count += 1
+
+
+class SessionMetrics(object):
+    """
+    Latency histograms of session phases, per pool and per account
+
+    Each observation is sent to statsd as `zap_phase_time.<phase>.<pool>`
+    and `zap_phase_time.<phase>.<pool>.<account>` timings and added to
+    local histograms, which are rendered in Prometheus text format.
+    """
+
+    def __init__(self, logger=None, max_accounts=1000):
+        """
+        :param logger: logger with statsd methods, None to keep local histograms only
+        :param max_accounts: accounts above this number are counted as `_other`
+        """
+        self.logger = logger
+        self.max_accounts = max_accounts
+        self.accounts = set()
+        # (phase, pool, account) -> Histogram
+        self.histograms = {}
+
+    def observe(self, phase, pool, account, seconds):
+        if account not in self.accounts:
+            if len(self.accounts) >= self.max_accounts:
+                account = '_other'
+            else:
+                self.accounts.add(account)
+        key = (phase, pool, account)
+        histogram = self.histograms.get(key)
+        if not histogram:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+        if self.logger:
+            name = 'zap_phase_time.%s.%s' % (phase, _statsd_name(pool))
+            self.logger.timing(name, seconds * 1000)
+            self.logger.timing('%s.%s' % (name, _statsd_name(account)), seconds * 1000)
+
+    def render(self):
+        lines = ['# HELP zerovm_phase_seconds Duration of zerovm session phases',
+                 '# TYPE zerovm_phase_seconds histogram']
+        for (phase, pool, account), histogram in sorted(self.histograms.iteritems()):
+            labels = 'phase="%s",pool="%s",account="%s"' \
+                     % (phase, _label_value(pool), _label_value(account))
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append('zerovm_phase_seconds_bucket{%s,le="%s"} %d' % (labels, bound, cumulative))
+            lines.append('zerovm_phase_seconds_sum{%s} %f' % (labels, histogram.total))
+            lines.append('zerovm_phase_seconds_count{%s} %d' % (labels, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+class PhaseTimer(object):
+    """Times consecutive phases of one session, does nothing but time() if metrics are disabled"""
+
+    def __init__(self, metrics, pool, account):
+        self.metrics = metrics
+        self.pool = pool
+        self.account = account
+        self.last = time.time()
+
+    def mark(self, phase):
+        """Records time passed since the previous mark as duration of the phase"""
+        now = time.time()
+        if self.metrics:
+            self.metrics.observe(phase, self.pool, self.account, now - self.last)
+        self.last = now
+
+
+def send_gauge(logger, name, value):
+    """Sends statsd gauge, swift loggers have no method for it, so it goes to their statsd client"""
+    gauge = getattr(logger, 'gauge', None)
+    if gauge:
+        gauge(name, value)
+        return
+    client = getattr(getattr(logger, 'logger', None), 'statsd_client', None)
+    if client:
+        client._send(name, value, 'g', None)
+
+
+def _statsd_name(value):
+    return str(value).replace('.', '_').replace(':', '_').replace('|', '_').replace('@', '_')
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -1,21 +1,32 @@
 from StringIO import StringIO
 from greenlet import GreenletExit
+import fcntl
+import hmac
+import math
+import mmap
 import re
 import shutil
 import time
 import traceback
 import tarfile
+from collections import OrderedDict, defaultdict
 from contextlib import contextmanager
 from urllib import unquote
-from hashlib import md5
+from hashlib import md5, sha256
 from tempfile import mkstemp, mkdtemp
 
-from eventlet import GreenPool, sleep, spawn
+from eventlet import sleep, spawn
+from eventlet.event import Event
+from eventlet.queue import Queue, Full
 from eventlet.green import select, subprocess, os, socket
 from eventlet.timeout import Timeout
+from eventlet.hubs import trampoline
 from eventlet.green.httplib import HTTPResponse
 import errno
 import signal
+import stat
+import struct
+import sys
 
 from swift import gettext_ as _
 from swift.common.swob import Request, Response, HTTPNotFound, \
@@ -23,7 +34,8 @@ from swift.common.swob import Request, Response, HTTPNotFound, \
     HTTPBadRequest, HTTPUnprocessableEntity, HTTPServiceUnavailable, \
     HTTPClientDisconnect, HTTPInternalServerError, HeaderKeyDict, HTTPInsufficientStorage
 from swift.common.utils import normalize_timestamp, fallocate, \
-    split_path, get_logger, mkdirs, disable_fallocate, TRUE_VALUES
+    split_path, get_logger, mkdirs, disable_fallocate, TRUE_VALUES, cache_from_env, ThreadPool, \
+    streq_const_time
 from swift.obj.diskfile import DiskFileManager, DiskFile, DiskFileWriter, write_metadata
 from swift.common.constraints import check_mount, check_utf8, check_float
 from swift.common.exceptions import DiskFileError, DiskFileNotExist, DiskFileNoSpace, DiskFileDeviceUnavailable, \
@@ -31,9 +43,12 @@ from swift.common.exceptions import DiskFileError, DiskFileNotExist, DiskFileNoS
 from swift.proxy.controllers.base import update_headers
 from zerocloud.common import TAR_MIMES, ACCESS_READABLE, ACCESS_CDR, ACCESS_WRITABLE, \
     MD5HASH_LENGTH, parse_location, \
-    is_image_path, ACCESS_NETWORK, ACCESS_RANDOM, REPORT_VALIDATOR, REPORT_RETCODE, REPORT_ETAG, \
-    REPORT_CDR, REPORT_STATUS, SwiftPath, REPORT_LENGTH, REPORT_DAEMON, NodeEncoder
-from zerocloud.configparser import ClusterConfigParser
+    is_image_path, is_swift_path, ACCESS_NETWORK, ACCESS_RANDOM, REPORT_VALIDATOR, REPORT_RETCODE, REPORT_ETAG, \
+    REPORT_CDR, REPORT_STATUS, SwiftPath, REPORT_LENGTH, REPORT_DAEMON, NodeEncoder, \
+    has_sendfile, sendfile, collapse_range, STREAM_REPORT
+from zerocloud.configparser import ClusterConfigParser, ClusterConfigParsingError, CHANNEL_TYPE_MAP
+from zerocloud.scheduler import FairPool, AccountPool, HostSlots, MemoryBudget, AdaptiveLimit
+from zerocloud.metrics import SessionMetrics, PhaseTimer
 
 from zerocloud.tarstream import UntarStream, TarStream, REGTYPE, BLOCKSIZE, NUL
 
@@ -42,6 +57,12 @@ try:
 except ImportError:
     import json
 
+# read size used to hash and move large output files on finalization
+FINALIZE_CHUNK_SIZE = 4 * 1048576
+
+# not exported by socket module on older pythons, value is for Linux
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
 
 class ZDiskFileManager(DiskFileManager):
 
@@ -67,6 +88,10 @@ class ZDiskFile(DiskFile):
         self.channel_device = None
         self.new_timestamp = None
 
+    def close(self):
+        """Closes the data file left open by open()"""
+        self.__exit__(None, None, None)
+
     @contextmanager
     def create(self, size=None, fd=None):
         if not os.path.exists(self._tmpdir):
@@ -97,7 +122,7 @@ class ZDiskFile(DiskFile):
         return self._name
 
     def put_metadata(self, metadata):
-        write_metadata(self._data_file, metadata)
+        self._threadpool.run_in_thread(write_metadata, self._data_file, metadata)
 
 
 class PseudoSocket():
@@ -110,17 +135,50 @@ class PseudoSocket():
 
 
 class TmpDir(object):
-    def __init__(self, path, device, disk_chunk_size=65536, os_interface=os):
+    def __init__(self, path, device, disk_chunk_size=65536, os_interface=os,
+                 scratch_dir=None, scratch_max_size=0, dir_pools=None, dir_pool_size=0,
+                 threadpool=None):
         self.os_interface = os_interface
         self.tmpdir = self.os_interface.path.join(path, device, 'tmp')
         self.disk_chunk_size = disk_chunk_size
+        # RAM-backed directory for small session files, None if not configured
+        self.scratch_dir = None
+        if scratch_dir:
+            self.scratch_dir = self.os_interface.path.join(scratch_dir, device)
+        self.scratch_max_size = scratch_max_size
+        # SessionDirPool for each parent dir, shared between sessions, None disables pooling
+        self.dir_pools = dir_pools
+        self.dir_pool_size = dir_pool_size
+        self.threadpool = threadpool
+
+    def fits_scratch(self, size):
+        """Checks that a file of the given size should and can be placed in scratch dir"""
+        if not self.scratch_dir or size > self.scratch_max_size:
+            return False
+        if not self.os_interface.path.exists(self.scratch_dir):
+            mkdirs(self.scratch_dir)
+        try:
+            st = os.statvfs(self.scratch_dir)
+        except OSError:
+            return False
+        return st.f_bavail * st.f_frsize > size
 
-    @contextmanager
-    def mkstemp(self):
-        """Contextmanager to make a temporary file."""
+    def get_dir(self, size=0, scratch=True):
+        """
+        Returns directory for a file of the given size: the scratch dir
+        for files up to `scratch_max_size` bytes that fit in it,
+        the device tmp dir otherwise
+        """
+        if scratch and self.fits_scratch(size):
+            return self.scratch_dir
         if not self.os_interface.path.exists(self.tmpdir):
             mkdirs(self.tmpdir)
-        fd, tmppath = mkstemp(dir=self.tmpdir)
+        return self.tmpdir
+
+    @contextmanager
+    def mkstemp(self, size=0):
+        """Contextmanager to make a temporary file."""
+        fd, tmppath = mkstemp(dir=self.get_dir(size))
         try:
             yield fd, tmppath
         finally:
@@ -134,14 +192,678 @@ class TmpDir(object):
                 pass
 
     @contextmanager
-    def mkdtemp(self):
-        if not self.os_interface.path.exists(self.tmpdir):
-            mkdirs(self.tmpdir)
-        tmpdir = mkdtemp(dir=self.tmpdir)
+    def mkdtemp(self, scratch=False):
+        """
+        Contextmanager to make a temporary directory, in scratch dir if
+        `scratch` is set, yields None if scratch dir is not configured
+        """
+        if scratch and not self.scratch_dir:
+            yield None
+            return
+        if self.dir_pools is None:
+            tmpdir = mkdtemp(dir=self.get_dir(scratch=scratch))
+            try:
+                yield tmpdir
+            finally:
+                if self.threadpool:
+                    self.threadpool.run_in_thread(shutil.rmtree, tmpdir, True)
+                else:
+                    shutil.rmtree(tmpdir, ignore_errors=True)
+            return
+        parent = self.scratch_dir if scratch else self.tmpdir
+        pool = self.dir_pools.get(parent)
+        if not pool:
+            pool = SessionDirPool(os.path.join(parent, 'zvm-sessions'), self.dir_pool_size,
+                                  threadpool=self.threadpool)
+            self.dir_pools[parent] = pool
+        tmpdir = pool.get()
         try:
             yield tmpdir
         finally:
-            shutil.rmtree(tmpdir, ignore_errors=True)
+            pool.put(tmpdir)
+
+
+class SessionDirPool(object):
+    """
+    Pool of empty session directories
+
+    Directories are handed out to sessions and emptied in background when
+    sessions return them, so neither creation nor recursive delete is on
+    the request path. Each object server worker keeps its directories under
+    `<parent>/<pid>`, directories of dead workers are removed and directories
+    left by a previous process with the same pid are emptied and reused.
+    """
+
+    def __init__(self, parent, max_size, threadpool=None):
+        """
+        :param parent: directory that holds pools of all workers
+        :param max_size: maximum number of clean directories kept in the pool
+        :param threadpool: swift ThreadPool to run cleanup in, None to run it in a green thread
+        """
+        self.max_size = max_size
+        self.threadpool = threadpool
+        self.pool_dir = os.path.join(parent, str(os.getpid()))
+        self.free = []
+        # cleanup threads in flight
+        self.jobs = set()
+        if not os.path.exists(self.pool_dir):
+            mkdirs(self.pool_dir)
+        for name in os.listdir(parent):
+            path = os.path.join(parent, name)
+            if path == self.pool_dir:
+                continue
+            try:
+                pid = int(name)
+                os.kill(pid, 0)
+                continue
+            except ValueError:
+                pass
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    continue
+            self._spawn(shutil.rmtree, path, True)
+        for name in os.listdir(self.pool_dir):
+            self.put(os.path.join(self.pool_dir, name))
+
+    def get(self):
+        if self.free:
+            return self.free.pop()
+        return mkdtemp(dir=self.pool_dir)
+
+    def put(self, path):
+        """Returns directory to the pool, it is emptied before reuse"""
+        self._spawn(self._clean, path)
+
+    def wait(self):
+        """Waits for all pending cleanups"""
+        for thrd in list(self.jobs):
+            thrd.wait()
+
+    def _spawn(self, func, *args):
+        if self.threadpool:
+            thrd = spawn(self.threadpool.run_in_thread, func, *args)
+        else:
+            thrd = spawn(func, *args)
+        self.jobs.add(thrd)
+        thrd.link(self.jobs.discard)
+
+    def _clean(self, path):
+        if len(self.free) < self.max_size:
+            try:
+                for name in os.listdir(path):
+                    entry = os.path.join(path, name)
+                    if os.path.isdir(entry) and not os.path.islink(entry):
+                        shutil.rmtree(entry)
+                    else:
+                        os.unlink(entry)
+            except OSError:
+                pass
+            else:
+                self.free.append(path)
+                return
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class FifoFeeder(object):
+    """
+    Writes data of a tar member that is still being uploaded to a FIFO read by zerovm
+
+    The FIFO is opened for writing only when zerovm opens it for reading,
+    so zerovm gets EOF right after the member data. When the member is written
+    the rest of the request body is drained. Data zerovm does not read before
+    it exits is dropped.
+    """
+
+    def __init__(self, path, data_iter, rest_iter, check, open_interval=0.01):
+        """
+        :param path: FIFO to write to
+        :param data_iter: iterator over member data
+        :param rest_iter: iterator over the rest of the request body
+        :param check: called for each chunk, returns error response to stop the upload or None
+        :param open_interval: seconds between attempts to open the FIFO
+        """
+        self.path = path
+        self.data_iter = data_iter
+        self.rest_iter = rest_iter
+        self.check = check
+        self.open_interval = open_interval
+        self.reader_done = False
+        self.thrd = spawn(self._run)
+
+    def finish(self):
+        """
+        Called when zerovm has exited, waits until the upload is received
+
+        :returns error response of the upload or None
+        """
+        self.reader_done = True
+        return self.thrd.wait()
+
+    def _open(self):
+        while not self.reader_done:
+            try:
+                return os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError, e:
+                if e.errno != errno.ENXIO:
+                    raise
+            # nobody reads the FIFO yet
+            sleep(self.open_interval)
+        return None
+
+    def _run(self):
+        fd = self._open()
+        try:
+            for data in self.data_iter:
+                error = self.check()
+                if error:
+                    return error
+                while data and fd is not None and not self.reader_done:
+                    written = 0
+                    # reader_done is checked again if the pipe stays full
+                    with Timeout(self.open_interval * 10, False):
+                        try:
+                            written = os.write(fd, data)
+                        except OSError, e:
+                            if e.errno != errno.EPIPE:
+                                raise
+                            # zerovm closed the FIFO
+                            os.close(fd)
+                            fd = None
+                    data = data[written:]
+        finally:
+            if fd is not None:
+                os.close(fd)
+        for _junk in self.rest_iter:
+            error = self.check()
+            if error:
+                return error
+        return None
+
+
+class EarlyPreparation(object):
+    """
+    Session preparation that runs in a green thread while the upload is received
+
+    The session takes prepared results when the upload is done,
+    whatever it did not take is released by finish().
+    Preparation is not killed: a copy running in a thread would keep
+    writing to the session directory, so finish() waits for it.
+    """
+
+    def __init__(self, thrdpool, logger, func, *args):
+        """
+        :param thrdpool: AccountPool of the session, its reservation is cancelled if not used
+        :param logger: logger to report failed preparation to
+        :param func: called with this object and args, fills in the results
+        """
+        # executable extracted from a system image
+        self.boot = None
+        # channel device -> (DiskFile, error response) of the local object
+        self.disk_files = {}
+        # channel device -> output file
+        self.outputs = {}
+        # bytes allocated for outputs
+        self.reserved_size = 0
+        # set when the session is over, preparation stops at its next step
+        self.cancelled = False
+        self.thrdpool = thrdpool
+        self.logger = logger
+        self.waited = False
+        self.thrd = spawn(func, self, *args)
+
+    def wait(self):
+        """Waits until preparation is done, a failed preparation leaves the work to the session"""
+        if self.waited:
+            return
+        self.waited = True
+        try:
+            self.thrd.wait()
+        except Exception:
+            self.logger.exception(_('Early session preparation failed'))
+
+    def finish(self):
+        self.cancelled = True
+        self.wait()
+        self.thrdpool.cancel()
+        for path in self.outputs.itervalues():
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        self.outputs.clear()
+        for disk_file, _junk in self.disk_files.itervalues():
+            if disk_file:
+                disk_file.close()
+        self.disk_files.clear()
+
+
+class OutputStream(object):
+    """
+    Immediate response channel sent to the client while zerovm is still writing it
+
+    The session runs in its own green thread and keeps running after its
+    response is returned. Channel data is sent as a sequence of tar members
+    named after the channel, each one holding the data written since the previous one.
+    The last member, `report`, holds the status and x-nexe headers of the session.
+    """
+
+    def __init__(self, chunk_size, interval, queue_size=4):
+        """
+        :param chunk_size: maximum size of channel data in one member
+        :param interval: seconds between checks for new data in the channel file
+        :param queue_size: members waiting to be sent before the channel file is not read
+        """
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.tar_stream = TarStream()
+        self.queue = Queue(queue_size)
+        self.response = Event()
+        self.started = False
+        self.closed = False
+
+    def run(self, func, *args):
+        """
+        Calls func in a green thread
+
+        :returns response of func, or the streamed response if func calls start()
+        """
+        thrd = spawn(func, *args)
+        thrd.link(self._finish)
+        return self.response.wait()
+
+    def start(self, response):
+        """Returns response to the client, its body is the output sent by follow() and the report"""
+        self.started = True
+        response.app_iter = self
+        self.response.send(response)
+
+    def follow(self, name, path, thrd):
+        """Sends data written to path until thrd is done"""
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            while not self.closed:
+                # nothing is written after thrd is done, the last read gets the rest
+                done = thrd.dead
+                data = os.read(fd, self.chunk_size)
+                if data:
+                    self._put_member(name, data)
+                elif done:
+                    break
+                else:
+                    sleep(self.interval)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        self.closed = True
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.closed = True
+
+    def _finish(self, thrd):
+        try:
+            resp = thrd.wait()
+        except Exception, e:
+            if not self.started:
+                self.response.send_exception(*sys.exc_info())
+                return
+            # client connection is dropped, the output is incomplete
+            self._put(e)
+            return
+        if not self.started:
+            self.response.send(resp)
+            return
+        headers = dict((key.lower(), value) for key, value in resp.headers.iteritems()
+                       if key.lower().startswith('x-nexe-'))
+        self._put_member(STREAM_REPORT, json.dumps({'status': resp.status, 'headers': headers}))
+        self._put(None)
+
+    def _put_member(self, name, data):
+        info = self.tar_stream.create_tarinfo(ftype=REGTYPE, name=name, size=len(data))
+        remainder = len(data) % BLOCKSIZE
+        if remainder:
+            data += NUL * (BLOCKSIZE - remainder)
+        self._put(info + data)
+
+    def _put(self, item):
+        # nothing is sent after the client is gone
+        while not self.closed:
+            try:
+                self.queue.put(item, timeout=self.interval)
+                return
+            except Full:
+                pass
+
+
+class BootFileCache(object):
+    """
+    LRU cache of boot files extracted from system image tar files
+
+    Entries are keyed by image path, image identity (device, inode, mtime,
+    size) and member name, so the same key always means the same content
+    and the cache directory can be shared by all object server workers.
+    Cached files are kept on the same device as the session directories,
+    a cache hit is a hard link, not a copy.
+
+    The byte budget is for the whole host: hits are taken from the directory,
+    whichever worker put them there, a hit updates mtime of the file and
+    eviction goes by mtime over the files of all the workers.
+    """
+
+    def __init__(self, cache_dir, max_size, os_interface=os):
+        self.os_interface = os_interface
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        if not self.os_interface.path.exists(self.cache_dir):
+            mkdirs(self.cache_dir)
+        for name in self.os_interface.listdir(self.cache_dir):
+            if len(name) != MD5HASH_LENGTH:
+                # leftover of an interrupted copy
+                try:
+                    self.os_interface.unlink(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+        # adopt entries left by other workers or by previous incarnations
+        self._scan()
+
+    def get_key(self, image, member):
+        st = self.os_interface.stat(image)
+        return md5('%s:%d:%d:%d:%d:%s' % (image, st.st_dev, st.st_ino,
+                                          st.st_mtime, st.st_size,
+                                          member)).hexdigest()
+
+    def get(self, key, dest):
+        """
+        Links cached file into session directory
+
+        :param key: cache key returned by get_key()
+        :param dest: file name to link cached file to
+        :returns True on cache hit, False otherwise
+        """
+        path = os.path.join(self.cache_dir, key)
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.size -= entry[1]
+        try:
+            # the file can be put by another worker, or evicted by it
+            _link_or_copy(path, dest)
+            size = self.os_interface.path.getsize(dest)
+        except (OSError, IOError):
+            self.misses += 1
+            return False
+        try:
+            self.os_interface.utime(path, None)
+        except OSError:
+            pass
+        self.entries[key] = (path, size)
+        self.size += size
+        self.hits += 1
+        return True
+
+    def put(self, key, src):
+        """
+        Adds freshly extracted file to the cache, evicts least recently used
+        entries if cache grows larger than max_size
+
+        :param key: cache key returned by get_key()
+        :param src: extracted file
+        """
+        if key in self.entries:
+            return
+        try:
+            size = self.os_interface.path.getsize(src)
+            if size > self.max_size:
+                return
+            path = os.path.join(self.cache_dir, key)
+            _link_or_copy(src, path)
+        except (OSError, IOError):
+            return
+        # files of the other workers count against the budget too
+        self._scan()
+        while self.entries and self.size > self.max_size:
+            old_path, old_size = self.entries.popitem(last=False)[1]
+            self.size -= old_size
+            try:
+                self.os_interface.unlink(old_path)
+            except OSError:
+                pass
+
+    def _scan(self):
+        """Reads entries of all the workers from the cache directory, least recently used first"""
+        existing = []
+        for name in self.os_interface.listdir(self.cache_dir):
+            if len(name) != MD5HASH_LENGTH:
+                # copy in progress
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = self.os_interface.stat(path)
+            except OSError:
+                continue
+            existing.append((st.st_mtime, name, path, st.st_size))
+        self.entries.clear()
+        self.size = 0
+        for _mtime, name, path, size in sorted(existing):
+            self.entries[name] = (path, size)
+            self.size += size
+
+
+class ValidationStore(object):
+    """
+    Store of executables that passed zerovm validation
+
+    Entries are keyed by SHA-256 of the executable and not by its ETag,
+    MD5 is too weak for a security check shared between different objects.
+    Each entry is an empty file in store_dir, so the store is shared by all
+    object server workers and survives restarts. An entry lets an executable
+    run without validation, so store_dir must be owned by the server user and
+    writable only by it. Entries can also be shared between hosts through
+    memcache if a secret is set, memcache values are HMACs of the keys and
+    entries not signed with the secret are ignored. Each host still hashes
+    its own copy.
+    """
+
+    def __init__(self, store_dir, secret=None, os_interface=os):
+        """
+        :param store_dir: directory of the store entries, created if it does not exist
+        :param secret: secret shared by the servers to sign memcache entries, None to not use memcache
+        :raises ValueError: if store_dir can be written by other users
+        """
+        self.os_interface = os_interface
+        self.store_dir = store_dir
+        self.secret = secret
+        if not self.os_interface.path.exists(store_dir):
+            self.os_interface.makedirs(store_dir, 0700)
+        st = self.os_interface.stat(store_dir)
+        if st.st_uid not in (self.os_interface.geteuid(), 0) \
+                or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise ValueError('Validation store %s must be owned by the object server user '
+                             'and not writable by others' % store_dir)
+
+    def get_key(self, path, chunk_size=65536):
+        checksum = sha256()
+        fp = open(path, 'rb')
+        try:
+            for data in iter(lambda: fp.read(chunk_size), ''):
+                checksum.update(data)
+        finally:
+            fp.close()
+        return checksum.hexdigest()
+
+    def is_valid(self, key, memcache=None):
+        if self.os_interface.path.exists(self._get_path(key)):
+            return True
+        if memcache and self.secret:
+            signature = memcache.get('zvmvalid/%s' % key)
+            if signature and streq_const_time(str(signature), self._sign(key)):
+                self._add(key)
+                return True
+        return False
+
+    def set_valid(self, key, memcache=None):
+        self._add(key)
+        if memcache and self.secret:
+            memcache.set('zvmvalid/%s' % key, self._sign(key))
+
+    def _sign(self, key):
+        return hmac.new(self.secret, key, sha256).hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self.store_dir, key[:2], key)
+
+    def _add(self, key):
+        path = self._get_path(key)
+        try:
+            mkdirs(os.path.dirname(path))
+            open(path, 'wb').close()
+        except (OSError, IOError):
+            pass
+
+
+class DaemonRegistry(object):
+    """
+    Registry of running zerovm daemons
+
+    For each daemon socket we record pid of the daemon (taken from the socket
+    peer credentials) and its start time, so a dead or reused pid is detected
+    with a single kill(0) and /proc/<pid>/stat read.
+    Records are kept as `<socket>.pid` files and shared by all object server workers.
+    Only records owned by the server user and not writable by others are used,
+    and a daemon whose record was not registered by this worker is killed only
+    if its socket confirms the pid.
+    """
+
+    def __init__(self, sockets_dir):
+        """
+        :param sockets_dir: directory of daemon sockets and records, created if it does not exist
+        :raises ValueError: if sockets_dir can be written by other users
+        """
+        self.sockets_dir = sockets_dir
+        self.daemons = {}
+        # sockets whose records come from peer credentials seen by this worker
+        self.registered = set()
+        if not os.path.exists(sockets_dir):
+            os.makedirs(sockets_dir, 0700)
+        st = os.stat(sockets_dir)
+        if st.st_uid != os.geteuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise ValueError('Daemon sockets directory %s must be owned by the object server user '
+                             'and not writable by others' % sockets_dir)
+
+    def register(self, daemon_sock, sock):
+        """
+        Records the daemon listening on daemon_sock
+
+        :param daemon_sock: path of the daemon socket
+        :param sock: socket connected to the daemon
+        :returns daemon record dict, None if daemon pid cannot be obtained
+        """
+        pid = _get_peer_pid(sock)
+        if not pid:
+            return None
+        record = self.get(daemon_sock)
+        if record and record['pid'] == pid:
+            self.registered.add(daemon_sock)
+            return record
+        record = {'pid': pid,
+                  'start_time': _get_process_start_time(pid),
+                  'registered': time.time()}
+        fd, tmp_path = mkstemp(dir=self.sockets_dir)
+        try:
+            os.write(fd, json.dumps(record))
+            os.close(fd)
+            os.rename(tmp_path, daemon_sock + '.pid')
+        except OSError:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+        self.daemons[daemon_sock] = record
+        self.registered.add(daemon_sock)
+        return record
+
+    def get(self, daemon_sock):
+        record = self.daemons.get(daemon_sock)
+        if record:
+            return record
+        try:
+            fp = open(daemon_sock + '.pid', 'rb')
+            try:
+                st = os.fstat(fp.fileno())
+                if st.st_uid != os.geteuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                    return None
+                record = json.load(fp)
+            finally:
+                fp.close()
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(record, dict) or not isinstance(record.get('pid'), int) \
+                or record['pid'] <= 0:
+            return None
+        self.daemons[daemon_sock] = record
+        return record
+
+    def is_alive(self, daemon_sock):
+        if self._is_running(self.get(daemon_sock)):
+            return True
+        # cached record may be stale, daemon could have been restarted by another worker
+        self.registered.discard(daemon_sock)
+        if self.daemons.pop(daemon_sock, None):
+            return self._is_running(self.get(daemon_sock))
+        return False
+
+    def _is_running(self, record):
+        if not record:
+            return False
+        try:
+            os.kill(record['pid'], 0)
+        except OSError, e:
+            if e.errno != errno.EPERM:
+                return False
+        return record['start_time'] == _get_process_start_time(record['pid'])
+
+    def _is_listening(self, daemon_sock, pid):
+        """Checks that the process listening on daemon_sock is pid"""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(1)
+        try:
+            sock.connect(daemon_sock)
+            return _get_peer_pid(sock) == pid
+        except (IOError, OSError):
+            return False
+        finally:
+            sock.close()
+
+    def cleanup(self, daemon_sock):
+        """
+        Kills the daemon if it is still running and removes its socket and record
+        """
+        if self.is_alive(daemon_sock):
+            pid = self.daemons[daemon_sock]['pid']
+            if daemon_sock in self.registered or self._is_listening(daemon_sock, pid):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+        self.daemons.pop(daemon_sock, None)
+        self.registered.discard(daemon_sock)
+        for path in (daemon_sock, daemon_sock + '.pid'):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
 
 
 class DualReader(object):
@@ -199,9 +921,18 @@ class ObjectQueryMiddleware(object):
         # run the middleware in debug mode
         # will gather temp files and write them into /tmp/zvm_debug/ dir
         self.zerovm_debug = conf.get('zerovm_debug', 'no').lower() in TRUE_VALUES
+        # histograms of session phase durations, sent to statsd and served at zerovm_metrics_path
+        self.session_metrics = None
+        if conf.get('zerovm_metrics', 'no').lower() in TRUE_VALUES:
+            self.session_metrics = SessionMetrics(logger=self.logger)
+        self.zerovm_metrics_path = conf.get('zerovm_metrics_path', '/zerovm/metrics')
         # run the middleware in performance check mode
         # will print performance data to system log
         self.zerovm_perf = conf.get('zerovm_perf', 'no').lower() in TRUE_VALUES
+        # send channel data from files directly to the client socket with sendfile(2)
+        # works only if WSGI server lets us use its socket, otherwise data is streamed as usual
+        self.zerovm_sendfile = conf.get('zerovm_sendfile', 'no').lower() in TRUE_VALUES \
+            and has_sendfile()
         # name-path pairs for sysimage devices on this node
         zerovm_sysimage_devices = {}
         sysimage_list = [i.strip() for i in conf.get('zerovm_sysimage_devices', '').split() if i.strip()]
@@ -212,23 +943,92 @@ class ObjectQueryMiddleware(object):
         threadpool_list = [i.strip()
                            for i in conf.get('zerovm_threadpools', 'default 10 3 cluster 10 0').split()
                            if i.strip()]
+        # per-account weights for fair sharing of the threadpools, triples of pool, account, weight
+        pool_weights = {}
+        weight_list = [i.strip() for i in conf.get('zerovm_pool_weights', '').split() if i.strip()]
+        try:
+            for name, account, weight in zip(*[iter(weight_list)]*3):
+                weight = float(weight)
+                if weight <= 0:
+                    raise ValueError
+                pool_weights.setdefault(name, {})[account] = weight
+        except ValueError:
+            raise ValueError('Cannot parse "zerovm_pool_weights" configuration variable')
+        # directory of slot lock files shared by all workers of the host,
+        # pool sizes and queue lengths are per host if set, per worker otherwise
+        self.zerovm_host_slots_dir = conf.get('zerovm_host_slots_dir', '')
+        # memory in bytes shared by sessions of all the pools of the host,
+        # sessions start only while their memory fits, 0 to count only slots
+        memory_budget = int(conf.get('zerovm_memory_budget', 0))
+        memory = None
+        if memory_budget > 0:
+            if self.zerovm_host_slots_dir:
+                memory = MemoryBudget(memory_budget, path=os.path.join(self.zerovm_host_slots_dir, 'memory'))
+            else:
+                # without shared lock files each worker gets its part of the budget
+                memory = MemoryBudget(memory_budget // max(1, int(conf.get('workers', 1))))
+        # pools with adaptive size, triples of pool, min size, max size,
+        # size is cut when run time grows over the baseline by the tolerance
+        # or load average per cpu is over the maximum, and raised while jobs wait
+        adaptive_pools = {}
+        adaptive_list = [i.strip() for i in conf.get('zerovm_adaptive_pools', '').split() if i.strip()]
+        adaptive_tolerance = float(conf.get('zerovm_adaptive_tolerance', 2.0))
+        adaptive_max_load = float(conf.get('zerovm_adaptive_max_load', 1.0))
+        try:
+            for name, min_size, max_size in zip(*[iter(adaptive_list)]*3):
+                min_size = int(min_size)
+                max_size = int(max_size)
+                if min_size < 1 or max_size < min_size:
+                    raise ValueError
+                adaptive_pools[name] = (min_size, max_size)
+        except ValueError:
+            raise ValueError('Cannot parse "zerovm_adaptive_pools" configuration variable')
         try:
             for name, size, queue in zip(*[iter(threadpool_list)]*3):
-                self.zerovm_threadpools[name] = (GreenPool(int(size)), int(queue))
+                size = int(size)
+                queue = int(queue)
+                host_slots, host_queue = self._get_host_slots(name, size, queue)
+                limit = None
+                if name in adaptive_pools:
+                    limit = AdaptiveLimit(*adaptive_pools[name], tolerance=adaptive_tolerance,
+                                          max_load=adaptive_max_load)
+                self.zerovm_threadpools[name] = (FairPool(size, weights=pool_weights.get(name),
+                                                          name=name, logger=self.logger,
+                                                          host_slots=host_slots, host_queue=host_queue,
+                                                          memory=memory, limit=limit),
+                                                 queue)
         except ValueError:
             raise ValueError('Cannot parse "zerovm_threadpools" configuration variable')
         if len(self.zerovm_threadpools) < 1 or not self.zerovm_threadpools.get('default', None):
             raise ValueError('Invalid "zerovm_threadpools" configuration variable')
 
+        # validation of uploaded executables runs in background in its own pool,
+        # uploads above the queue length are not validated until execution
+        validation_pool_size = int(conf.get('zerovm_validation_pool', 2))
+        self.validation_pool = FairPool(validation_pool_size,
+                                        name='validation', logger=self.logger,
+                                        host_slots=self._get_host_slots('validation', validation_pool_size, 0)[0])
+        self.zerovm_validation_queue = int(conf.get('zerovm_validation_queue', 100))
+        self.validation_jobs = set()
+
         # hardcoded absolute limits for zerovm executable stdout and stderr size
         # we don't want to crush the server
         self.zerovm_stderr_size = 65536
         self.zerovm_stdout_size = 65536
 
-        # hardcoded dir for zerovm caching daemon sockets
-        self.zerovm_sockets_dir = '/tmp/zvm-daemons'
-        if not os.path.exists(self.zerovm_sockets_dir):
-            mkdirs(self.zerovm_sockets_dir)
+        # directory of zerovm daemon sockets and their pid records,
+        # must be owned by the server user and not writable by others
+        self.zerovm_sockets_dir = conf.get('zerovm_sockets_dir', '/var/run/swift/zvm-daemons')
+        self.daemons = DaemonRegistry(self.zerovm_sockets_dir)
+        # number of instances started for each daemon in "zerovm_daemons"
+        self.zerovm_daemon_instances = int(conf.get('zerovm_daemon_instances', 1))
+        if self.zerovm_daemon_instances < 1:
+            raise ValueError('Invalid "zerovm_daemon_instances" configuration variable')
+        # seconds between checks that all daemon instances are running
+        self.zerovm_daemon_check_interval = float(conf.get('zerovm_daemon_check_interval', 10))
+        # number of requests in flight for each daemon socket
+        self.daemon_load = {}
+        self.daemon_supervisor = None
         # mapping between return code and its message
         self.retcode_map = ['OK', 'Error', 'Timed out', 'Killed', 'Output too long']
 
@@ -254,19 +1054,315 @@ class ObjectQueryMiddleware(object):
                 'Memory': int(conf.get('zerovm_maxnexemem', 4 * 1024 * 1048576))
             }
         }
+        # directory where member indexes of sysimage devices are persisted,
+        # must be writable only by the server user, empty value keeps indexes in memory
+        self.zerovm_sysimage_index_dir = conf.get('zerovm_sysimage_index_dir', '/var/cache/swift/zvm-sysimage-index')
+        # number of compiled manifest templates kept, one for each shape of node config, 0 disables the cache
+        manifest_template_cache_size = int(conf.get('zerovm_manifest_template_cache_size', 1024))
         self.parser = ClusterConfigParser(zerovm_sysimage_devices, None,
-                                          self.parser_config, None, None)
+                                          self.parser_config, None, None,
+                                          sysimage_index_dir=self.zerovm_sysimage_index_dir,
+                                          manifest_template_cache_size=manifest_template_cache_size)
+        # index all sysimage devices now, so the first session does not pay for the tar scan
+        for device_name in zerovm_sysimage_devices.keys():
+            if not self.parser.get_sysimage_index(device_name):
+                self.logger.warning('Cannot index system image %s'
+                                    % zerovm_sysimage_devices[device_name])
+        # daemons prestarted on this node, pairs of daemon UUID and config file, same as in proxy
+        daemon_list = [i.strip() for i in conf.get('zerovm_daemons', '').split() if i.strip()]
+        self.zerovm_daemons = self.parse_daemon_config(daemon_list, zerovm_sysimage_devices)
+        # byte budget for boot files cached after extraction from sysimage devices,
+        # one cache per object server device shared by all the workers, 0 disables the cache
+        self.zerovm_bootcache_size = int(conf.get('zerovm_bootcache_size', 256 * 1048576))
+        self.boot_caches = {}
+        # directory of the store of validated executables, owned by the server user,
+        # empty value disables the store
+        zerovm_validation_dir = conf.get('zerovm_validation_dir', '')
+        # secret shared by object servers to sign entries of the store shared through memcache,
+        # empty value does not use memcache
+        zerovm_validation_secret = conf.get('zerovm_validation_secret', '')
+        self.validation_store = None
+        if zerovm_validation_dir:
+            self.validation_store = ValidationStore(zerovm_validation_dir,
+                                                    secret=zerovm_validation_secret or None,
+                                                    os_interface=os)
+        # RAM-backed (tmpfs) directory for manifests, nvram files and small uploaded channels,
+        # empty value keeps them in the device tmp dir
+        self.zerovm_scratch_dir = conf.get('zerovm_scratch_dir', '')
+        # files above this size in bytes are placed in the device tmp dir
+        self.zerovm_scratch_max_size = int(conf.get('zerovm_scratch_max_size', 1048576))
+        # zerovm is started before the upload finishes, the last uploaded member
+        # of a sequential read channel (stdin) is fed to it through a FIFO
+        self.zerovm_pipeline = conf.get('zerovm_pipeline', 'no').lower() in TRUE_VALUES
+        # session is prepared from its sysmap while the rest of the upload is received:
+        # pool slot, executable from system image, local object and output files
+        self.zerovm_early_prepare = conf.get('zerovm_early_prepare', 'no').lower() in TRUE_VALUES
+        # immediate response channel is sent while zerovm writes it, if requested with x-zerovm-stream
+        self.zerovm_stream_output = conf.get('zerovm_stream_output', 'no').lower() in TRUE_VALUES
+        # seconds between checks for new output of a streamed session
+        self.zerovm_stream_interval = float(conf.get('zerovm_stream_interval', 0.05))
+        # number of empty session directories kept for reuse on each device, 0 disables the pool
+        self.zerovm_session_dir_pool = int(conf.get('zerovm_session_dir_pool', 64))
+        self.session_dir_pools = {}
+        # free space in bytes that must be left on a device after output space is reserved
+        self.zerovm_tmp_reserve = int(conf.get('zerovm_tmp_reserve', 0))
         # obey `disable_fallocate` configuration directive
         if conf.get('disable_fallocate', 'no').lower() in TRUE_VALUES:
             disable_fallocate()
 
         self._diskfile_mgr = ZDiskFileManager(conf, self.logger)
+        # threads per device for blocking disk and hashing work,
+        # 0 uses the threadpools of swift disk files (`threads_per_disk`)
+        self.zerovm_threads_per_disk = int(conf.get('zerovm_threads_per_disk', 0))
+        self.threadpools = defaultdict(lambda: ThreadPool(nthreads=self.zerovm_threads_per_disk))
+
+    def _check_deadline(self, req, thrdpool, nexe_headers):
+        """
+        Rejects the session if it is not expected to finish by its deadline,
+        the client can retry later unless the deadline has already passed
+        """
+        if not thrdpool.deadline:
+            return None
+        now = time.time()
+        if now >= thrdpool.deadline:
+            self.logger.increment('zap_deadline_expired')
+            return HTTPRequestTimeout(body='Deadline has passed',
+                                      request=req, content_type='text/plain',
+                                      headers=nexe_headers)
+        estimate = thrdpool.estimate()
+        if now + estimate <= thrdpool.deadline:
+            return None
+        self.logger.increment('zap_deadline_rejected')
+        headers = dict(nexe_headers)
+        # retry when the jobs queued before it are expected to be done
+        headers['Retry-After'] = str(max(1, int(math.ceil(estimate - thrdpool.pool.run_time))))
+        # tells the proxy that other nodes will not do better
+        headers['X-Zerovm-Deadline-Rejected'] = 'true'
+        return HTTPServiceUnavailable(body='Deadline cannot be met',
+                                      request=req, content_type='text/plain',
+                                      headers=headers)
+
+    def _get_host_slots(self, name, size, queue):
+        """Returns HostSlots for the running and the queued jobs of a pool, or Nones if disabled"""
+        if not self.zerovm_host_slots_dir:
+            return None, None
+        path = os.path.join(self.zerovm_host_slots_dir, name)
+        host_queue = None
+        if queue > 0:
+            host_queue = HostSlots(path + '.queue', queue)
+        return HostSlots(path, size), host_queue
+
+    def get_threadpool(self, device):
+        """Returns ThreadPool of the device, its run_in_thread() keeps blocking work off the hub"""
+        if self.zerovm_threads_per_disk > 0:
+            return self.threadpools[device]
+        return self._diskfile_mgr.threadpools[device]
+
+    def get_tmpdir(self, device):
+        return TmpDir(
+            self._diskfile_mgr.devices,
+            device,
+            disk_chunk_size=self.app.disk_chunk_size,
+            os_interface=self.os_interface,
+            scratch_dir=self.zerovm_scratch_dir,
+            scratch_max_size=self.zerovm_scratch_max_size,
+            dir_pools=self.session_dir_pools if self.zerovm_session_dir_pool > 0 else None,
+            dir_pool_size=self.zerovm_session_dir_pool,
+            threadpool=self.get_threadpool(device)
+        )
 
     def get_disk_file(self, device, partition, account, container, obj,
                       **kwargs):
         return self._diskfile_mgr.get_diskfile(
             device, partition, account, container, obj, **kwargs)
 
+    def parse_daemon_config(self, daemon_list, sysimage_devices):
+        """
+        Loads configs of the daemons that are started on this node
+
+        :param daemon_list: list of daemon UUID, config file name pairs
+        :param sysimage_devices: dict of sysimage device name to path
+        :returns dict of daemon UUID to system map of the daemon node
+        """
+        result = {}
+        for sock, conf_file in zip(*[iter(daemon_list)] * 2):
+            if sock in result:
+                self.logger.warning('Duplicate daemon config for uuid %s' % sock)
+                continue
+            try:
+                json_config = json.load(open(conf_file))
+            except (IOError, ValueError):
+                self.logger.warning('Cannot load daemon config file: %s' % conf_file)
+                continue
+            parser = ClusterConfigParser(sysimage_devices, None, self.parser_config, None, None)
+            try:
+                parser.parse(json_config, False)
+            except ClusterConfigParsingError, e:
+                self.logger.warning('Daemon config %s error: %s' % (conf_file, str(e)))
+                continue
+            if len(parser.node_list) != 1:
+                self.logger.warning('Bad daemon config %s: too many nodes' % conf_file)
+                continue
+            node = parser.node_list[0]
+            if node.bind or node.connect:
+                self.logger.warning('Bad daemon config %s: network channels are present' % conf_file)
+                continue
+            if not is_image_path(node.exe) or not parser.is_sysimage_device(node.exe.image):
+                self.logger.warning('Bad daemon config %s: exe is not in sysimage device' % conf_file)
+                continue
+            node.channels = sorted(node.channels, key=lambda ch: ch.device)
+            result[sock] = json.dumps(node, cls=NodeEncoder)
+            self.logger.info('Loaded daemon config %s with UUID %s' % (conf_file, sock))
+        return result
+
+    def get_daemon_sockets(self, daemon_uuid):
+        """
+        Returns socket paths of all instances of the daemon
+
+        First instance uses the plain UUID, the same socket a lazily started daemon uses.
+        """
+        daemon_sock = os.path.join(self.zerovm_sockets_dir, daemon_uuid)
+        if daemon_uuid not in self.zerovm_daemons:
+            return [daemon_sock]
+        return [daemon_sock] + ['%s.%d' % (daemon_sock, i)
+                                for i in range(1, self.zerovm_daemon_instances)]
+
+    def select_daemon_socket(self, daemon_uuid):
+        """
+        Returns socket of the least loaded running instance of the daemon,
+        first instance socket if none is running (it will be started on connect failure)
+        """
+        sockets = self.get_daemon_sockets(daemon_uuid)
+        running = [sock for sock in sockets if self.daemons.is_alive(sock)]
+        if not running:
+            return sockets[0]
+        return min(running, key=lambda sock: self.daemon_load.get(sock, 0))
+
+    def start_daemon(self, daemon_uuid, daemon_sock):
+        """
+        Starts daemon instance and waits until it listens on its socket
+
+        No job is sent to the instance and no slot of the execution pools is used.
+        Instance is started by one worker at a time, others skip it while the lock is held.
+
+        :param daemon_uuid: daemon UUID from "zerovm_daemons"
+        :param daemon_sock: socket path of the instance
+        :returns True if the instance is running
+        """
+        device = self._get_local_device()
+        if not device:
+            return False
+        lock_fd = os.open(daemon_sock + '.lock', os.O_CREAT | os.O_RDWR, 0644)
+        try:
+            # daemon must not inherit the lock
+            fcntl.fcntl(lock_fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return False
+            if self.daemons.is_alive(daemon_sock):
+                return True
+            error = self._spawn_daemon(daemon_uuid, daemon_sock, device)
+            if not error and not self._wait_for_daemon(daemon_sock):
+                error = 'socket is not listening'
+            if error:
+                self.logger.warning('Cannot start daemon %s: %s' % (daemon_sock, error))
+                return False
+            self.logger.info('Started daemon %s' % daemon_sock)
+            return True
+        finally:
+            os.close(lock_fd)
+
+    def _spawn_daemon(self, daemon_uuid, daemon_sock, device):
+        """
+        Runs zerovm with the daemon config, zerovm exits when the daemon is forked
+
+        :returns error message, None if the daemon was forked
+        """
+        config = json.loads(self.zerovm_daemons[daemon_uuid])
+        exe_path = parse_location(config['exe'])
+        sysimage_path = self.parser.get_sysimage(exe_path.image)
+        if not sysimage_path:
+            return 'system image does not exist: %s' % exe_path.image
+        tmpdir = self.get_tmpdir(device)
+        with tmpdir.mkdtemp() as zerovm_tmp:
+            channels = {}
+            if not self._extract_boot_file(channels, exe_path.path, sysimage_path, zerovm_tmp,
+                                           cache=self._get_boot_cache(device),
+                                           index=self.parser.get_sysimage_index(exe_path.image),
+                                           threadpool=self.get_threadpool(device)):
+                return 'cannot find daemon nexe in system image %s' % sysimage_path
+            for ch in config['channels']:
+                if self.parser.is_sysimage_device(ch['device']):
+                    ch['lpath'] = self.parser.get_sysimage(ch['device'])
+                else:
+                    # real channels come with each job, daemon only needs them to exist
+                    ch['lpath'] = os.path.join(zerovm_tmp, ch['device'])
+                    os.close(os.open(ch['lpath'], os.O_WRONLY | os.O_CREAT, 0644))
+            with tmpdir.mkstemp() as (zerovm_inputmnfst_fd, zerovm_inputmnfst_fn), \
+                    tmpdir.mkstemp() as (nvram_fd, nvram_file):
+                zerovm_inputmnfst = self.parser.prepare_zerovm_files(config, nvram_file, {},
+                                                                     channels['boot'], False)
+                zerovm_inputmnfst += 'Job = %s\n' % daemon_sock
+                while zerovm_inputmnfst:
+                    written = self.os_interface.write(zerovm_inputmnfst_fd, zerovm_inputmnfst)
+                    zerovm_inputmnfst = zerovm_inputmnfst[written:]
+                (zerovm_retcode, zerovm_stdout, zerovm_stderr) = \
+                    self.execute_zerovm(zerovm_inputmnfst_fn)
+        report = zerovm_stdout.split('\n', REPORT_LENGTH - 1)
+        if zerovm_retcode > 1 or len(report) < REPORT_LENGTH:
+            return 'zerovm retcode=%s %s' % (self.retcode_map[zerovm_retcode],
+                                             zerovm_stdout + zerovm_stderr)
+        try:
+            if int(report[REPORT_DAEMON]) == 1:
+                return None
+        except ValueError:
+            pass
+        return 'daemon was not started: %s' % zerovm_stdout
+
+    def _wait_for_daemon(self, daemon_sock, interval=0.1):
+        """
+        Waits until the daemon accepts connections on its socket and records its pid
+
+        :returns True if the daemon was recorded
+        """
+        with Timeout(self.parser_config['manifest']['Timeout'], False):
+            while True:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.connect(daemon_sock)
+                    return self.daemons.register(daemon_sock, sock) is not None
+                except IOError:
+                    pass
+                finally:
+                    sock.close()
+                sleep(interval)
+        return False
+
+    def _supervise_daemons(self):
+        while True:
+            for daemon_uuid in sorted(self.zerovm_daemons.keys()):
+                for daemon_sock in self.get_daemon_sockets(daemon_uuid):
+                    # busy instance is being started by a request
+                    if self.daemon_load.get(daemon_sock) or self.daemons.is_alive(daemon_sock):
+                        continue
+                    try:
+                        self.start_daemon(daemon_uuid, daemon_sock)
+                    except (Exception, Timeout):
+                        self.logger.exception(_('ERROR starting daemon %s') % daemon_sock)
+            sleep(self.zerovm_daemon_check_interval)
+
+    def _get_local_device(self):
+        devices = self._diskfile_mgr.devices
+        try:
+            device_list = sorted(os.listdir(devices))
+        except OSError:
+            return None
+        for device in device_list:
+            if not self._diskfile_mgr.mount_check or check_mount(devices, device):
+                return device
+        return None
+
     def send_to_socket(self, sock, zerovm_inputmnfst):
         SIZE = 8
         size = '0x%06x' % len(zerovm_inputmnfst)
@@ -274,12 +1370,12 @@ class ObjectQueryMiddleware(object):
             with Timeout(self.parser_config['manifest']['Timeout']):
                 sock.sendall(size + zerovm_inputmnfst)
                 try:
-                    size = int(sock.recv(SIZE), 0)
+                    size = int(_recv_all(sock, SIZE), 0)
                     if not size:
                         return 1, 'Report error', ''
                     if size > self.zerovm_stdout_size:
                         return 4, 'Output too long', ''
-                    report = sock.recv(size)
+                    report = _recv_all(sock, size)
                     return 0, report, ''
                 except ValueError:
                     return 1, 'Report error', ''
@@ -290,12 +1386,13 @@ class ObjectQueryMiddleware(object):
         finally:
             sock.close()
 
-    def execute_zerovm(self, zerovm_inputmnfst_fn, zerovm_args=None):
+    def execute_zerovm(self, zerovm_inputmnfst_fn, zerovm_args=None, timer=None):
         """
         Executes zerovm in a subprocess
 
         :param zerovm_inputmnfst_fn: file name of zerovm manifest, can be relative path
         :param zerovm_args: additional arguments passed to zerovm command line, should be a list of str
+        :param timer: PhaseTimer of the session, spawn and run phases are recorded in it
 
         """
         cmdline = []
@@ -306,6 +1403,8 @@ class ObjectQueryMiddleware(object):
         proc = subprocess.Popen(cmdline,
                                 stdout=subprocess.PIPE,
                                 stderr=subprocess.PIPE)
+        if timer:
+            timer.mark('spawn')
 
         def get_final_status(stdout_data, stderr_data, return_code=None):
             (data1, data2) = proc.communicate()
@@ -337,20 +1436,16 @@ class ObjectQueryMiddleware(object):
         readable = [proc.stdout, proc.stderr]
         try:
             with Timeout(self.parser_config['manifest']['Timeout'] + 1):
-                start = time.time()
-                perf = ''
                 while len(readable) > 0:
                     stdout_data, stderr_data = read_from_std(readable, stdout_data, stderr_data)
                     if len(stdout_data) > self.zerovm_stdout_size \
                             or len(stderr_data) > self.zerovm_stderr_size:
                         proc.kill()
                         return 4, stdout_data, stderr_data
-                    perf = "%s %.3f" % (perf, time.time() - start)
-                    start = time.time()
-                perf = "%s %.3f" % (perf, time.time() - start)
-                if self.zerovm_perf:
-                    self.logger.info("PERF EXEC: %s" % perf)
-                return get_final_status(stdout_data, stderr_data)
+                result = get_final_status(stdout_data, stderr_data)
+                if timer:
+                    timer.mark('run')
+                return result
         except (Exception, Timeout):
             proc.terminate()
             try:
@@ -366,7 +1461,179 @@ class ObjectQueryMiddleware(object):
                 proc.kill()
                 return get_final_status(stdout_data, stderr_data, 3)
 
-    def _extract_boot_file(self, channels, boot_file, image, zerovm_tmp):
+    def _spool_file(self, path, size, data_iter, threadpool, checksum=None):
+        """
+        Writes tar member data to a file, space for it is reserved upfront
+
+        Data is received on the hub, written and hashed in the threadpool.
+        """
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+        try:
+            if size > 0:
+                threadpool.run_in_thread(fallocate, fd, size)
+            for data in data_iter:
+                threadpool.run_in_thread(_write_chunk, fd, data, checksum)
+        finally:
+            os.close(fd)
+
+    def _get_upload_devices(self, config, local_path):
+        """
+        Returns names of tar members the proxy sends for the config
+        and names of the ones zerovm can read from a FIFO
+        """
+        upload_devices = set()
+        sequential_devices = set()
+        if is_swift_path(parse_location(config['exe'])):
+            upload_devices.add('boot')
+        for ch in config['channels']:
+            if not ch['access'] & (ACCESS_READABLE | ACCESS_CDR) \
+                    or self.parser.is_sysimage_device(ch['device']):
+                continue
+            chan_path = parse_location(ch['path'])
+            if not chan_path:
+                # user image is sent to all nodes
+                if ch['device'] != 'image':
+                    continue
+            elif not is_swift_path(chan_path) or (local_path and chan_path.url in local_path):
+                continue
+            upload_devices.add(ch['device'])
+            if not ch['access'] & (ACCESS_CDR | ACCESS_RANDOM) \
+                    and CHANNEL_TYPE_MAP.get(ch['device']) == 0:
+                sequential_devices.add(ch['device'])
+        return upload_devices, sequential_devices
+
+    def _get_local_disk_file(self, req, device, partition, account, container, obj, ch):
+        """
+        Returns DiskFile of the local object, opened if the channel reads it
+
+        :returns tuple of DiskFile and error response, one of them is None
+        """
+        try:
+            disk_file = self.get_disk_file(device, partition,
+                                           account, container, obj)
+        except DiskFileDeviceUnavailable:
+            return None, HTTPInsufficientStorage(drive=device, request=req)
+        if ch['access'] & (ACCESS_READABLE | ACCESS_CDR):
+            try:
+                disk_file.open()
+            except DiskFileNotExist:
+                return None, HTTPNotFound(request=req)
+        return disk_file, None
+
+    def _create_output_file(self, device, ch):
+        """Creates temporary file for a writable channel, with space reserved for its size hint"""
+        writable_tmpdir = os.path.join(self._diskfile_mgr.devices, device, 'tmp')
+        if not os.path.exists(writable_tmpdir):
+            mkdirs(writable_tmpdir)
+        (output_fd, output_fn) = mkstemp(dir=writable_tmpdir)
+        try:
+            size_hint = self._get_size_hint(ch)
+            if size_hint:
+                self.get_threadpool(device).run_in_thread(fallocate, output_fd, size_hint)
+        finally:
+            os.close(output_fd)
+        return output_fn
+
+    def _prepare_early(self, early, req, config, device, partition, account, container, obj,
+                       local_path, zerovm_tmp, daemon_sock):
+        """
+        Prepares session from its sysmap while the rest of the upload is received
+
+        Everything done here is redone by the session if it is not done,
+        so any step can be skipped or fail.
+        """
+        exe_path = parse_location(config['exe'])
+        if is_image_path(exe_path) and not daemon_sock and not early.cancelled:
+            sysimage_path = self.parser.get_sysimage(exe_path.image)
+            if sysimage_path:
+                boot = {}
+                # uploaded executable, if any, is still written to "boot"
+                if self._extract_boot_file(boot, exe_path.path, sysimage_path, zerovm_tmp,
+                                           cache=self._get_boot_cache(device),
+                                           index=self.parser.get_sysimage_index(exe_path.image),
+                                           name='sysimage-boot', threadpool=self.get_threadpool(device)):
+                    early.boot = boot['boot']
+        for ch in config['channels']:
+            if early.cancelled:
+                return
+            if self.parser.is_sysimage_device(ch['device']):
+                continue
+            chan_path = parse_location(ch['path'])
+            if local_path and chan_path and chan_path.url in local_path and not early.disk_files:
+                early.disk_files[ch['device']] = \
+                    self._get_local_disk_file(req, device, partition, account, container, obj, ch)
+            if ch['access'] & ACCESS_WRITABLE and not ch['access'] & (ACCESS_READABLE | ACCESS_CDR):
+                size_hint = self._get_size_hint(ch)
+                if not self._has_tmp_space(device, size_hint):
+                    continue
+                early.outputs[ch['device']] = self._create_output_file(device, ch)
+                early.reserved_size += size_hint
+
+    def _get_size_hint(self, ch):
+        return min(int(ch.get('size_hint') or 0), self.parser_config['limits']['wbytes'])
+
+    def _has_tmp_space(self, device, size):
+        """
+        Checks that size bytes can be reserved on the device and at least
+        `zerovm_tmp_reserve` bytes stay free after that
+        """
+        try:
+            st = os.statvfs(os.path.join(self._diskfile_mgr.devices, device))
+        except OSError:
+            return True
+        return st.f_bavail * st.f_frsize - size >= self.zerovm_tmp_reserve
+
+    def _get_boot_cache(self, device):
+        if self.zerovm_bootcache_size <= 0:
+            return None
+        cache = self.boot_caches.get(device)
+        if not cache:
+            cache_dir = os.path.join(self._diskfile_mgr.devices, device, 'tmp', 'zvm-bootcache')
+            cache = BootFileCache(cache_dir, self.zerovm_bootcache_size,
+                                  os_interface=self.os_interface)
+            self.boot_caches[device] = cache
+        return cache
+
+    def _extract_boot_file(self, channels, boot_file, image, zerovm_tmp, cache=None, index=None,
+                           name='boot', threadpool=None):
+        boot_path = os.path.join(zerovm_tmp, name)
+        key = None
+        if cache:
+            try:
+                key = cache.get_key(image, boot_file)
+            except OSError:
+                return False
+            if cache.get(key, boot_path):
+                self.logger.increment('zap_bootcache_hit')
+                channels['boot'] = boot_path
+                return True
+            self.logger.increment('zap_bootcache_miss')
+        if index and not index.lookup(boot_file):
+            index = None
+        # copy from the image is the only part that reads much data
+        if threadpool:
+            copied = threadpool.run_in_thread(self._copy_boot_file, boot_file, image, index, boot_path)
+        else:
+            copied = self._copy_boot_file(boot_file, image, index, boot_path)
+        if not copied:
+            return False
+        channels['boot'] = boot_path
+        if key:
+            cache.put(key, boot_path)
+        return True
+
+    def _copy_boot_file(self, boot_file, image, index, boot_path):
+        """Copies executable out of the tar image, through the index if it has the member"""
+        if index:
+            try:
+                fp = open(boot_path, 'wb')
+                try:
+                    index.copy_member(boot_file, fp, self.app.disk_chunk_size)
+                finally:
+                    fp.close()
+            except IOError:
+                return False
+            return True
         tar = tarfile.open(name=image)
         nexe = None
         try:
@@ -374,10 +1641,10 @@ class ObjectQueryMiddleware(object):
         except KeyError:
             pass
         if not nexe:
+            tar.close()
             return False
         try:
-            channels['boot'] = os.path.join(zerovm_tmp, 'boot')
-            fp = open(channels['boot'], 'wb')
+            fp = open(boot_path, 'wb')
             reader = iter(lambda: nexe.read(self.app.disk_chunk_size), '')
             for chunk in reader:
                 fp.write(chunk)
@@ -440,7 +1707,7 @@ class ObjectQueryMiddleware(object):
             std.close()
 
     def _create_zerovm_thread(self, zerovm_inputmnfst, zerovm_inputmnfst_fd,
-                              zerovm_inputmnfst_fn, zerovm_valid, thrdpool):
+                              zerovm_inputmnfst_fn, zerovm_valid, thrdpool, timer=None):
         while zerovm_inputmnfst:
             written = self.os_interface.write(zerovm_inputmnfst_fd,
                                               zerovm_inputmnfst)
@@ -448,7 +1715,10 @@ class ObjectQueryMiddleware(object):
         zerovm_args = None
         if zerovm_valid:
             zerovm_args = ['-s']
-        thrd = thrdpool.spawn(self.execute_zerovm, zerovm_inputmnfst_fn, zerovm_args)
+        thrd = thrdpool.spawn(self.execute_zerovm, zerovm_inputmnfst_fn, zerovm_args, timer)
+        if timer:
+            # spawn returns when the pool has a free slot
+            timer.mark('queue_wait')
         return thrd
 
     def _create_exec_error(self, nexe_headers, zerovm_retcode, zerovm_stdout):
@@ -465,10 +1735,26 @@ class ObjectQueryMiddleware(object):
     def zerovm_query(self, req):
         """Handle zerovm execution requests for the Swift Object Server."""
 
+        if self.zerovm_stream_output \
+                and req.headers.get('x-zerovm-stream', 'false').lower() in TRUE_VALUES:
+            stream = OutputStream(self.app.network_chunk_size, self.zerovm_stream_interval)
+            return stream.run(self._daemon_query, req, stream)
+        return self._daemon_query(req, None)
+
+    def _daemon_query(self, req, stream):
+        daemon_uuid = req.headers.get('x-zerovm-daemon', None)
+        if not daemon_uuid:
+            return self._zerovm_query(req, None, stream)
+        daemon_sock = req.environ.get('zerovm.daemon_socket') \
+            or self.select_daemon_socket(daemon_uuid)
+        self.daemon_load[daemon_sock] = self.daemon_load.get(daemon_sock, 0) + 1
+        try:
+            return self._zerovm_query(req, daemon_sock, stream)
+        finally:
+            self.daemon_load[daemon_sock] -= 1
+
+    def _zerovm_query(self, req, daemon_sock, stream=None):
         debug_dir = self._debug_init(req)
-        daemon_sock = req.headers.get('x-zerovm-daemon', None)
-        if daemon_sock:
-            daemon_sock = os.path.join(self.zerovm_sockets_dir, daemon_sock)
         #print "URL: " + req.url
         nexe_headers = {
             'x-nexe-retcode': 0,
@@ -515,37 +1801,59 @@ class ObjectQueryMiddleware(object):
                                   content_type='text/plain', headers=nexe_headers)
 
         pool = req.headers.get('x-zerovm-pool', 'default').lower()
-        (thrdpool, queue) = self.zerovm_threadpools.get(pool, None)
+        (thrdpool, queue) = self.zerovm_threadpools.get(pool, (None, None))
         if not thrdpool:
             return HTTPBadRequest(body='Cannot find pool %s' % pool,
                                   request=req, content_type='text/plain',
                                   headers=nexe_headers)
+        # slots are shared fairly between accounts
+        thrdpool = AccountPool(thrdpool, req.headers.get('x-account-name', account))
+        # sessions of the account are queued earliest deadline first
+        deadline = req.headers.get('x-zerovm-deadline')
+        if deadline:
+            if not check_float(deadline):
+                return HTTPBadRequest(body='Invalid x-zerovm-deadline',
+                                      request=req, content_type='text/plain',
+                                      headers=nexe_headers)
+            thrdpool.deadline = float(deadline)
+        timer = PhaseTimer(self.session_metrics, pool, thrdpool.account)
         # early reject for "threadpool is full"
         # checked again below, when the request is received
-        if thrdpool.free() <= 0 and thrdpool.waiting() >= queue:
+        if not thrdpool.can_admit(queue):
+            self.logger.increment('zap_pool_rejected')
             return HTTPServiceUnavailable(body='Slot not available',
                                           request=req, content_type='text/plain',
                                           headers=nexe_headers)
+        error = self._check_deadline(req, thrdpool, nexe_headers)
+        if error:
+            return error
         #holder = thrdpool.spawn(self._placeholder)
         zerovm_valid = False
         if req.headers.get('x-zerovm-valid', 'false').lower() in TRUE_VALUES:
             zerovm_valid = True
-        tmpdir = TmpDir(
-            self._diskfile_mgr.devices,
-            device,
-            disk_chunk_size=self.app.disk_chunk_size,
-            os_interface=self.os_interface
-        )
+        tmpdir = self.get_tmpdir(device)
         disk_file = None
         start = time.time()
         channels = {}
-        with tmpdir.mkdtemp() as zerovm_tmp:
+        local_path = None
+        if not zerovm_execute_only:
+            local_path = SwiftPath.init(account, container, obj).url
+        with tmpdir.mkdtemp() as zerovm_tmp, tmpdir.mkdtemp(scratch=True) as zerovm_scratch, \
+                _finished_on_exit() as jobs:
             read_iter = iter(lambda: req.body_file.read(self.app.network_chunk_size), '')
             upload_expiration = time.time() + self.app.max_upload_time
             untar_stream = UntarStream(read_iter)
-            perf = "%.3f" % (time.time() - start)
-            for chunk in read_iter:
-                perf = "%s %.3f" % (perf, time.time() - start)
+            # (member name, size, time when member was received)
+            perf = [('start', 0, time.time())]
+            sysmap = []
+            config = None
+            # members expected in the upload, known if sysmap is received first
+            upload_devices = None
+            feeder = None
+            early = None
+            boot_checksum = None
+
+            def check_upload():
                 if req.body_file.position > self.parser_config['limits']['rbytes']:
                     return HTTPRequestEntityTooLarge(body='RPC request too large',
                                                      request=req,
@@ -553,83 +1861,167 @@ class ObjectQueryMiddleware(object):
                                                      headers=nexe_headers)
                 if time.time() > upload_expiration:
                     return HTTPRequestTimeout(request=req, headers=nexe_headers)
+
+            for chunk in read_iter:
+                error = check_upload()
+                if error:
+                    return error
                 untar_stream.update_buffer(chunk)
                 info = untar_stream.get_next_tarinfo()
                 while info:
                     if info.offset_data:
-                        channels[info.name] = os.path.join(zerovm_tmp, info.name)
-                        fp = open(channels[info.name], 'ab')
                         untar_stream.to_write = info.size
                         untar_stream.offset_data = info.offset_data
-                        for data in untar_stream.untar_file_iter():
-                            fp.write(data)
-                            perf = "%s %s:%.3f" % (perf, info.name, time.time() - start)
-                        fp.close()
+                        if info.name == 'sysmap':
+                            # system map is parsed right away, no need to write it to disk
+                            sysmap.append(untar_stream.read_file())
+                            if not channels and (self.zerovm_pipeline or self.zerovm_early_prepare):
+                                try:
+                                    config = json.loads(''.join(sysmap))
+                                    if self.zerovm_pipeline and not daemon_sock:
+                                        upload_devices, sequential_devices = \
+                                            self._get_upload_devices(config, local_path)
+                                except Exception:
+                                    config = None
+                                if config and self.zerovm_early_prepare:
+                                    # rest of the upload is received while the session is prepared,
+                                    # account that cannot be admitted yet is checked again after the upload
+                                    thrdpool.cost = self.parser.get_memory(config)
+                                    if thrdpool.reserve(queue):
+                                        early = EarlyPreparation(thrdpool, self.logger, self._prepare_early,
+                                                                 req, config, device, partition, account,
+                                                                 container, obj, local_path, zerovm_tmp,
+                                                                 daemon_sock)
+                                        jobs.append(early)
+                        elif upload_devices and info.name in sequential_devices \
+                                and upload_devices.difference(channels) == set([info.name]):
+                            # the last member is fed to zerovm while it is being uploaded
+                            channels[info.name] = os.path.join(zerovm_tmp, info.name)
+                            os.mkfifo(channels[info.name])
+                            feeder = FifoFeeder(channels[info.name], untar_stream.untar_file_iter(),
+                                                read_iter, check_upload)
+                            jobs.append(feeder)
+                            self.logger.increment('zap_pipelined')
+                            break
+                        else:
+                            if zerovm_scratch and _is_scratch_channel(config, info.name) \
+                                    and tmpdir.fits_scratch(info.size):
+                                channels[info.name] = os.path.join(zerovm_scratch, info.name)
+                            else:
+                                channels[info.name] = os.path.join(zerovm_tmp, info.name)
+                            checksum = None
+                            if info.name == 'boot' and self.validation_store:
+                                # executable is hashed on the way to disk, to look it up in validation store
+                                checksum = boot_checksum = sha256()
+                            try:
+                                self._spool_file(channels[info.name], info.size,
+                                                 untar_stream.untar_file_iter(),
+                                                 self.get_threadpool(device), checksum=checksum)
+                            except OSError, e:
+                                if e.errno in (errno.ENOSPC, errno.EDQUOT):
+                                    return HTTPInsufficientStorage(drive=device, request=req)
+                                raise
+                        perf.append((info.name, info.size, time.time()))
                     info = untar_stream.get_next_tarinfo()
-            if 'content-length' in req.headers\
+                if feeder:
+                    break
+            if not feeder and 'content-length' in req.headers\
                     and int(req.headers['content-length']) != req.body_file.position:
                 self.logger.warning('Client disconnect %s != %d : %s' % (req.headers['content-length'],
                                                                          req.body_file.position,
                                                                          str(req.headers)))
                 return HTTPClientDisconnect(request=req,
                                             headers=nexe_headers)
-            perf = "%s %.3f" % (perf, time.time() - start)
+            perf.append(('end', req.body_file.position, time.time()))
+            timer.mark('upload')
+            self.logger.timing('zap_upload_time', (perf[-1][2] - perf[0][2]) * 1000)
             if self.zerovm_perf:
-                self.logger.info("PERF UNTAR: %s" % perf)
-            if 'sysmap' in channels:
-                config_file = channels.pop('sysmap')
-                fp = open(config_file, 'rb')
-                try:
-                    config = json.load(fp)
-                except Exception:
-                    fp.close()
+                self.logger.info("PERF UNTAR: %s"
+                                 % ' '.join(['%s:%d:%.3f' % (name, size, t - perf[0][2])
+                                             for name, size, t in perf]))
+            if early:
+                early.wait()
+            if config is None:
+                if sysmap:
+                    try:
+                        config = json.loads(''.join(sysmap))
+                    except Exception:
+                        return HTTPBadRequest(request=req,
+                                              body='Cannot parse system map')
+                else:
                     return HTTPBadRequest(request=req,
-                                          body='Cannot parse system map')
-                fp.close()
-            else:
-                return HTTPBadRequest(request=req,
-                                      body='No system map found in request')
+                                          body='No system map found in request')
 
+            timer.mark('sysmap_parse')
             nexe_headers['x-nexe-system'] = config.get('name', '')
+            thrdpool.cost = self.parser.get_memory(config)
             #print json.dumps(config, cls=NodeEncoder, indent=2)
             zerovm_nexe = None
             exe_path = parse_location(config['exe'])
             if is_image_path(exe_path):
                 if exe_path.image in channels:
-                    self._extract_boot_file(channels, exe_path.path, channels[exe_path.image], zerovm_tmp)
+                    self._extract_boot_file(channels, exe_path.path, channels[exe_path.image], zerovm_tmp,
+                                            threadpool=self.get_threadpool(device))
+                elif early and early.boot:
+                    channels['boot'] = early.boot
+                    zerovm_valid = True
                 elif not daemon_sock:
                     sysimage_path = self.parser.get_sysimage(exe_path.image)
                     if sysimage_path:
-                        if self._extract_boot_file(channels, exe_path.path, sysimage_path, zerovm_tmp):
+                        if self._extract_boot_file(channels, exe_path.path, sysimage_path, zerovm_tmp,
+                                                   cache=self._get_boot_cache(device),
+                                                   index=self.parser.get_sysimage_index(exe_path.image),
+                                                   threadpool=self.get_threadpool(device)):
                             zerovm_valid = True
+            boot_key = None
+            if boot_checksum and 'boot' in channels:
+                boot_key = boot_checksum.hexdigest()
+                if not zerovm_valid \
+                        and self.validation_store.is_valid(boot_key, cache_from_env(req.environ)):
+                    zerovm_valid = True
+                    boot_key = None
             if 'boot' in channels:
                 zerovm_nexe = channels.pop('boot')
             elif not daemon_sock:
                 return HTTPBadRequest(request=req,
                                       body='No executable found in request')
+            # output files grow on demand, space is reserved only for size hints
+            # session is rejected if its reservations do not fit on the device
+            reserved_size = 0
+            for ch in config['channels']:
+                if ch['access'] & ACCESS_WRITABLE \
+                        and not ch['access'] & (ACCESS_READABLE | ACCESS_CDR) \
+                        and not self.parser.is_sysimage_device(ch['device']):
+                    reserved_size += self._get_size_hint(ch)
+            if early:
+                # already allocated by early preparation
+                reserved_size -= early.reserved_size
+            if not self._has_tmp_space(device, reserved_size):
+                self.logger.increment('zap_space_rejected')
+                return HTTPServiceUnavailable(body='Not enough space for session output',
+                                              request=req, content_type='text/plain',
+                                              headers=nexe_headers)
             is_master = True
             if config.get('replicate', 1) > 1 and len(config.get('replicas', [])) < (config.get('replicate', 1) - 1):
                 is_master = False
             response_channels = []
             local_object = {}
-            if not zerovm_execute_only:
-                local_object['path'] = SwiftPath.init(account, container, obj).url
+            if local_path:
+                local_object['path'] = local_path
             for ch in config['channels']:
                 chan_path = parse_location(ch['path'])
                 if ch['device'] in channels:
                     ch['lpath'] = channels[ch['device']]
                 elif local_object and chan_path:
                     if chan_path.url in local_object['path']:
-                        try:
-                            disk_file = self.get_disk_file(device, partition,
-                                                           account, container, obj)
-                        except DiskFileDeviceUnavailable:
-                            return HTTPInsufficientStorage(drive=device, request=req)
+                        if early and ch['device'] in early.disk_files:
+                            disk_file, error = early.disk_files.pop(ch['device'])
+                        else:
+                            disk_file, error = self._get_local_disk_file(req, device, partition,
+                                                                         account, container, obj, ch)
+                        if error:
+                            return error
                         if ch['access'] & (ACCESS_READABLE | ACCESS_CDR):
-                            try:
-                                disk_file.open()
-                            except DiskFileNotExist:
-                                return HTTPNotFound(request=req)
                             meta = disk_file.get_metadata()
                             input_file_size = int(meta['Content-Length'])
                             if input_file_size > self.parser_config['limits']['rbytes']:
@@ -660,12 +2052,11 @@ class ObjectQueryMiddleware(object):
                                                   body='Could not resolve channel path: %s'
                                                        % ch['path'])
                 elif ch['access'] & ACCESS_WRITABLE:
-                    writable_tmpdir = os.path.join(self._diskfile_mgr.devices, device, 'tmp')
-                    if not os.path.exists(writable_tmpdir):
-                        mkdirs(writable_tmpdir)
-                    (output_fd, output_fn) = mkstemp(dir=writable_tmpdir)
-                    fallocate(output_fd, self.parser_config['limits']['wbytes'])
-                    os.close(output_fd)
+                    output_fn = None
+                    if early:
+                        output_fn = early.outputs.pop(ch['device'], None)
+                    if not output_fn:
+                        output_fn = self._create_output_file(device, ch)
                     ch['lpath'] = output_fn
                     channels[ch['device']] = output_fn
                     if is_master:
@@ -675,11 +2066,17 @@ class ObjectQueryMiddleware(object):
                             response_channels.insert(0, ch)
                 elif ch['access'] & ACCESS_NETWORK:
                     ch['lpath'] = chan_path.path
-
-            with tmpdir.mkstemp() as (zerovm_inputmnfst_fd,
-                                      zerovm_inputmnfst_fn):
-                (output_fd, nvram_file) = mkstemp()
-                os.close(output_fd)
+            # only a plain immediate response is streamed, other outputs
+            # are finalized or parsed after zerovm exits
+            stream_ch = None
+            if stream and len(response_channels) == 1 and not response_channels[0]['path'] \
+                    and not response_channels[0]['content_type'].startswith(('message/http', 'message/cgi')) \
+                    and not (local_object and local_object.get('access', 0) & ACCESS_WRITABLE):
+                stream_ch = response_channels[0]
+
+            timer.mark('channel_resolution')
+            with tmpdir.mkstemp() as (zerovm_inputmnfst_fd, zerovm_inputmnfst_fn), \
+                    tmpdir.mkstemp() as (nvram_fd, nvram_file):
                 zerovm_inputmnfst = self.parser.prepare_zerovm_files(config,
                                                                      nvram_file,
                                                                      local_object,
@@ -689,25 +2086,35 @@ class ObjectQueryMiddleware(object):
                 #print zerovm_inputmnfst
                 #print open(nvram_file).read()
                 #holder.kill()
-                if thrdpool.free() <= 0 and thrdpool.waiting() >= queue:
+                if not thrdpool.can_admit(queue):
+                    self.logger.increment('zap_pool_rejected')
                     return HTTPServiceUnavailable(body='Slot not available',
                                                   request=req, content_type='text/plain',
                                                   headers=nexe_headers)
+                error = self._check_deadline(req, thrdpool, nexe_headers)
+                if error:
+                    return error
                 self._debug_before_exec(config, debug_dir, nexe_headers, nvram_file, zerovm_inputmnfst)
+                timer.mark('manifest_build')
                 start = time.time()
                 daemon_status = None
                 if daemon_sock:
                     sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
                     try:
                         sock.connect(daemon_sock)
+                        self.daemons.register(daemon_sock, sock)
                         thrd = thrdpool.spawn(self.send_to_socket, sock, zerovm_inputmnfst)
+                        timer.mark('queue_wait')
                     except IOError:
-                        self._cleanup_daemon(daemon_sock)
+                        self.daemons.cleanup(daemon_sock)
                         sysimage_path = self.parser.get_sysimage(exe_path.image)
                         if not sysimage_path:
                             return HTTPInternalServerError(body='System image does not exist: %s'
                                                                 % exe_path.image)
-                        if not self._extract_boot_file(channels, exe_path.path, sysimage_path, zerovm_tmp):
+                        if not self._extract_boot_file(channels, exe_path.path, sysimage_path, zerovm_tmp,
+                                                       cache=self._get_boot_cache(device),
+                                                       index=self.parser.get_sysimage_index(exe_path.image),
+                                                       threadpool=self.get_threadpool(device)):
                             return HTTPInternalServerError(body='Cannot find daemon nexe in system image %s'
                                                                 % sysimage_path)
                         zerovm_nexe = channels.pop('boot')
@@ -720,6 +2127,8 @@ class ObjectQueryMiddleware(object):
                                                           zerovm_inputmnfst_fd, zerovm_inputmnfst_fn,
                                                           zerovm_valid, thrdpool)
                         (zerovm_retcode, zerovm_stdout, zerovm_stderr) = thrd.wait()
+                        # daemon start counts as spawn of this session
+                        timer.mark('spawn')
                         self._debug_after_exec(debug_dir, nexe_headers, zerovm_retcode, zerovm_stderr, zerovm_stdout)
                         if zerovm_stderr:
                             self.logger.warning('zerovm stderr: '+zerovm_stderr)
@@ -739,7 +2148,9 @@ class ObjectQueryMiddleware(object):
                             return HTTPInternalServerError(body=zerovm_stdout)
                         try:
                             sock.connect(daemon_sock)
+                            self.daemons.register(daemon_sock, sock)
                             thrd = thrdpool.spawn(self.send_to_socket, sock, zerovm_inputmnfst)
+                            timer.mark('queue_wait')
                         except IOError:
                             return HTTPInternalServerError(body='Cannot connect to daemon even after daemon restart: '
                                                                 'socket %s' % daemon_sock,
@@ -747,19 +2158,30 @@ class ObjectQueryMiddleware(object):
                 else:
                     thrd = self._create_zerovm_thread(zerovm_inputmnfst,
                                                       zerovm_inputmnfst_fd, zerovm_inputmnfst_fn,
-                                                      zerovm_valid, thrdpool)
+                                                      zerovm_valid, thrdpool, timer)
+                if stream_ch:
+                    stream.start(Response(request=req, content_type='application/x-gtar',
+                                          headers={'x-zerovm-stream': 'true',
+                                                   'x-nexe-system': nexe_headers['x-nexe-system'],
+                                                   'x-nexe-status': 'Running'}))
+                    self.logger.increment('zap_streamed')
+                    stream.follow(stream_ch['device'], stream_ch['lpath'], thrd)
                 (zerovm_retcode, zerovm_stdout, zerovm_stderr) = thrd.wait()
+                if daemon_sock:
+                    timer.mark('run')
+                if feeder:
+                    error = feeder.finish()
+                    if not error and 'content-length' in req.headers \
+                            and int(req.headers['content-length']) != req.body_file.position:
+                        error = HTTPClientDisconnect(request=req, headers=nexe_headers)
+                    if error:
+                        _channel_cleanup(response_channels)
+                        return error
                 perf = "%.3f" % (time.time() - start)
                 if self.zerovm_perf:
                     self.logger.info("PERF SPAWN: %s" % perf)
-                self.logger.error("WILK: zap_server_time: %s" % int(float(perf) * 1000))
                 self.logger.timing("zap_server_time", int(float(perf) * 1000))
                 self._debug_after_exec(debug_dir, nexe_headers, zerovm_retcode, zerovm_stderr, zerovm_stdout)
-                if nvram_file:
-                    try:
-                        os.unlink(nvram_file)
-                    except OSError:
-                        pass
                 if zerovm_stderr:
                     self.logger.warning('zerovm stderr: '+zerovm_stderr)
                     zerovm_stdout += zerovm_stderr
@@ -784,6 +2206,10 @@ class ObjectQueryMiddleware(object):
                     _channel_cleanup(response_channels)
                     self.logger.increment("zap_failed_execution")
                     return req.get_response(resp)
+                timer.mark('report_parse')
+                if boot_key and not zerovm_valid and nexe_headers['x-nexe-validation'] == 0:
+                    # executable passed validation in this session
+                    self.validation_store.set_valid(boot_key, cache_from_env(req.environ))
 
                 self.logger.info('Zerovm CDR: %s' % nexe_headers['x-nexe-cdr-line'])
                 try:
@@ -806,11 +2232,9 @@ class ObjectQueryMiddleware(object):
                                      "zap_writes_to_network",
                                      "zap_bytes_written_to_network"]
                     for name, value in zip(timer_names, timers):
-                        self.logger.error("WILK: %s: %s" % (name, int(float(value.strip(",")) * 1000)))
                         self.logger.timing(name,
                                            int(float(value.strip(",")) * 1000))
                     for name, value in zip(counter_names, counters):
-                        self.logger.error("WILK: %s: %s" % (name, int(value.strip(","))))
                         self.logger.update_stats(name, int(value.strip(",")))
                 except:
                     # never fail on statsd things
@@ -824,6 +2248,11 @@ class ObjectQueryMiddleware(object):
                 response.content_type = 'application/x-gtar'
                 if daemon_status == 1:
                     response.headers['x-zerovm-daemon'] = req.headers.get('x-zerovm-daemon', None)
+                if stream_ch:
+                    # output is already sent, headers go to the report
+                    _channel_cleanup(response_channels)
+                    timer.mark('output_finalize')
+                    return response
                 tar_stream = TarStream()
                 resp_size = 0
                 immediate_responses = []
@@ -870,6 +2299,15 @@ class ObjectQueryMiddleware(object):
                                                             size=len(sysmap_dump))
                     resp_size += len(sysmap_info) + TarStream.get_archive_size(len(sysmap_dump))
 
+                client_sock = None
+                if self.zerovm_sendfile:
+                    client_sock = self._get_client_socket(req)
+                    if client_sock:
+                        # we need each chunk to be written to socket before the next one is requested
+                        req.environ['eventlet.minimum_write_chunk_size'] = 0
+
+                threadpool = self.get_threadpool(device)
+
                 def resp_iter(channels, chunk_size):
                     tstream = TarStream(chunk_size=chunk_size)
                     if send_config:
@@ -883,29 +2321,71 @@ class ObjectQueryMiddleware(object):
                             for chunk in tstream.serve_chunk(nulls):
                                 yield chunk
                     for ch in channels:
-                        fp = open(ch['lpath'], 'rb')
-                        if ch.get('offset', None):
-                            fp.seek(ch['offset'])
-                        reader = iter(lambda: fp.read(chunk_size), '')
                         for chunk in tstream.serve_chunk(ch['info']):
                             yield chunk
-                        for data in reader:
-                            for chunk in tstream.serve_chunk(data):
-                                yield chunk
-                        fp.close()
+                        if client_sock and ch['size'] > 0:
+                            if tstream.buffer_len:
+                                yield tstream.flush()
+                            self._sendfile_channel(client_sock, ch)
+                        else:
+                            fp = open(ch['lpath'], 'rb')
+                            if ch.get('offset', None):
+                                fp.seek(ch['offset'])
+                            reader = iter(lambda: threadpool.run_in_thread(fp.read, chunk_size), '')
+                            for data in reader:
+                                for chunk in tstream.serve_chunk(data):
+                                    yield chunk
+                            fp.close()
                         os.unlink(ch['lpath'])
                         blocks, remainder = divmod(ch['size'], BLOCKSIZE)
                         if remainder > 0:
                             nulls = NUL * (BLOCKSIZE - remainder)
                             for chunk in tstream.serve_chunk(nulls):
                                 yield chunk
-                    if tstream.data:
-                        yield tstream.data
+                    if tstream.buffer_len:
+                        yield tstream.flush()
+                    timer.mark('response_stream')
 
+                timer.mark('output_finalize')
                 response.app_iter = resp_iter(immediate_responses, self.app.network_chunk_size)
                 response.content_length = resp_size
                 return req.get_response(response)
 
+    def _get_client_socket(self, req):
+        get_socket = getattr(req.environ.get('wsgi.input'), 'get_socket', None)
+        if not get_socket:
+            return None
+        try:
+            sock = get_socket()
+        except AttributeError:
+            return None
+        # no sendfile for encrypted connections
+        if not hasattr(sock, 'fileno') or hasattr(sock, 'getpeercert'):
+            return None
+        return sock
+
+    def _sendfile_channel(self, sock, ch):
+        fd = os.open(ch['lpath'], os.O_RDONLY)
+        try:
+            out_fd = sock.fileno()
+            offset = ch.get('offset', None) or 0
+            remaining = ch['size']
+            while remaining > 0:
+                try:
+                    sent = sendfile(out_fd, fd, offset, remaining)
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                    trampoline(out_fd, write=True, timeout=sock.gettimeout(),
+                               timeout_exc=socket.timeout('timed out'))
+                    continue
+                if not sent:
+                    raise IOError('Unexpected end of file %s' % ch['lpath'])
+                offset += sent
+                remaining -= sent
+        finally:
+            os.close(fd)
+
     def _read_cgi_response(self, ch, nph=True):
         if nph:
             fp = open(ch['lpath'], 'rb')
@@ -938,10 +2418,16 @@ class ObjectQueryMiddleware(object):
     def __call__(self, env, start_response):
         """WSGI Application entry point for the Swift Object Server."""
         start_time = time.time()
+        if self.zerovm_daemons and not self.daemon_supervisor:
+            # started here and not in __init__, so it runs in each forked worker
+            self.daemon_supervisor = spawn(self._supervise_daemons)
         req = Request(env)
         self.logger.txn_id = req.headers.get('x-trans-id', None)
         if not check_utf8(req.path_info):
             res = HTTPPreconditionFailed(body='Invalid UTF8')
+        elif self.session_metrics and req.method == 'GET' and req.path == self.zerovm_metrics_path:
+            return Response(body=self.session_metrics.render(),
+                            content_type='text/plain; version=0.0.4')(env, start_response)
         else:
             try:
                 if 'x-zerovm-execute' in req.headers and req.method == 'POST':
@@ -956,8 +2442,12 @@ class ObjectQueryMiddleware(object):
 
                     def validate_resp(status, response_headers, exc_info=None):
                         if 200 <= int(status.split(' ')[0]) < 300:
-                            if self.validate(req):
-                                response_headers.append(('X-Zerovm-Valid', 'true'))
+                            if req.headers.get('x-zerovm-validate', '').lower() == 'sync':
+                                # client waits for the result
+                                if self.validate(req):
+                                    response_headers.append(('X-Zerovm-Valid', 'true'))
+                            else:
+                                self.validate_in_background(req)
                         return start_response(status, response_headers, exc_info)
 
                     return self.app(env, validate_resp)
@@ -997,7 +2487,28 @@ class ObjectQueryMiddleware(object):
 
         return res(env, start_response)
 
-    def validate(self, req):
+    def validate_in_background(self, req):
+        """
+        Queues validation of the uploaded executable, `Validated` metadata is set when it is done
+
+        Uploads are not validated if the queue is full, they will be validated on execution.
+        """
+        if len(self.validation_jobs) >= self.validation_pool.size + self.zerovm_validation_queue:
+            self.logger.increment('zap_validation_dropped')
+            return None
+        thrd = spawn(self._validate_job, req)
+        self.validation_jobs.add(thrd)
+        thrd.link(self.validation_jobs.discard)
+        return thrd
+
+    def _validate_job(self, req):
+        try:
+            return self.validate(req, pool=self.validation_pool)
+        except (Exception, Timeout):
+            self.logger.exception(_('ERROR validating %s') % req.path)
+            return False
+
+    def validate(self, req, pool=None):
         try:
             (device, partition, account, container, obj) =\
                 split_path(unquote(req.path), 5, 5, True)
@@ -1016,12 +2527,15 @@ class ObjectQueryMiddleware(object):
                 metadata = disk_file.get_metadata()
                 if int(metadata['Content-Length']) > self.zerovm_maxnexe:
                     return False
-                tmpdir = TmpDir(
-                    self._diskfile_mgr.devices,
-                    device,
-                    disk_chunk_size=self.app.disk_chunk_size,
-                    os_interface=self.os_interface
-                )
+                key = None
+                if self.validation_store:
+                    key = self.get_threadpool(device).run_in_thread(self.validation_store.get_key,
+                                                                    disk_file.data_file)
+                    if self.validation_store.is_valid(key, cache_from_env(req.environ)):
+                        metadata['Validated'] = metadata['ETag']
+                        disk_file.put_metadata(metadata)
+                        return True
+                tmpdir = self.get_tmpdir(device)
                 with tmpdir.mkstemp() as (zerovm_inputmnfst_fd, zerovm_inputmnfst_fn):
                     zerovm_inputmnfst = (
                         'Version=%s\n'
@@ -1042,8 +2556,9 @@ class ObjectQueryMiddleware(object):
                                                           zerovm_inputmnfst)
                         zerovm_inputmnfst = zerovm_inputmnfst[written:]
 
-                    (thrdpool, queue) = self.zerovm_threadpools['default']
-                    thrd = thrdpool.spawn(self.execute_zerovm, zerovm_inputmnfst_fn, ['-F'])
+                    if not pool:
+                        (pool, queue) = self.zerovm_threadpools['default']
+                    thrd = pool.spawn(account, self.execute_zerovm, zerovm_inputmnfst_fn, ['-F'])
                     (zerovm_retcode, zerovm_stdout, zerovm_stderr) = thrd.wait()
                     if zerovm_stderr:
                         self.logger.warning('zerovm stderr: ' + zerovm_stderr)
@@ -1057,6 +2572,8 @@ class ObjectQueryMiddleware(object):
                             metadata = disk_file.get_metadata()
                             metadata['Validated'] = metadata['ETag']
                             disk_file.put_metadata(metadata)
+                            if key:
+                                self.validation_store.set_valid(key, cache_from_env(req.environ))
                             return True
                     return False
             except DiskFileNotExist:
@@ -1080,6 +2597,15 @@ class ObjectQueryMiddleware(object):
                 etag = metadata.get('ETag', None)
                 if status and etag and etag == status:
                     return True
+                if self.validation_store and etag \
+                        and int(metadata['Content-Length']) <= self.zerovm_maxnexe:
+                    key = self.get_threadpool(device).run_in_thread(self.validation_store.get_key,
+                                                                    disk_file.data_file)
+                    if self.validation_store.is_valid(key, cache_from_env(req.environ)):
+                        # copy or overwrite of a validated executable
+                        metadata['Validated'] = etag
+                        disk_file.put_metadata(metadata)
+                        return True
                 return False
             except DiskFileNotExist:
                 return False
@@ -1115,33 +2641,19 @@ class ObjectQueryMiddleware(object):
             'ETag': reported_etag,
             'Content-Length': str(local_object['size'])}
         metadata.update(('x-object-meta-' + val[0], val[1]) for val in local_object['meta'].iteritems())
+        try:
+            if local_object.get('offset', None):
+                # CGI header is cut off in place, the file stays on the device
+                metadata['ETag'] = self.get_threadpool(device).run_in_thread(_strip_file_head,
+                                                                            local_object['lpath'],
+                                                                            local_object['offset'])
+            elif local_object['access'] & ACCESS_RANDOM:
+                # need to re-read the file to get correct md5
+                metadata['ETag'] = self.get_threadpool(device).run_in_thread(_md5_file, local_object['lpath'])
+        except (IOError, OSError):
+            return HTTPInternalServerError(body='Cannot read resulting file for device %s'
+                                                % disk_file.channel_device)
         fd = os.open(local_object['lpath'], os.O_RDONLY)
-        if local_object.get('offset', None):
-            # need to re-write the file
-            newfd, new_name = mkstemp()
-            new_etag = md5()
-            try:
-                os.lseek(fd, local_object['offset'], os.SEEK_SET)
-                for chunk in iter(lambda: os.read(fd, self.app.disk_chunk_size), ''):
-                    os.write(newfd, chunk)
-                    new_etag.update(chunk)
-            except IOError:
-                pass
-            os.close(newfd)
-            metadata['ETag'] = new_etag.hexdigest()
-            os.unlink(local_object['lpath'])
-            local_object['lpath'] = new_name
-            fd = os.open(local_object['lpath'], os.O_RDONLY)
-        elif local_object['access'] & ACCESS_RANDOM:
-            # need to re-read the file to get correct md5
-            new_etag = md5()
-            try:
-                for chunk in iter(lambda: os.read(fd, self.app.disk_chunk_size), ''):
-                    new_etag.update(chunk)
-            except IOError:
-                return HTTPInternalServerError(body='Cannot read resulting file for device %s'
-                                                    % disk_file.channel_device)
-            metadata['ETag'] = new_etag.hexdigest()
         disk_file.tmppath = local_object['lpath']
         try:
             with disk_file.create(fd=fd) as writer:
@@ -1166,38 +2678,19 @@ class ObjectQueryMiddleware(object):
             device)
         #disk_file.close()
 
-    def _cleanup_daemon(self, daemon_sock):
-        for pid in self._get_daemon_pid(daemon_sock):
-            try:
-                os.kill(pid, signal.SIGKILL)
-            except OSError:
-                continue
-        try:
-            os.unlink(daemon_sock)
-        except OSError:
-            pass
 
-    def _get_daemon_pid(self, daemon_sock):
-        result = []
-        sock = None
-        for l in open('/proc/net/unix').readlines():
-            m = re.search('(\d+) %s' % daemon_sock, l)
-            if m:
-                sock = m.group(1)
-        if not sock:
-            return []
-        for pid in [f for f in os.listdir('/proc') if re.match('\d+$', f)]:
-            try:
-                for fd in os.listdir('/proc/%s/fd' % pid):
-                    l = os.readlink('/proc/%s/fd/%s' % (pid, fd))
-                    m = re.match(r'socket:\[(\d+)\]', l)
-                    if m and sock in m.group(1):
-                        m = re.match('\d+ \(([^\)]+)', open('/proc/%s/stat' % pid).read())
-                        if 'zerovm.daemon' in m.group(1):
-                            result.append(pid)
-            except OSError:
-                continue
-        return result
+def _is_scratch_channel(config, name):
+    """
+    Checks that uploaded member can be placed in the scratch dir: only channels
+    zerovm just reads, executables and writable channels stay on the device,
+    members uploaded before the sysmap too, as their access is not known yet
+    """
+    if name == 'boot' or not config:
+        return False
+    for ch in config.get('channels', []):
+        if ch.get('device') == name:
+            return not ch.get('access', 0) & (ACCESS_WRITABLE | ACCESS_CDR)
+    return False
 
 
 def _parse_zerovm_report(nexe_headers, report):
@@ -1208,6 +2701,135 @@ def _parse_zerovm_report(nexe_headers, report):
     nexe_headers['x-nexe-status'] = report[REPORT_STATUS].replace('\n', ' ').rstrip()
 
 
+def _write_chunk(fd, data, checksum=None):
+    if checksum:
+        checksum.update(data)
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+def _md5_file(path, chunk_size=FINALIZE_CHUNK_SIZE):
+    """Returns md5 of the file, the file is read through mmap in large chunks"""
+    checksum = md5()
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if size:
+            data = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+            try:
+                for pos in xrange(0, size, chunk_size):
+                    checksum.update(buffer(data, pos, chunk_size))
+            finally:
+                data.close()
+    finally:
+        os.close(fd)
+    return checksum.hexdigest()
+
+
+def _strip_file_head(path, offset, chunk_size=FINALIZE_CHUNK_SIZE):
+    """
+    Removes first offset bytes of the file in place
+
+    Block aligned head is collapsed by the filesystem, otherwise the rest
+    of the data is moved to the start of the same file.
+
+    :returns md5 of the remaining data
+    """
+    wfd = os.open(path, os.O_WRONLY)
+    try:
+        st = os.fstat(wfd)
+        if offset % st.st_blksize == 0 and offset < st.st_size:
+            try:
+                collapse_range(wfd, 0, offset)
+                return _md5_file(path, chunk_size)
+            except OSError:
+                pass
+        checksum = md5()
+        rfd = os.open(path, os.O_RDONLY)
+        try:
+            os.lseek(rfd, offset, os.SEEK_SET)
+            for data in iter(lambda: os.read(rfd, chunk_size), ''):
+                checksum.update(data)
+                while data:
+                    written = os.write(wfd, data)
+                    data = data[written:]
+        finally:
+            os.close(rfd)
+        os.ftruncate(wfd, max(st.st_size - offset, 0))
+        return checksum.hexdigest()
+    finally:
+        os.close(wfd)
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError as exc:
+        if exc.errno == errno.EEXIST:
+            os.unlink(dst)
+            return _link_or_copy(src, dst)
+        if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        # cross-device or no hard links: copy under a temporary name,
+        # so nobody can link a partially copied file
+        fd, tmp_path = mkstemp(dir=os.path.dirname(dst))
+        os.close(fd)
+        try:
+            shutil.copyfile(src, tmp_path)
+            os.rename(tmp_path, dst)
+        except (OSError, IOError):
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+
+def _recv_all(sock, size):
+    data = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            break
+        data.append(chunk)
+        size -= len(chunk)
+    return ''.join(data)
+
+
+def _get_peer_pid(sock):
+    try:
+        creds = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize('3i'))
+    except (IOError, OSError):
+        return None
+    pid, _junk, __junk = struct.unpack('3i', creds)
+    return pid
+
+
+def _get_process_start_time(pid):
+    try:
+        fp = open('/proc/%d/stat' % pid, 'rb')
+        try:
+            stat = fp.read()
+        finally:
+            fp.close()
+    except IOError:
+        return None
+    # process name can contain spaces, start time is 20th field after it
+    return int(stat[stat.rindex(')') + 2:].split()[19])
+
+
+@contextmanager
+def _finished_on_exit():
+    """Yields list of session background jobs, all of them are finished when the session ends"""
+    jobs = []
+    try:
+        yield jobs
+    finally:
+        for job in jobs:
+            job.finish()
+
+
 def _channel_cleanup(response_channels):
     for ch in response_channels:
         try:
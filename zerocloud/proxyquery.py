@@ -17,7 +17,7 @@ from swiftclient.client import quote
 
 from swift import gettext_ as _
 from swift.common.http import HTTP_CONTINUE, is_success, \
-    HTTP_INSUFFICIENT_STORAGE, is_client_error
+    HTTP_INSUFFICIENT_STORAGE, is_client_error, HTTP_SERVICE_UNAVAILABLE
 from swift.proxy.controllers.base import update_headers, delay_denial, \
     cors_validation
 from swift.common.utils import split_path, get_logger, TRUE_VALUES, \
@@ -26,7 +26,7 @@ from swift.proxy.server import ObjectController, ContainerController, \
     AccountController
 from swift.common.bufferedhttp import http_connect
 from swift.common.exceptions import ConnectionTimeout, ChunkReadTimeout
-from swift.common.constraints import check_utf8, MAX_FILE_SIZE
+from swift.common.constraints import check_utf8, check_float, MAX_FILE_SIZE
 from swift.common.swob import Request, Response, HTTPNotFound, \
     HTTPPreconditionFailed, HTTPRequestTimeout, HTTPRequestEntityTooLarge, \
     HTTPBadRequest, HTTPUnprocessableEntity, HTTPServiceUnavailable, \
@@ -34,11 +34,11 @@ from swift.common.swob import Request, Response, HTTPNotFound, \
 from zerocloud.common import ACCESS_READABLE, ACCESS_CDR, ACCESS_WRITABLE, \
     CLUSTER_CONFIG_FILENAME, NODE_CONFIG_FILENAME, TAR_MIMES, \
     POST_TEXT_OBJECT_SYSTEM_MAP, POST_TEXT_ACCOUNT_SYSTEM_MAP, \
-    merge_headers, update_metadata, DEFAULT_EXE_SYSTEM_MAP, STREAM_CACHE_SIZE, \
+    merge_headers, update_metadata, DEFAULT_EXE_SYSTEM_MAP, STREAM_CACHE_SIZE, STREAM_REPORT, \
     ZvmChannel, parse_location, is_swift_path, is_image_path, can_run_as_daemon, SwiftPath, NodeEncoder
 from zerocloud.configparser import ClusterConfigParser, ClusterConfigParsingError
 from zerocloud.tarstream import StringBuffer, UntarStream, \
-    TarStream, REGTYPE, BLOCKSIZE, NUL, ExtractedFile, Path
+    TarStream, REGTYPE, BLOCKSIZE, NUL, ExtractedFile, Path, TarInfo, HeaderError
 
 
 try:
@@ -53,7 +53,7 @@ class CachedBody(object):
                  total_size=None):
         self.read_iter = read_iter
         self.total_size = total_size
-        if cache:
+        if cache is not None:
             self.cache = cache
         else:
             self.cache = []
@@ -90,15 +90,81 @@ class CachedBody(object):
                 yield chunk
 
 
+class StreamedBody(object):
+    """
+    Immediate response channel streamed by object server while the session runs
+
+    Channel data arrives as a sequence of tar members named after the channel,
+    the session report is the last member. Members are passed to the client
+    with names prefixed by the node name, so output of all nodes and their
+    reports can be sent in one tar stream.
+    """
+
+    def __init__(self, untar_stream, info, prefix, on_report):
+        """
+        :param untar_stream: UntarStream of object server response
+        :param info: TarInfo of the first channel member
+        :param prefix: prefix of member names sent to the client
+        :param on_report: called with the report data when it is received,
+                          or with None if the stream is closed before it
+        """
+        self.untar_stream = untar_stream
+        self.info = info
+        self.prefix = prefix
+        self.on_report = on_report
+        self.finished = False
+
+    def __iter__(self):
+        info = self.info
+        while info:
+            self.untar_stream.to_write = info.size
+            self.untar_stream.offset_data = info.offset_data
+            data = self.untar_stream.read_file()
+            if info.name == STREAM_REPORT:
+                self._finish(data)
+                yield _tar_member(self.prefix + info.name, data)
+                return
+            yield _tar_member(self.prefix + info.name, data)
+            info = _next_tarinfo(self.untar_stream)
+        # session failed after the output was started
+        raise IOError('Streamed response ended without report')
+
+    def close(self):
+        # client is gone or the object server connection failed
+        self._finish(None)
+
+    def _finish(self, data):
+        if not self.finished:
+            self.finished = True
+            self.on_report(data)
+
+
 class FinalBody(object):
 
     def __init__(self, app_iter):
         self.app_iters = [app_iter]
+        # called when the whole body is sent or the client is gone
+        self.callbacks = []
+        # sent after all the bodies
+        self.trailer = ''
 
     def __iter__(self):
+        try:
+            for app_iter in self.app_iters:
+                for chunk in app_iter:
+                    yield chunk
+            if self.trailer:
+                yield self.trailer
+        finally:
+            self.close()
+
+    def close(self):
         for app_iter in self.app_iters:
-            for chunk in app_iter:
-                yield chunk
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
 
     def append(self, app_iter):
         self.app_iters.append(app_iter)
@@ -567,6 +633,11 @@ class ClusterController(ObjectController):
         if 'content-type' not in req.headers:
             return HTTPBadRequest(request=req,
                                   body='Must specify Content-Type')
+        # absolute time the sessions must finish by, passed to object servers
+        # which queue sessions by it and reject the ones that cannot meet it
+        if 'x-zerovm-deadline' in req.headers and not check_float(req.headers['x-zerovm-deadline']):
+            return HTTPBadRequest(request=req,
+                                  body='Invalid x-zerovm-deadline')
         upload_expiration = time.time() + self.app.max_upload_time
         etag = md5()
         req.bytes_transferred = 0
@@ -797,9 +868,13 @@ class ClusterController(ObjectController):
 
         for conn in conns:
             if getattr(conn, 'error', None):
+                headers = dict(conn.nexe_headers)
+                retry_after = conn.resp.getheader('retry-after')
+                if retry_after:
+                    headers['Retry-After'] = retry_after
                 return Response(body=conn.error,
                                 status="%d %s" % (conn.resp.status, conn.resp.reason),
-                                headers=conn.nexe_headers)
+                                headers=headers)
 
         _attach_connections_to_data_sources(conns, data_sources)
 
@@ -847,6 +922,14 @@ class ClusterController(ObjectController):
         final_body = None
         final_response = Response(request=req)
         req.cdr_log = []
+        # with a streamed node the client gets a tar stream of node outputs and reports
+        streamed = any(getattr(conn, 'streamed', False) for conn in conns)
+        if streamed:
+            final_body = FinalBody(iter(()))
+            final_body.trailer = NUL * (BLOCKSIZE * 2)
+            final_response.app_iter = final_body
+            final_response.content_type = TAR_MIMES[0]
+            final_response.headers['x-zerovm-stream'] = 'true'
         for conn in conns:
             resp = conn.resp
             if resp:
@@ -858,23 +941,37 @@ class ClusterController(ObjectController):
                     conn.error.replace('\n', '')
 
             #print [final_response.headers, conn.nexe_headers]
-            self._store_accounting_data(req, conn)
+            if getattr(conn, 'streamed', False):
+                # session is still running, it is accounted when its report arrives
+                # or when the client is gone
+                final_body.append(resp.app_iter)
+            else:
+                self._store_accounting_data(req, conn)
+                if streamed:
+                    final_body.append(_node_members(conn))
             merge_headers(final_response.headers, conn.nexe_headers)
             if resp and resp.headers.get('x-zerovm-daemon', None):
                 final_response.headers['x-nexe-cached'] = 'true'
-            if resp and resp.content_length > 0:
+            if resp and not streamed and resp.content_length > 0:
                 if final_body:
                     final_body.append(resp.app_iter)
-                    final_response.content_length += resp.content_length
                 else:
                     final_body = FinalBody(resp.app_iter)
                     final_response.app_iter = final_body
-                    final_response.content_length = resp.content_length
+                    final_response.content_length = 0
                     final_response.content_type = resp.content_type
+                final_response.content_length += resp.content_length
+        if streamed:
+            # size of streamed output is not known, response is chunked
+            final_response.content_length = None
         if ns_server:
             ns_server.stop()
         if self.app.zerovm_accounting_enabled:
-            self.app.zerovm_ns_thrdpool.spawn_n(self._store_accounting_data, req)
+            if streamed:
+                final_body.callbacks.append(
+                    lambda: self.app.zerovm_ns_thrdpool.spawn_n(self._store_accounting_data, req))
+            else:
+                self.app.zerovm_ns_thrdpool.spawn_n(self._store_accounting_data, req)
         if self.app.zerovm_use_cors and self.container_name:
             container_info = self.container_info(self.account_name, self.container_name)
             if container_info.get('cors', None):
@@ -908,10 +1005,15 @@ class ClusterController(ObjectController):
                           server_response.reason,
                           server_response.read())
             return conn
+        streamed = server_response.getheader('x-zerovm-stream', 'false').lower() in TRUE_VALUES
+        if streamed:
+            read_iter = _member_iter(server_response, self.app.network_chunk_size)
+        else:
+            read_iter = iter(lambda: server_response.read(self.app.network_chunk_size), '')
         resp = Response(status='%d %s' %
                                (server_response.status,
                                 server_response.reason),
-                        app_iter=iter(lambda: server_response.read(self.app.network_chunk_size), ''),
+                        app_iter=read_iter,
                         headers=dict(server_response.getheaders()))
         conn.resp = resp
         if resp.content_length == 0:
@@ -934,14 +1036,28 @@ class ClusterController(ObjectController):
                     _load_channel_data(node, ExtractedFile(untar_stream))
                     info = untar_stream.get_next_tarinfo()
                     continue
+                if streamed and STREAM_REPORT == info.name:
+                    # session ended before it wrote any output
+                    untar_stream.to_write = info.size
+                    untar_stream.offset_data = info.offset_data
+                    _load_stream_report(conn, untar_stream.read_file())
+                    info = untar_stream.get_next_tarinfo()
+                    continue
                 chan = node.get_channel(device=info.name)
                 if not chan:
                     conn.error = 'Channel name %s not found' % info.name
                     return conn
+                if not chan.path and streamed:
+                    conn.streamed = True
+                    resp.app_iter = StreamedBody(untar_stream, info, '%s/' % node.name,
+                                                 lambda data: self._finish_stream(request, conn, data))
+                    resp.content_type = chan.content_type
+                    return conn
                 if not chan.path:
+                    conn.channel = info.name
                     app_iter = iter(CachedBody(
                         untar_stream.tar_iter,
-                        cache=[untar_stream.block[info.offset_data:]],
+                        cache=untar_stream.buffered_chunks(info.offset_data),
                         total_size=info.size))
                     resp.app_iter = app_iter
                     resp.content_length = info.size
@@ -981,6 +1097,15 @@ class ClusterController(ObjectController):
         resp.content_length = 0
         return conn
 
+    def _finish_stream(self, request, conn, data):
+        if data is None:
+            conn.error = 'Streamed response was not finished'
+        else:
+            _load_stream_report(conn, data)
+        if conn.error:
+            conn.nexe_headers['x-nexe-error'] = conn.error.replace('\n', '')
+        self._store_accounting_data(request, conn)
+
     def _connect_exec_node(self, obj_nodes, part, request,
                            logger_thread_locals, cnode, request_headers):
         self.app.logger.thread_locals = logger_thread_locals
@@ -1008,7 +1133,11 @@ class ClusterController(ObjectController):
                     return conn
                 elif resp.status == HTTP_INSUFFICIENT_STORAGE:
                     self.error_limit(node, _('ERROR Insufficient Storage'))
-                elif is_client_error(resp.status):
+                elif is_client_error(resp.status) or \
+                        (resp.status == HTTP_SERVICE_UNAVAILABLE
+                         and resp.getheader('x-zerovm-deadline-rejected')):
+                    # the session itself is rejected, other nodes will not do better,
+                    # any other 503 means the node is busy and the next one is tried
                     conn.error = resp.read()
                     conn.resp = resp
                     return conn
@@ -1148,6 +1277,83 @@ def _load_channel_data(node, extracted_file):
                     old_ch.meta[k] = v
 
 
+# creates headers of members sent to the client
+_member_stream = TarStream()
+
+
+def _next_tarinfo(untar_stream):
+    info = untar_stream.get_next_tarinfo()
+    while not info:
+        try:
+            data = next(untar_stream.tar_iter)
+        except StopIteration:
+            return None
+        untar_stream.update_buffer(data)
+        info = untar_stream.get_next_tarinfo()
+    return info
+
+
+def _member_iter(server_response, chunk_size):
+    """
+    Reads streamed tar response of object server member by member,
+    each read asks for the rest of a member already being sent,
+    read(chunk_size) would wait until chunk_size bytes are received
+    """
+    while True:
+        header = server_response.read(BLOCKSIZE)
+        if not header:
+            return
+        yield header
+        try:
+            size = TarInfo.frombuf(header).size
+        except HeaderError:
+            # end of archive, the rest is read as is
+            for data in iter(lambda: server_response.read(chunk_size), ''):
+                yield data
+            return
+        remaining = size + (BLOCKSIZE - size % BLOCKSIZE) % BLOCKSIZE
+        while remaining:
+            data = server_response.read(min(chunk_size, remaining))
+            if not data:
+                return
+            remaining -= len(data)
+            yield data
+
+
+def _tar_member(name, data):
+    """Returns tar member holding data, with padding"""
+    header = _member_stream.create_tarinfo(ftype=REGTYPE, name=name, size=len(data))
+    return header + data + NUL * ((BLOCKSIZE - len(data) % BLOCKSIZE) % BLOCKSIZE)
+
+
+def _node_members(conn):
+    """Returns response of a node that was not streamed as tar members, output and report"""
+    name = conn.cnode.name
+    resp = conn.resp
+    if resp and getattr(conn, 'channel', None) and resp.content_length > 0:
+        yield _member_stream.create_tarinfo(ftype=REGTYPE, name='%s/%s' % (name, conn.channel),
+                                            size=resp.content_length)
+        for chunk in resp.app_iter:
+            yield chunk
+        yield NUL * ((BLOCKSIZE - resp.content_length % BLOCKSIZE) % BLOCKSIZE)
+    status = conn.error or (resp.status if resp else '503 Service Unavailable')
+    headers = dict((key, value) for key, value in conn.nexe_headers.iteritems()
+                   if key.lower().startswith('x-nexe-'))
+    yield _tar_member('%s/%s' % (name, STREAM_REPORT),
+                      json.dumps({'status': status, 'headers': headers}))
+
+
+def _load_stream_report(conn, data):
+    """Updates connection with the report of a streamed session"""
+    report = json.loads(data)
+    conn.resp.headers.update(report['headers'])
+    for key in conn.nexe_headers.keys():
+        if key in report['headers']:
+            conn.nexe_headers[key] = report['headers'][key]
+    if not report['status'].startswith('2'):
+        conn.error = report['status']
+
+
 def _total_node_count(node_list):
     count = 0
     for n in node_list:
@@ -1216,8 +1422,8 @@ def _finalize_tar_streams(chunked, data_src, req):
                     return HTTPServiceUnavailable(request=req)
     for conn in data_src.conns:
         if conn['conn'].last_data is data_src:
-            if conn['conn'].tar_stream.data:
-                data = conn['conn'].tar_stream.data
+            if conn['conn'].tar_stream.buffer_len:
+                data = conn['conn'].tar_stream.flush()
                 if not conn['conn'].failed:
                     _queue_put(conn, data, chunked)
                 else:
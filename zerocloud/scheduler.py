@@ -0,0 +1,640 @@
+import errno
+import fcntl
+import math
+import os
+import time
+from collections import deque
+from heapq import heapify, heappop, heappush
+from itertools import count
+from multiprocessing import cpu_count
+
+from eventlet import sleep, spawn
+from eventlet.event import Event
+
+from zerocloud.metrics import send_gauge
+
+
+class HostSlots(object):
+    """
+    Slots shared by all processes of the host, each slot is a lock file
+
+    A slot is taken with a non-blocking flock of its file. Locks are
+    released by the kernel when a process exits, so slots of crashed
+    workers are never lost.
+    """
+
+    def __init__(self, path, size):
+        """
+        :param path: prefix of slot file names, slot files are `<path>.<index>`
+        :param size: number of slots on the host
+        """
+        self.path = path
+        self.size = size
+        # slot index -> open slot file
+        self.fds = {}
+        # slots taken by this process
+        self.held = set()
+        parent = os.path.dirname(path)
+        if parent and not os.path.exists(parent):
+            try:
+                os.makedirs(parent)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def acquire(self):
+        """Takes a free slot without blocking, returns its index or None if all slots are taken"""
+        for i in xrange(self.size):
+            if i not in self.held and self._lock(i):
+                self.held.add(i)
+                return i
+        return None
+
+    def release(self, slot):
+        self.held.remove(slot)
+        fcntl.flock(self.fds[slot], fcntl.LOCK_UN)
+
+    def used(self):
+        """Returns number of slots taken by all processes of the host"""
+        used = len(self.held)
+        for i in xrange(self.size):
+            if i in self.held:
+                continue
+            if self._lock(i):
+                fcntl.flock(self.fds[i], fcntl.LOCK_UN)
+            else:
+                used += 1
+        return used
+
+    def _lock(self, slot):
+        fd = self.fds.get(slot)
+        if fd is None:
+            fd = self.fds[slot] = os.open('%s.%d' % (self.path, slot), os.O_RDWR | os.O_CREAT, 0644)
+            # zerovm and daemons spawned by the worker must not inherit the lock,
+            # or the slot stays taken while they outlive a crashed worker
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        return True
+
+
+class MemoryBudget(object):
+    """
+    Memory shared by the pools of a process, or by all processes of the host
+
+    Jobs declare the memory they need and run only while it fits in the budget,
+    a job larger than the whole budget runs alone. Pools waiting for memory
+    are dispatched again when any of them releases it.
+
+    Budget of the host is a file with one byte for each unit of memory,
+    a job holds record locks of the units it needs. Record locks are released
+    by the kernel when a process exits and are not inherited by its children.
+    Pools poll for memory released by other processes.
+    """
+
+    def __init__(self, size, path=None, unit=64 * 1048576):
+        """
+        :param size: budget in bytes
+        :param path: file of the budget shared by all processes of the host, None for a per-process budget
+        :param unit: bytes of memory in one lock of the host budget
+        """
+        self.size = size
+        self.used = 0
+        self.pools = []
+        self.path = path
+        self.unit = unit
+        self.units = max(1, size // unit)
+        # units locked by this process, record locks of one process do not conflict
+        self.held = set()
+        self.fd = None
+        if path:
+            parent = os.path.dirname(path)
+            if parent and not os.path.exists(parent):
+                try:
+                    os.makedirs(parent)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+            fcntl.fcntl(self.fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+
+    def fits(self, cost):
+        if self.take(cost):
+            self._give_back(cost)
+            return True
+        return False
+
+    def take(self, cost):
+        """Takes memory for a job without blocking, returns False if it does not fit"""
+        if self.fd is None:
+            if self.used and self.used + cost > self.size:
+                return False
+            self.used += cost
+            return True
+        need = self._get_units(cost)
+        taken = []
+        for i in xrange(self.units):
+            if len(taken) >= need:
+                break
+            if i not in self.held and self._lock(i):
+                taken.append(i)
+                self.held.add(i)
+        if len(taken) < need:
+            for i in taken:
+                self.held.remove(i)
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, i)
+            return False
+        self.used += cost
+        return True
+
+    def release(self, cost):
+        self._give_back(cost)
+        for pool in self.pools:
+            pool._dispatch_free()
+
+    def _give_back(self, cost):
+        self.used -= cost
+        if self.fd is not None:
+            # units are interchangeable, any held ones are unlocked
+            for _junk in xrange(self._get_units(cost)):
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, self.held.pop())
+
+    def _get_units(self, cost):
+        # a job larger than the budget takes all the units and runs alone
+        return min(self.units, (cost + self.unit - 1) // self.unit)
+
+    def _lock(self, unit):
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, unit)
+        except IOError, e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        return True
+
+
+# run times of adaptive pools are counted in quarter octave buckets from 1ms
+RUN_TIME_MIN = 0.001
+RUN_TIME_BUCKETS = 100
+
+
+class AdaptiveLimit(object):
+    """
+    AIMD limit of a pool driven by run times of its jobs and host load
+
+    The baseline is the distribution of run times seen, which slowly decays
+    to follow changes of the workload. Each run time divided by the tolerance
+    is ranked in the baseline and the ranks are smoothed. When all jobs run
+    as usual the smoothed rank stays below a half, even if the pool mixes
+    short and long jobs, it goes above when jobs run more than tolerance times
+    longer than before. Once per interval the limit is cut by the backoff factor
+    if that happens or the host is overloaded, otherwise it is raised by one
+    if jobs wait in the queue.
+    """
+
+    def __init__(self, min_size, max_size, tolerance=2.0, max_load=1.0,
+                 interval=1.0, backoff=0.75, smoothing=0.2, drift=0.01):
+        """
+        :param min_size: lowest limit
+        :param max_size: highest limit
+        :param tolerance: how many times longer than before jobs run when the limit is cut
+        :param max_load: 1 minute load average per cpu above which the limit is cut
+        :param interval: seconds between limit changes
+        :param backoff: factor the limit is multiplied by when it is cut
+        :param smoothing: weight of the rank of a new run time in the smoothed rank
+        :param drift: weight of a new run time in the baseline
+        """
+        self.min_size = min_size
+        self.max_size = max_size
+        self.tolerance = tolerance
+        self.max_load = max_load
+        self.interval = interval
+        self.backoff = backoff
+        self.smoothing = smoothing
+        self.drift = drift
+        # weights of run time buckets
+        self.baseline = [0.0] * RUN_TIME_BUCKETS
+        self.rank = 0.0
+        self.last = time.time()
+        try:
+            self.cpus = cpu_count()
+        except NotImplementedError:
+            self.cpus = 1
+
+    def clamp(self, size):
+        return max(self.min_size, min(self.max_size, size))
+
+    def get_load(self):
+        """Returns host load per cpu, run queue of linux counts tasks waiting for io too"""
+        try:
+            return os.getloadavg()[0] / self.cpus
+        except OSError:
+            return 0.0
+
+    def get_rank(self, seconds):
+        """Returns share of the baseline below the run time, 0.0 if the baseline is empty"""
+        total = sum(self.baseline)
+        if not total:
+            return 0.0
+        i = _run_time_bucket(seconds)
+        return (sum(self.baseline[:i]) + self.baseline[i] / 2) / total
+
+    def update(self, pool, seconds):
+        """Records run time of a job of the pool, returns new limit of the pool"""
+        self.rank += (self.get_rank(seconds / self.tolerance) - self.rank) * self.smoothing
+        self.baseline = [weight * (1 - self.drift) for weight in self.baseline]
+        self.baseline[_run_time_bucket(seconds)] += self.drift
+        now = time.time()
+        if now - self.last < self.interval:
+            return pool.size
+        self.last = now
+        if self.rank > 0.5 or self.get_load() > self.max_load:
+            return self.clamp(int(pool.size * self.backoff))
+        if pool.queued and pool.running >= pool.size:
+            return self.clamp(pool.size + 1)
+        return pool.size
+
+
+def _run_time_bucket(seconds):
+    if seconds <= RUN_TIME_MIN:
+        return 0
+    return min(int(math.log(seconds / RUN_TIME_MIN, 2) * 4), RUN_TIME_BUCKETS - 1)
+
+
+class FairPool(object):
+    """
+    Pool of execution slots shared between accounts, works like GreenPool.
+
+    When all the slots are busy jobs are queued per account and dispatched
+    with deficit round robin, each account gets slots in proportion to its weight.
+
+    With host slots each running job also holds one of the slots shared by
+    all processes of the host, and each queued job one of the host queue slots.
+    Slots freed by other processes are polled for while jobs are queued.
+
+    With memory budget a job also needs its declared memory (cost) to start,
+    memory of the host budget released by other processes is polled for too.
+    Jobs are dispatched in order, a large job waits for memory at the head
+    of the queue and is not overtaken by smaller ones.
+
+    With adaptive limit the size is changed by it after each job.
+
+    Jobs of an account are dispatched earliest deadline first,
+    jobs without deadline after them in the order they came.
+    """
+
+    def __init__(self, size, weights=None, name='default', logger=None,
+                 host_slots=None, host_queue=None, poll_interval=0.05, memory=None,
+                 limit=None):
+        """
+        :param size: number of jobs that can run simultaneously
+        :param weights: dict of account name to weight, default weight is 1
+        :param name: pool name, used in metric names
+        :param logger: logger with statsd methods, to report wait time and queue depth
+        :param host_slots: HostSlots limiting jobs running on the host, None for a per-process limit
+        :param host_queue: HostSlots limiting jobs queued on the host, None for a per-process limit
+        :param poll_interval: seconds between checks for host slots freed by other processes
+        :param memory: MemoryBudget shared with other pools, None to count only slots
+        :param limit: AdaptiveLimit, None to keep the size
+        """
+        self.limit = limit
+        if limit:
+            size = limit.clamp(size)
+        self.size = size
+        self.host_slots = host_slots
+        self.host_queue = host_queue
+        self.poll_interval = poll_interval
+        # host slots held by running jobs
+        self.slots = []
+        self.poller = None
+        self.memory = memory
+        if memory:
+            memory.pools.append(self)
+        self.weights = weights or {}
+        self.name = name
+        self.logger = logger
+        self.running = 0
+        # smoothed run time of the jobs, to estimate the wait in the queue
+        self.run_time = 0.0
+        # account -> heap of (deadline, sequence number, (event, enqueue time, ticket, cost, deadline))
+        self.queues = {}
+        self.sequence = count()
+        self.queued = 0
+        # accounts with waiting jobs, in dispatch order
+        self.active = deque()
+        self.deficit = {}
+
+    def get_weight(self, account):
+        return self.weights.get(account, 1)
+
+    def free(self):
+        # running jobs are above the size when the size is cut
+        free = max(0, self.size - self.running)
+        if self.host_slots:
+            return min(free, self.host_slots.size - self.host_slots.used())
+        return free
+
+    def waiting(self, account=None):
+        if account is None:
+            return self.queued
+        return len(self.queues.get(account, ()))
+
+    def estimate(self, deadline=None):
+        """
+        Returns expected seconds a new job waits in the queue before it starts,
+        only jobs dispatched before it by deadline are counted, so the estimate is optimistic
+
+        :param deadline: absolute time the job must finish by, None if it has no deadline
+        """
+        key = deadline or float('inf')
+        ahead = sum(1 for queue in self.queues.itervalues() for item in queue if item[0] <= key)
+        if not ahead and self.free() > 0:
+            return 0.0
+        return (ahead // max(self.size, 1) + 1) * self.run_time
+
+    def host_waiting(self):
+        """Returns number of jobs queued in all processes of the host"""
+        if self.host_queue:
+            return self.host_queue.used()
+        return self.queued
+
+    def can_admit(self, account, queue, cost=0):
+        """
+        Checks whether new job of the account can be accepted
+
+        A job is accepted if there is a free slot or place in the queue.
+        If the queue is full, accounts that have less than their weighted share
+        of the queue are still accepted, so one busy account cannot lock others out.
+        With host queue the queue length is counted on the host, the share
+        is kept only against accounts queued in this process.
+
+        :param account: account name
+        :param queue: maximum queue length
+        :param cost: memory the job needs
+        :returns True if job can be accepted
+        """
+        if (self.free() > 0 and self._fits(cost)) or self.host_waiting() < queue:
+            return True
+        if self.host_queue and not [a for a in self.active if a != account]:
+            # host queue is full, no other account waits here to share it with
+            return False
+        weights = sum(self.get_weight(a) for a in self.active if a != account)
+        weight = self.get_weight(account)
+        share = queue * weight / float(weights + weight)
+        return self.waiting(account) < int(share)
+
+    def spawn(self, account, func, *args, **kwargs):
+        """
+        Runs func in a green thread, blocks until the account gets a slot
+
+        :returns GreenThread instance, use wait() to get the result
+        """
+        self._acquire(account)
+        try:
+            return spawn(self._run, 0, func, args, kwargs)
+        except BaseException:
+            self._release()
+            raise
+
+    def reserve(self, account, cost=0, deadline=None):
+        """
+        Takes a slot for the account in advance without blocking,
+        or puts the account in the queue if all the slots are busy
+
+        :param cost: memory the job needs
+        :param deadline: absolute time the job must finish by, orders the queue of the account
+        :returns None if the slot is taken, otherwise queue entry to pass
+                 to wait_reserved() or cancel()
+        """
+        return self._enqueue(account, cost, deadline)
+
+    def wait_reserved(self, account, entry):
+        """Blocks until the queue entry returned by reserve() gets a slot"""
+        self._wait(account, entry)
+
+    def spawn_reserved(self, cost, func, *args, **kwargs):
+        """Runs func in a green thread in a slot taken with reserve(), cost is the one passed to reserve()"""
+        try:
+            return spawn(self._run, cost, func, args, kwargs)
+        except BaseException:
+            self._release(cost)
+            raise
+
+    def cancel(self, account, entry=None, cost=0):
+        """Gives back a slot taken with reserve(), or leaves the queue if the slot is not taken yet"""
+        if entry is not None and not entry[0].ready():
+            self._remove(account, entry)
+        else:
+            self._release(cost)
+
+    def _run(self, cost, func, args, kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            seconds = time.time() - start
+            self.run_time += (seconds - self.run_time) * 0.2
+            if self.limit:
+                self._resize(self.limit.update(self, seconds))
+            self._release(cost)
+
+    def _resize(self, size):
+        # running jobs are not stopped when the size is cut, queued jobs wait for them
+        if size != self.size:
+            self.size = size
+            if self.logger:
+                send_gauge(self.logger, 'zap_pool_limit.%s' % self.name, size)
+
+    def _acquire(self, account):
+        entry = self._enqueue(account, 0)
+        if entry is not None:
+            self._wait(account, entry)
+
+    def _enqueue(self, account, cost, deadline=None):
+        if self.logger:
+            send_gauge(self.logger, 'zap_pool_queue_depth.%s' % self.name, self.queued)
+        if self.running < self.size and not self.queued and self._take_slot(cost):
+            self.running += 1
+            return None
+        event = Event()
+        queue = self.queues.get(account)
+        if queue is None:
+            queue = self.queues[account] = []
+            self.active.append(account)
+            self.deficit[account] = 0
+        ticket = None
+        if self.host_queue:
+            # None if host queue is full, account is admitted by its share
+            ticket = self.host_queue.acquire()
+        entry = (event, time.time(), ticket, cost, deadline)
+        heappush(queue, (deadline or float('inf'), next(self.sequence), entry))
+        self.queued += 1
+        if (self.host_slots or (self.memory and self.memory.path)) and self.poller is None:
+            self.poller = spawn(self._poll)
+        return entry
+
+    def _wait(self, account, entry):
+        event = entry[0]
+        try:
+            start = event.wait()
+        except BaseException:
+            if event.ready():
+                self._release(entry[3])
+            else:
+                self._remove(account, entry)
+            raise
+        if self.logger:
+            self.logger.timing_since('zap_pool_wait_time.%s' % self.name, start)
+
+    def _release(self, cost=0):
+        self.running -= 1
+        if self.host_slots:
+            self.host_slots.release(self.slots.pop())
+        if self.memory:
+            # other pools may wait for the memory too
+            self.memory.release(cost)
+        self._dispatch_free()
+
+    def _dispatch_free(self):
+        while self.running < self.size and self.queued \
+                and self._take_slot(self.queues[self._next_account()][0][2][3]):
+            self._dispatch()
+
+    def _fits(self, cost):
+        return not self.memory or self.memory.fits(cost)
+
+    def _take_slot(self, cost=0):
+        """Takes a host slot and memory for a job of the cost, nothing if either is not available"""
+        slot = None
+        if self.host_slots:
+            slot = self.host_slots.acquire()
+            if slot is None:
+                return False
+        if self.memory and not self.memory.take(cost):
+            if slot is not None:
+                self.host_slots.release(slot)
+            return False
+        if slot is not None:
+            self.slots.append(slot)
+        return True
+
+    def _poll(self):
+        try:
+            while self.queued:
+                sleep(self.poll_interval)
+                self._dispatch_free()
+        finally:
+            self.poller = None
+
+    def _remove(self, account, entry):
+        queue = self.queues[account]
+        queue[:] = [item for item in queue if item[2] is not entry]
+        heapify(queue)
+        self.queued -= 1
+        self._release_ticket(entry)
+        if not queue:
+            self._deactivate(account)
+
+    def _release_ticket(self, entry):
+        if entry[2] is not None:
+            self.host_queue.release(entry[2])
+
+    def _deactivate(self, account):
+        self.active.remove(account)
+        del self.deficit[account]
+        del self.queues[account]
+
+    def _next_account(self):
+        """Returns account whose job is dispatched next"""
+        account = self.active[0]
+        while self.deficit[account] < 1:
+            # account has used its quantum, next one gets a new quantum
+            self.active.rotate(-1)
+            account = self.active[0]
+            self.deficit[account] += self.get_weight(account)
+        return account
+
+    def _dispatch(self):
+        account = self._next_account()
+        queue = self.queues[account]
+        entry = heappop(queue)[2]
+        event, start = entry[:2]
+        self.deficit[account] -= 1
+        self.queued -= 1
+        self._release_ticket(entry)
+        if not queue:
+            self._deactivate(account)
+        self.running += 1
+        event.send(start)
+
+
+class AccountPool(object):
+    """FairPool bound to an account, used where a GreenPool was used before"""
+
+    def __init__(self, pool, account, cost=0, deadline=None):
+        """
+        :param pool: FairPool
+        :param account: account name
+        :param cost: memory a job of the account needs, can be set until the job is reserved or spawned
+        :param deadline: absolute time the job must finish by, can be set like the cost
+        """
+        self.pool = pool
+        self.account = account
+        self.cost = cost
+        self.deadline = deadline
+        # slot or place in the queue is taken in advance by reserve()
+        self.reserved = False
+        self.entry = None
+
+    def free(self):
+        return self.pool.free()
+
+    def waiting(self):
+        return self.pool.waiting(self.account)
+
+    def estimate(self):
+        """Returns expected seconds until the job finishes, see FairPool.estimate()"""
+        if self.reserved and self.entry is None:
+            return self.pool.run_time
+        return self.pool.estimate(self.deadline) + self.pool.run_time
+
+    def can_admit(self, queue):
+        if self.reserved:
+            return True
+        return self.pool.can_admit(self.account, queue, self.cost)
+
+    def reserve(self, queue):
+        """
+        Takes a slot, or a place in the queue, in advance, the next spawn() runs in it
+
+        :param queue: maximum queue length
+        :returns False if the account cannot be admitted
+        """
+        if self.reserved:
+            return True
+        if not self.pool.can_admit(self.account, queue, self.cost):
+            return False
+        self.entry = self.pool.reserve(self.account, self.cost, self.deadline)
+        self.reserved = True
+        return True
+
+    def cancel(self):
+        """Gives back the reservation if it was not used"""
+        if self.reserved:
+            self.reserved = False
+            entry, self.entry = self.entry, None
+            self.pool.cancel(self.account, entry, self.cost)
+
+    def spawn(self, func, *args, **kwargs):
+        if self.reserved:
+            self.reserved = False
+            entry, self.entry = self.entry, None
+        else:
+            entry = self.pool.reserve(self.account, self.cost, self.deadline)
+        if entry is not None:
+            self.pool.wait_reserved(self.account, entry)
+        return self.pool.spawn_reserved(self.cost, func, *args, **kwargs)
@@ -11,12 +11,20 @@ import struct
 import copy
 import re
 import operator
+from collections import deque, OrderedDict
+import tarfile
+from tempfile import mkstemp
 
 try:
     import grp, pwd
 except ImportError:
     grp = pwd = None
 
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
 #---------------------------------------------------------
 # tar constants
 #---------------------------------------------------------
@@ -219,6 +227,12 @@ def calc_chksums(buf):
     return unsigned_chksum, signed_chksum
 
 
+def calc_unsigned_chksum(buf):
+    """Calculate only the unsigned checksum, which is used by all modern tars.
+    """
+    return 256 + sum(bytearray(buf[:148])) + sum(bytearray(buf[156:512]))
+
+
 class TarInfo(object):
     """Informational class which holds the details about an
        archive member given by a tar header block.
@@ -510,7 +524,7 @@ class TarInfo(object):
             raise EOFHeaderError("end of file header")
 
         chksum = nti(buf[148:156])
-        if chksum not in calc_chksums(buf):
+        if chksum != calc_unsigned_chksum(buf) and chksum not in calc_chksums(buf):
             raise InvalidHeaderError("bad checksum")
 
         obj = cls()
@@ -930,7 +944,7 @@ class StringBuffer:
 
     def write(self, data):
         if not self.is_closed:
-            self.body += data
+            self.body += _to_str(data)
 
     def close(self):
         self.is_closed = True
@@ -939,6 +953,11 @@ class StringBuffer:
 class TarStream(object):
 
     errors = None
+    # header blocks for already seen (type, name) pairs, shared by all streams,
+    # only size, mtime and checksum are patched for a new header,
+    # least recently used ones are evicted above max_header_templates
+    header_templates = OrderedDict()
+    max_header_templates = 1024
 
     def __init__(self, tar_iter=None, path_list=None, chunk_size=65536,
                  format=DEFAULT_FORMAT, encoding=ENCODING, append=False):
@@ -948,36 +967,101 @@ class TarStream(object):
         self.format = format
         self.encoding = encoding
         self.to_write = self.chunk_size
-        self.data = ''
+        # served data is accumulated in a reusable buffer
+        # until a full chunk can be yielded
+        self.buffer = bytearray(self.chunk_size)
+        self.buffer_len = 0
         self.file_len = 0
         self.append = append
 
+    @property
+    def data(self):
+        return str(buffer(self.buffer, 0, self.buffer_len))
+
     def serve_chunk(self, buf):
-        self.to_write -= len(buf)
-        if self.to_write < 0:
-            self.data += buf[:self.to_write]
-            self.file_len += self.chunk_size
-            yield self.data
-            self.data = buf[self.to_write:]
-            self.to_write += self.chunk_size
+        size = len(buf)
+        if size < self.to_write:
+            self.buffer[self.buffer_len:self.buffer_len + size] = buf
+            self.buffer_len += size
+            self.to_write -= size
+            return
+        view = memoryview(buf)
+        pos = self.to_write
+        if self.buffer_len:
+            self.buffer[self.buffer_len:] = view[:pos]
+            yield str(self.buffer)
+        elif pos == size:
+            yield buf
         else:
-            self.data += buf
+            yield view[:pos].tobytes()
+        self.file_len += self.chunk_size
+        # whole chunks are served directly from the input buffer
+        while size - pos >= self.chunk_size:
+            yield view[pos:pos + self.chunk_size].tobytes()
+            self.file_len += self.chunk_size
+            pos += self.chunk_size
+        self.buffer_len = size - pos
+        self.buffer[:self.buffer_len] = view[pos:]
+        self.to_write = self.chunk_size - self.buffer_len
+
+    def flush(self):
+        """Returns buffered data, which was not yet served, and empties the buffer
+        """
+        data = self.data
+        self.file_len += self.buffer_len
+        self.buffer_len = 0
+        self.to_write = self.chunk_size
+        return data
 
     def create_tarinfo(self, path=None, ftype=None, name=None, size=None):
+        if path:
+            ftype = path.type
+            name = path.file_name
+            size = path.size
+        mtime = time.time()
+        template = self._get_header_template(ftype, name)
+        if template:
+            header, chksum = template
+            size_field = itn(size, 12, self.format)
+            mtime_field = itn(mtime, 12, self.format)
+            chksum += sum(bytearray(size_field)) + sum(bytearray(mtime_field))
+            return header[:124] + size_field + mtime_field + "%06o\0" % chksum + header[155:]
         tarinfo = TarInfo()
         tarinfo.tarfile = None
-        if path:
-            tarinfo.type = path.type
-            tarinfo.name = path.file_name
-            tarinfo.size = path.size
-        else:
-            tarinfo.type = ftype
-            tarinfo.name = name
-            tarinfo.size = size
-        tarinfo.mtime = time.time()
+        tarinfo.type = ftype
+        tarinfo.name = name
+        tarinfo.size = size
+        tarinfo.mtime = mtime
         buf = tarinfo.tobuf(self.format, self.encoding, self.errors)
         return buf
 
+    def _get_header_template(self, ftype, name):
+        """Returns header block for (ftype, name) with empty size, mtime and checksum fields
+           and checksum of all the other fields, None if header cannot be patched
+        """
+        if self.format != GNU_FORMAT:
+            return None
+        key = (ftype, name, self.encoding)
+        template = self.header_templates.pop(key, None)
+        if template:
+            self.header_templates[key] = template
+            return template
+        tarinfo = TarInfo()
+        tarinfo.tarfile = None
+        tarinfo.type = ftype
+        tarinfo.name = name
+        buf = tarinfo.tobuf(self.format, self.encoding, self.errors)
+        if len(buf) != BLOCKSIZE:
+            # long names are stored in additional blocks
+            return None
+        header = buf[:124] + NUL * 24 + " " * 8 + buf[156:]
+        template = (header, sum(bytearray(header)))
+        if self.max_header_templates > 0:
+            while len(self.header_templates) >= self.max_header_templates:
+                self.header_templates.popitem(last=False)
+            self.header_templates[key] = template
+        return template
+
     @classmethod
     def get_archive_size(cls, file_size):
         size = file_size + BLOCKSIZE - 1
@@ -1004,7 +1088,7 @@ class TarStream(object):
             for file_data in path:
                 for chunk in self.serve_chunk(file_data):
                     yield chunk
-            self.file_len += len(self.data)
+            self.file_len += self.buffer_len
             blocks, remainder = divmod(self.file_len, BLOCKSIZE)
             if remainder > 0:
                 nulls = NUL * (BLOCKSIZE - remainder)
@@ -1019,7 +1103,7 @@ class TarStream(object):
             else:
                 for chunk in self.serve_chunk(NUL * (BLOCKSIZE * 2)):
                     yield chunk
-        if self.data:
+        if self.buffer_len:
             yield self.data
 
 
@@ -1027,38 +1111,49 @@ class ExtractedFile(object):
 
     def __init__(self, untar_stream):
         self.untar_stream = untar_stream
-        self.data = ''
+        # file data is kept as a list of received chunks, or memoryviews of their parts,
+        # read position is in the first one
+        self.chunks = deque()
+        self.chunks_len = 0
+        self.pos = 0
 
     def read(self, size=None):
         if size is None:
-            size = self.untar_stream.to_write
-
-        if size:
+            size = self.chunks_len - self.pos + self.untar_stream.to_write
+        while self.chunks_len - self.pos < size and self.untar_stream.to_write:
+            for chunk in self.untar_stream.get_file_views():
+                self.chunks.append(chunk)
+                self.chunks_len += len(chunk)
             if self.untar_stream.to_write:
-                while len(self.data) < size:
-                    chunk = self.untar_stream.get_file_chunk()
-                    if not chunk:
-                        result = self.data[:]
-                        self.data = ''
-                        return result
-                    self.data += chunk
-                    if self.untar_stream.to_write:
-                        self.untar_stream.block = ''
-                        try:
-                            data = next(self.untar_stream.tar_iter)
-                        except StopIteration:
-                            result = self.data[:]
-                            self.data = ''
-                            return result
-                        self.untar_stream.update_buffer(data)
+                try:
+                    data = next(self.untar_stream.tar_iter)
+                except StopIteration:
+                    break
+                self.untar_stream.update_buffer(data)
+        return self._pop_data(size)
+
+    def _pop_data(self, size):
+        # data is copied once, when it is sliced out of a chunk,
+        # whole chunks are returned as they are
+        parts = []
+        while size > 0 and self.chunks:
+            chunk = self.chunks[0]
+            available = len(chunk) - self.pos
+            if available <= size:
+                self.chunks.popleft()
+                self.chunks_len -= len(chunk)
+                if self.pos:
+                    chunk = chunk[self.pos:]
+                parts.append(_to_str(chunk))
+                self.pos = 0
+                size -= available
             else:
-                result = self.data[:]
-                self.data = ''
-                return result
-            result = self.data[:size]
-            self.data = self.data[size:]
-            return result
-        return ''
+                parts.append(_to_str(chunk[self.pos:self.pos + size]))
+                self.pos += size
+                size = 0
+        if len(parts) == 1:
+            return parts[0]
+        return ''.join(parts)
 
 
 class UntarStream(object):
@@ -1067,7 +1162,10 @@ class UntarStream(object):
                  errors=None):
         self.tar_iter = iter(tar_iter)
         self.path_list = path_list
-        self.block = ''
+        # received chunks are kept as they are until they are parsed or extracted,
+        # offset and offset_data are relative to the first one
+        self.chunks = deque()
+        self.chunks_len = 0
         self.encoding = encoding
         self.errors = errors
         self.pax_headers = {}
@@ -1078,10 +1176,9 @@ class UntarStream(object):
         self.format = None
 
     def update_buffer(self, data):
-        if self.block:
-            self.block += data
-        else:
-            self.block = data
+        if data:
+            self.chunks.append(data)
+            self.chunks_len += len(data)
 
     def __iter__(self):
         while True:
@@ -1101,14 +1198,10 @@ class UntarStream(object):
                     self.offset_data = info.offset_data
                     while self.to_write:
                         if self.fp:
-                            self.fp.write(self.get_file_chunk())
-                            if not self.to_write:
-                                self.fp.close()
-                                self.fp = None
+                            self.write_file()
                         else:
                             self.skip_file_chunk()
                         if self.to_write:
-                            self.block = ''
                             yield data
                             try:
                                 data = next(self.tar_iter)
@@ -1119,16 +1212,37 @@ class UntarStream(object):
             yield data
 
     def next_block(self, size=BLOCKSIZE):
-        if size > len(self.block):
-            return None
+        # chunks before the next header are already consumed
+        while self.chunks and self.offset >= len(self.chunks[0]):
+            self._drop_chunk()
         stop = self.offset + size
-        if stop > len(self.block):
-            self.block = self.block[self.offset:]
-            self.offset = 0
+        if stop > self.chunks_len:
             return None
         start = self.offset
         self.offset = stop
-        return self.block[start:stop]
+        chunk = self.chunks[0]
+        if stop <= len(chunk):
+            return chunk[start:stop]
+        # header spans several chunks, only its own bytes are copied
+        parts = []
+        for chunk in self.chunks:
+            parts.append(chunk[start:stop])
+            stop -= len(chunk)
+            if stop <= 0:
+                break
+            start = 0
+        return ''.join(parts)
+
+    def _drop_chunk(self):
+        chunk = self.chunks.popleft()
+        self.chunks_len -= len(chunk)
+        self.offset -= len(chunk)
+
+    def _drop_buffer(self):
+        # all buffered chunks are consumed, offsets become relative to the next received one
+        self.offset -= self.chunks_len
+        self.chunks.clear()
+        self.chunks_len = 0
 
     def read_tarinfo(self):
         buf = self.next_block()
@@ -1136,6 +1250,11 @@ class UntarStream(object):
             return None
         tarinfo = TarInfo.frombuf(buf)
         tarinfo.offset = self.offset - BLOCKSIZE
+        if tarinfo.type in (REGTYPE, AREGTYPE) and not self.pax_headers:
+            # plain file, nothing to patch: just skip the data blocks
+            tarinfo.offset_data = self.offset
+            self.offset += tarinfo._block(tarinfo.size)
+            return tarinfo
         if tarinfo.type in (GNUTYPE_LONGNAME, GNUTYPE_LONGLINK):
             return tarinfo._proc_gnulong(self)
         elif tarinfo.type == GNUTYPE_SPARSE:
@@ -1146,34 +1265,56 @@ class UntarStream(object):
             return tarinfo._proc_builtin(self)
 
     def write_file(self):
-        chunk = self.get_file_chunk()
-        if self.fp:
-            self.fp.write(chunk)
-            if not self.to_write:
-                self.fp.close()
-                self.fp = None
+        for view in self.get_file_views():
+            if self.fp:
+                self.fp.write(view)
+        if self.fp and not self.to_write:
+            self.fp.close()
+            self.fp = None
 
-    def get_file_chunk(self):
-        buf_size = len(self.block)
-        eof = self.offset_data + self.to_write
-        if eof <= buf_size:
-            self.to_write = 0
-            return self.block[self.offset_data:eof]
+    def get_file_views(self):
+        """
+        Returns buffered data of the current member: received chunks
+        or memoryviews of their parts, nothing is copied
+        """
+        views = []
         start = self.offset_data
-        self.offset_data = 0
-        self.offset -= buf_size
-        self.to_write = eof - buf_size
-        return self.block[start:]
+        for chunk in self.chunks:
+            if not self.to_write:
+                break
+            if start >= len(chunk):
+                start -= len(chunk)
+                continue
+            stop = min(len(chunk), start + self.to_write)
+            if start or stop < len(chunk):
+                views.append(memoryview(chunk)[start:stop])
+            else:
+                views.append(chunk)
+            self.to_write -= stop - start
+            start = 0
+        if self.to_write:
+            # rest of the member is not received yet
+            self.offset_data = start
+            self._drop_buffer()
+        return views
+
+    def buffered_chunks(self, start):
+        """Returns buffered data from the start offset on, whole chunks are not copied"""
+        chunks = []
+        for chunk in self.chunks:
+            if start < len(chunk):
+                chunks.append(chunk[start:] if start else chunk)
+            start = max(0, start - len(chunk))
+        return chunks
 
     def skip_file_chunk(self):
-        buf_size = len(self.block)
         eof = self.offset_data + self.to_write
-        if eof < buf_size:
+        if eof <= self.chunks_len:
             self.to_write = 0
             return
         self.offset_data = 0
-        self.offset -= buf_size
-        self.to_write = eof - buf_size
+        self.to_write = eof - self.chunks_len
+        self._drop_buffer()
 
     def get_next_tarinfo(self):
         info = None
@@ -1197,16 +1338,153 @@ class UntarStream(object):
         return info
 
     def untar_file_iter(self):
+        """Yields the rest of the current member as received chunks or memoryviews of their parts"""
         while self.to_write:
-            yield self.get_file_chunk()
+            for view in self.get_file_views():
+                yield view
             if self.to_write:
-                self.block = ''
                 try:
                     data = next(self.tar_iter)
                 except StopIteration:
                     break
                 self.update_buffer(data)
 
+    def read_file(self):
+        """Returns the rest of the current member as a string"""
+        return ''.join(_to_str(view) for view in self.untar_file_iter())
+
+
+def _to_str(data):
+    # memoryviews are copied, strings are returned as they are
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return data
+
+
+class TarIndex(object):
+    """Member index of a static tar file: member name -> (offset, size, type, linkname).
+       Lets us read a member with one positioned read instead of a full tar scan.
+    """
+
+    # how many links we follow when resolving a member
+    MAX_LINKS = 8
+
+    def __init__(self, path):
+        self.path = path
+        self.identity = None
+        self.members = {}
+
+    @classmethod
+    def get_identity(cls, path):
+        st = os.stat(path)
+        return [st.st_dev, st.st_ino, int(st.st_mtime), st.st_size]
+
+    def is_stale(self):
+        try:
+            return self.identity != self.get_identity(self.path)
+        except OSError:
+            return True
+
+    def build(self):
+        identity = self.get_identity(self.path)
+        members = {}
+        tar = tarfile.open(self.path)
+        try:
+            for info in tar:
+                members[info.name] = (info.offset_data, info.size, info.type, info.linkname)
+        finally:
+            tar.close()
+        self.identity = identity
+        self.members = members
+
+    def load(self, index_file):
+        """Loads persisted index, returns False if it's missing, outdated
+           or can be written by other users
+        """
+        try:
+            fp = open(index_file, 'rb')
+            try:
+                st = os.fstat(fp.fileno())
+                if st.st_uid != os.geteuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                    return False
+                data = json.load(fp)
+            finally:
+                fp.close()
+        except (IOError, OSError, ValueError):
+            return False
+        try:
+            identity = self.get_identity(self.path)
+        except OSError:
+            return False
+        if data.get('path') != self.path or data.get('identity') != identity:
+            return False
+        try:
+            # member names are saved as unicode, tarfile gives them as utf-8 strings
+            members = dict((name.encode('utf-8'), tuple(value)) for name, value in data['members'].iteritems())
+        except (ValueError, TypeError, AttributeError):
+            return False
+        self.identity = identity
+        self.members = members
+        return True
+
+    def save(self, index_file):
+        index_dir = os.path.dirname(index_file)
+        fd, tmp_path = mkstemp(dir=index_dir)
+        try:
+            fp = os.fdopen(fd, 'wb')
+            json.dump({'path': self.path,
+                       'identity': self.identity,
+                       'members': self.members}, fp)
+            fp.close()
+            os.rename(tmp_path, index_file)
+        except (OSError, IOError, ValueError):
+            # names that are not utf-8 cannot be saved as json
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def lookup(self, name):
+        """Finds data of a member, follows hard and symbolic links
+           :returns (offset, size) or None if member cannot be read directly
+        """
+        for _junk in range(self.MAX_LINKS):
+            entry = self.members.get(name)
+            if not entry:
+                return None
+            offset, size, type, linkname = entry
+            if type in (REGTYPE, AREGTYPE, CONTTYPE):
+                return offset, size
+            if type == LNKTYPE:
+                name = linkname
+            elif type == SYMTYPE:
+                name = os.path.normpath(os.path.join(os.path.dirname(name), linkname))
+            else:
+                return None
+        return None
+
+    def copy_member(self, name, dst, chunk_size=65536):
+        """Copies member data to file object dst
+           :returns True if member was found and copied
+        """
+        entry = self.lookup(name)
+        if not entry:
+            return False
+        offset, size = entry
+        fp = open(self.path, 'rb')
+        try:
+            fp.seek(offset)
+            while size > 0:
+                chunk = fp.read(min(chunk_size, size))
+                if not chunk:
+                    raise IOError('unexpected end of tar file %s' % self.path)
+                dst.write(chunk)
+                size -= len(chunk)
+        finally:
+            fp.close()
+        return True
+
 if __name__ == "__main__":
     if len(sys.argv) < 4:
         print 'Usage: tarstream.py cf|xf <tar source> <tar dest> <filtered files>'